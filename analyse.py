@@ -13,7 +13,7 @@ Requires lucid-utils for actually analysing files.
 from __future__ import print_function
 
 # Required for analysis of files
-from lucid_utils import blobbing, xycreader
+from lucid_utils import blobbing
 
 from lucid_utils.classification.lucid_algorithm import classify
 
@@ -26,12 +26,98 @@ import os
 
 import csv
 
-import io
-
 import dscreader
 
+import xycarray
+
+import clustering
+
+import clusterfeatures
+
+import resultcache
+
+from framearchive import list_members
+
+from checkpoint import Checkpoint, CHECKPOINT_SUFFIX
+
+import columnar
+
+import framepack
+
+import dscindex
+
+import rates
+
+import hotpixels
+
+import prefetch
+
+import clustertable
+
+from metrics import Metrics, METRICS_JSON
+
 import time
 
+# For analysing frames on every core of the worker node
+import multiprocessing
+
+import numpy
+
+# How many frames are handed to a worker process at a time. The CSV file is flushed after every chunk.
+CHUNK_SIZE = 256
+
+# The size of the write buffer for the CSV file, in bytes
+BUFFER_SIZE = 1024 * 1024
+
+OUTPUT_CSV = "grid-analysis-frames.csv"
+
+# The settings analysis runs with unless told otherwise. These are passed along with every chunk of frames, so they
+# need to be picklable.
+DEFAULT_SETTINGS = {
+    # Find clusters with clustering.find instead of blobbing.find. This is only turned on once
+    # clustering.matches_blobbing has shown the installed blobbing.find gives the same clusters, held the same way.
+    'fast_clustering': False,
+    # The path to a result cache (see resultcache), or None to analyse every frame from scratch
+    'cache': None,
+    # The most results to keep in the cache before evicting the least recently used
+    'cache_size': resultcache.DEFAULT_MAX_ENTRIES,
+    # Time each stage of the analysis and keep track of the slowest frames (see metrics)
+    'metrics': False,
+    # The path to a hot pixel mask to apply to every frame before clustering (see hotpixels), or None
+    'hot_pixels': None,
+    # Read up to this many frames ahead in a background thread while analysing (see prefetch), or 0 to read each
+    # frame only when it's needed
+    'prefetch': 0,
+    # The path to write a table of every cluster and its features to (see clustertable), or None
+    'clusters': None,
+}
+
+# Frames with this many hit pixels or fewer are clustered straight from their pixels, rather than being laid out as a
+# full frame first
+SPARSE_MAX_PIXELS = 16
+
+# The name of the classifier, worked out the first time it's needed (see classifier_name)
+_classifier_name = None
+
+# The counts for a frame with nothing in it. This is shared between frames, so it mustn't be changed.
+EMPTY_COUNTS = {'alpha': 0, 'beta': 0, 'gamma': 0, 'proton': 0, 'muon': 0, 'other': 0}
+
+CSV_HEADER = ["Frame Name", "Capture Time", "Detector ID", "Bias Voltage", "Acquisition Time", "Alpha", "Beta", "Gamma",
+              "Proton", "Muon", "Other"]
+
+
+def make_settings(settings):
+    """
+    Fill in any analysis settings that haven't been given with their defaults.
+
+    :param settings: A dict of analysis settings, or None
+    :return: A complete dict of analysis settings
+    """
+    full = dict(DEFAULT_SETTINGS)
+    if settings is not None:
+        full.update(settings)
+    return full
+
 
 def decompress(user_zip):
     """
@@ -42,19 +128,533 @@ def decompress(user_zip):
     zipfile.ZipFile.extractall(archive, 'decompressed_frames')
 
 
-def analyse_folder(folder):
+def frame_size(dsc):
     """
-    Analyse a folder of XYC formatted files from a Timepix radiation detector, saving the output into a memory stream.
+    Get the size of a frame from its DSC file, falling back to the standard 256x256 if there isn't one.
 
-    :param folder: The folder containg the files to be analysed
-    :return: A BytesIO representation of the CSV file
+    :param dsc: The DscFile for the frame, or None if it doesn't have one
+    :return: A tuple of (width, height)
     """
-    output = io.BytesIO()
+    if dsc is None:
+        return xycarray.DEFAULT_WIDTH, xycarray.DEFAULT_HEIGHT
+    return dsc.getFrameWidth(), dsc.getFrameHeight()
 
-    writer = csv.writer(output)
 
-    writer.writerow(["Frame Name", "Capture Time", "Detector ID", "Bias Voltage", "Acquisition Time", "Alpha", "Beta", "Gamma", "Proton", "Muon", "Other"])
+def count_particles(frame, settings, metrics=None, table=None):
+    """
+    Find and classify the clusters in a frame, and count how many there are of each particle type.
+
+    :param frame: The frame, as read by xycarray (or xycreader)
+    :param settings: The analysis settings
+    :param metrics: The Metrics to time the clustering and classification with, or None
+    :param table: A list to add the frame's clusters to, as arguments for clustertable.records (after the frame
+    index), or None
+    :return: A dict of counts for each particle type
+    """
+    if metrics is None:
+        metrics = Metrics(enabled=False)
+
+    # Analyse every frame... clustering finds the same clusters as blobbing.find, wrapped up as blobs for classify
+    start = metrics.start()
+    if settings['fast_clustering']:
+        found = clustering.find(frame)
+        clusters = [blobbing.Blob(pixels) for pixels in found]
+    else:
+        clusters = blobbing.find(frame)
+        found = [blob.pixels for blob in clusters]
+    metrics.stop('clustering', start)
+
+    counts = {'alpha': 0, 'beta': 0, 'gamma': 0, 'proton': 0, 'muon': 0, 'other': 0}
+    types = []
+
+    start = metrics.start()
+    for cluster in clusters:
+        particle_type = classify(cluster)
+        counts[particle_type] += 1
+        types.append(particle_type)
+    metrics.stop('classify', start)
+
+    if table is not None:
+        table.append(clustertable.cluster_pixels(found, frame) + (len(found), particle_labels(types)))
+
+    return counts
+
+
+def count_sparse(x, y, c, settings, metrics=None, table=None):
+    """
+    Find and classify the clusters among a handful of hit pixels, and count how many there are of each particle type.
+    This gives the same counts as count_particles would for the frame, without building the frame.
+
+    :param x: The x coordinates of the hit pixels, in raster order with no repeats (see xycarray.hit_pixels)
+    :param y: The y coordinates of the hit pixels
+    :param c: The counts of the hit pixels
+    :param settings: The analysis settings
+    :param metrics: The Metrics to time the clustering and classification with, or None
+    :param table: A list to add the frame's clusters to, as arguments for clustertable.records (after the frame
+    index), or None
+    :return: A dict of counts for each particle type
+    """
+    if metrics is None:
+        metrics = Metrics(enabled=False)
+
+    start = metrics.start()
+    clusters = [blobbing.Blob(pixels) for pixels in clustering.find_pixels(x, y)]
+    metrics.stop('clustering', start)
+
+    counts = {'alpha': 0, 'beta': 0, 'gamma': 0, 'proton': 0, 'muon': 0, 'other': 0}
+    types = []
+
+    start = metrics.start()
+    for cluster in clusters:
+        particle_type = classify(cluster)
+        counts[particle_type] += 1
+        types.append(particle_type)
+    metrics.stop('classify', start)
+
+    if table is not None:
+        # find_pixels gives the clusters in label order, so label_pixels numbers them the same way
+        labels, n = clustering.label_pixels(x, y)
+        table.append((labels - 1, x, y, c, n, particle_labels(types)))
+
+    return counts
+
+
+def particle_labels(types):
+    """
+    :param types: A list of particle types, as given by classify
+    :return: An array of labels, indices into clusterfeatures.PARTICLES
+    """
+    return numpy.array([clusterfeatures.PARTICLES.index(t) for t in types], numpy.int8)
+
+
+def classifier_name():
+    """
+    :return: The name of the classifier in use, with the version of lucid_utils it comes from (see
+    resultcache.package_version)
+    """
+    global _classifier_name
+
+    if _classifier_name is None:
+        import lucid_utils
+        _classifier_name = "lucid_algorithm " + resultcache.package_version(lucid_utils)
+    return _classifier_name
+
+
+def clustering_name(settings):
+    """
+    :param settings: The analysis settings
+    :return: The name and version of the clustering in use. blobbing.find's version is part of lucid_utils'.
+    """
+    if settings['fast_clustering']:
+        return clustering.CLUSTERING_VERSION
+    return "blobbing"
+
+
+def cache_version(settings, width, height, mask=None):
+    """
+    Describe everything besides the XYC contents that changes a frame's counts, for its result cache key.
+
+    :param settings: The analysis settings
+    :param width: The width of the frame
+    :param height: The height of the frame
+    :param mask: The version of the hot pixel mask applied to the frame (see HotPixelMask.version), or None
+    :return: A version string
+    """
+    version = "%s %s %dx%d" % (classifier_name(), clustering_name(settings), width, height)
+    if mask is not None:
+        version += " hot pixels " + mask
+    return version
+
+
+def frame_row(file, dsc, counts):
+    """
+    Build a frame's row for the CSV file.
+
+    :param file: The name of the frame
+    :param dsc: The DscFile for the frame, or None if it doesn't have one
+    :param counts: A dict of counts for each particle type
+    :return: A list of values making up the frame's row in the CSV file
+    """
+    if dsc is not None:
+        return [file, dsc.getStartTime(), dsc.getChipId(), dsc.getBiasVoltage(), dsc.getAcqTime(),
+                counts['alpha'], counts['beta'], counts['gamma'], counts['proton'], counts['muon'], counts['other']]
+    else:
+        return [file, "", "", "", "", counts['alpha'], counts['beta'], counts['gamma'], counts['proton'],
+                counts['muon'], counts['other']]
+
+
+class ChunkAnalysis(object):
+    """
+    Analyses a chunk of frames inside a worker process. As well as the CSV rows, it keeps track of everything else
+    the main process needs back: counters for the end of run report, and results to add to the cache.
+    """
+
+    def __init__(self, settings):
+        """
+        :param settings: The analysis settings
+        """
+        self.settings = settings
+        self.rows = []
+        self.stats = {}
+        # New (key, counts) results for the cache, and the keys of results we found there
+        self.cached = []
+        self.hits = []
+
+        self.cache = None
+        if settings['cache'] is not None:
+            self.cache = resultcache.ResultCache(settings['cache'], settings['cache_size'])
+
+        self.metrics = Metrics(settings['metrics'])
+
+        self.hot_pixels = None
+        if settings['hot_pixels'] is not None:
+            self.hot_pixels = hotpixels.load(settings['hot_pixels'])
+
+        # The clusters of the frame being analysed (see count_particles), and the cluster table rows of the chunk
+        self.table = None
+        self.clusters = []
+        if settings['clusters'] is not None:
+            self.table = []
+
+    def count(self, stat, n=1):
+        """
+        Add to one of the counters for the end of run report.
+
+        :param stat: The name of the counter
+        :param n: How much to add
+        """
+        self.stats[stat] = self.stats.get(stat, 0) + n
+
+    def read_dsc(self, dscfilename, content=None):
+        """
+        Parse a frame's DSC file.
+
+        :param dscfilename: The path of the DSC file
+        :param content: The text of the DSC file, if it has already been read
+        :return: The DscFile, or None if the file is missing or invalid
+        """
+        start = self.metrics.start()
+        try:
+            return dscreader.DscFile(dscfilename, content, lazy=True)
+        except IOError:
+            return None
+        finally:
+            self.metrics.stop('dsc_parse', start)
+
+    def analyse(self, file, data, dsc):
+        """
+        Analyse a single frame, using the cached counts if we've seen it before.
+
+        Empty frames are spotted before any parsing and given a row of zeros straight away. Frames with so few lines
+        that they can only have a handful of hit pixels are parsed and go down the sparse path (see analyse_sparse).
+
+        :param file: The name of the frame
+        :param data: The contents of the XYC file, as bytes
+        :param dsc: The DscFile for the frame, or None if it doesn't have one
+        """
+        width, height = frame_size(dsc)
+
+        if not data.strip():
+            self.count('empty_frames')
+            self.add(file, dsc, EMPTY_COUNTS)
+            return
+
+        pixels = None
+
+        # Counting lines is much quicker than parsing them, and there's at most one pixel per line. Hot pixels can
+        # only be masked once the frame's been parsed, but then it might well turn out to be sparse.
+        if self.hot_pixels is not None or data.count(b"\n") < SPARSE_MAX_PIXELS:
+            start = self.metrics.start()
+            pixels = xycarray.parse(data)
+            self.metrics.stop('read', start)
+
+            pixels = self.mask(pixels, dsc)
+
+            if self.analyse_sparse(file, pixels, dsc):
+                return
+
+        key, counts = self.lookup(data, width, height, dsc)
+
+        if counts is None:
+            start = self.metrics.start()
+            if pixels is None:
+                pixels = xycarray.parse(data)
+            frame = xycarray.to_frame(pixels[0], pixels[1], pixels[2], width, height)
+            self.metrics.stop('read', start)
+
+            counts = count_particles(frame, self.settings, self.metrics, self.table)
+            self.count('full_frames')
+            if key is not None:
+                self.cached.append((key, counts))
+
+        self.add(file, dsc, counts)
+
+    def analyse_pixels(self, file, x, y, c, dsc):
+        """
+        Analyse a single frame that has already been read into arrays of hit pixels (eg from a pack file), using the
+        cached counts if we've seen it before. The cache is keyed on the pixel arrays rather than the XYC text.
+
+        :param file: The name of the frame
+        :param x: The x coordinates of the hit pixels
+        :param y: The y coordinates of the hit pixels
+        :param c: The counts of the hit pixels
+        :param dsc: The DscFile (or framepack.PackedDsc) for the frame, or None if it doesn't have one
+        """
+        width, height = frame_size(dsc)
+
+        if len(x) == 0:
+            self.count('empty_frames')
+            self.add(file, dsc, EMPTY_COUNTS)
+            return
+
+        data = None
+        if self.cache is not None:
+            data = b"".join(numpy.ascontiguousarray(a).tobytes() for a in (x, y, c))
+
+        x, y, c = self.mask((x, y, c), dsc)
+
+        if self.analyse_sparse(file, (x, y, c), dsc):
+            return
+
+        key, counts = self.lookup(data, width, height, dsc)
+
+        if counts is None:
+            start = self.metrics.start()
+            frame = xycarray.to_frame(x, y, c, width, height)
+            self.metrics.stop('read', start)
+
+            counts = count_particles(frame, self.settings, self.metrics, self.table)
+            self.count('full_frames')
+            if key is not None:
+                self.cached.append((key, counts))
+
+        self.add(file, dsc, counts)
+
+    def analyse_sparse(self, file, pixels, dsc):
+        """
+        Analyse a frame with only a handful of hit pixels without building the full frame, if it has few enough. These
+        are cheap enough that the cache isn't used for them.
+
+        :param file: The name of the frame
+        :param pixels: A tuple of the (x, y, C) arrays of the frame's pixels
+        :param dsc: The DscFile for the frame, or None if it doesn't have one
+        :return: Whether the frame was analysed. If not, it needs to go down the full path.
+        """
+        x, y, c = pixels
+        if len(x) > SPARSE_MAX_PIXELS:
+            return False
+
+        if not self.settings['fast_clustering']:
+            # blobbing.find needs a whole frame to look through
+            return False
+
+        width, height = frame_size(dsc)
+        if len(x) > 0 and (x.max() >= width or y.max() >= height):
+            # Leave pixels outside the frame for the full path to complain about
+            return False
+
+        x, y, c = xycarray.hit_pixels(x, y, c)
 
+        if len(x) == 0:
+            self.count('empty_frames')
+            self.add(file, dsc, EMPTY_COUNTS)
+        else:
+            self.count('sparse_frames')
+            self.add(file, dsc, count_sparse(x, y, c, self.settings, self.metrics, self.table))
+
+        return True
+
+    def mask(self, pixels, dsc):
+        """
+        Drop the hot pixels of the frame's chip from its pixels, if there's a hot pixel mask.
+
+        :param pixels: A tuple of the (x, y, C) arrays of the frame's pixels
+        :param dsc: The DscFile for the frame, or None if it doesn't have one
+        :return: A tuple of (x, y, C) arrays without the hot pixels
+        """
+        if self.hot_pixels is None:
+            return pixels
+
+        start = self.metrics.start()
+        masked = self.hot_pixels.apply(hotpixels.chip_of(dsc), *pixels)
+        self.metrics.stop('mask', start)
+
+        if len(masked[0]) != len(pixels[0]):
+            self.count('hot_pixel_hits', len(pixels[0]) - len(masked[0]))
+        return masked
+
+    def lookup(self, data, width, height, dsc=None):
+        """
+        Look a frame up in the cache.
+
+        :param data: The frame's contents, as bytes
+        :param width: The width of the frame
+        :param height: The height of the frame
+        :param dsc: The DscFile for the frame (to find its hot pixel mask), or None if it doesn't have one
+        :return: A tuple of (the frame's cache key, its counts), where the counts are None if the frame isn't in the
+        cache and both are None if there's no cache
+        """
+        if self.cache is None:
+            return None, None
+
+        mask = None
+        if self.hot_pixels is not None:
+            mask = self.hot_pixels.version(hotpixels.chip_of(dsc))
+
+        start = self.metrics.start()
+        key = resultcache.make_key(data, cache_version(self.settings, width, height, mask))
+        counts = self.cache.get(key)
+        self.metrics.stop('cache', start)
+
+        if counts is not None:
+            self.hits.append(key)
+            self.count('cache_hits')
+        else:
+            self.count('cache_misses')
+
+        return key, counts
+
+    def add(self, file, dsc, counts):
+        """
+        Add an analysed frame's row.
+
+        :param file: The name of the frame
+        :param dsc: The DscFile for the frame, or None if it doesn't have one
+        :param counts: A dict of counts for each particle type
+        """
+        if self.table:
+            for entry in self.table:
+                self.clusters.append(clustertable.records(len(self.rows), *entry))
+            del self.table[:]
+
+        self.rows.append(frame_row(file, dsc, counts))
+        self.metrics.end_frame(file, sum(counts.values()))
+
+    def result(self):
+        """
+        Finish the chunk.
+
+        :return: A dict of everything the main process needs back: rows, stats, cached, hits, metrics and clusters
+        """
+        if self.cache is not None:
+            self.cache.close()
+
+        clusters = None
+        if self.table is not None:
+            clusters = numpy.concatenate(self.clusters + [numpy.empty(0, clustertable.CLUSTER_DTYPE)])
+
+        return {'rows': self.rows, 'stats': self.stats, 'cached': self.cached, 'hits': self.hits,
+                'metrics': self.metrics.to_dict(), 'clusters': clusters}
+
+
+def analyse_frame(folder, file, chunk):
+    """
+    Analyse a single XYC frame (and its DSC file, if there is one) from a folder.
+
+    :param folder: The folder containing the frame
+    :param file: The file name of the frame
+    :param chunk: The ChunkAnalysis the frame is part of
+    """
+    chunk.metrics.begin_frame()
+
+    dsc = chunk.read_dsc(folder + "/" + file + ".dsc")
+
+    start = chunk.metrics.start()
+    data = read_xyc(folder + "/" + file)
+    chunk.metrics.stop('io', start)
+
+    chunk.analyse(file, data, dsc)
+
+
+def read_xyc(path):
+    """
+    :param path: The path of an XYC file
+    :return: The contents of the file, as bytes
+    """
+    if os.path.getsize(path) == 0:
+        # Empty frames don't even need opening
+        return b""
+
+    f = open(path, "rb")
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+def read_frame(folder, file):
+    """
+    Read a frame and parse its DSC file, ready to be analysed. This is what the prefetcher runs.
+
+    :param folder: The folder containing the frame
+    :param file: The file name of the frame
+    :return: A tuple of (file name, contents of the XYC file, DscFile or None)
+    """
+    try:
+        dsc = dscreader.DscFile(folder + "/" + file + ".dsc", lazy=True)
+    except IOError:
+        dsc = None
+    return file, read_xyc(folder + "/" + file), dsc
+
+
+def analyse_prefetched(read, items, chunk):
+    """
+    Analyse frames while the next ones are read in a background thread (see prefetch). The time spent waiting for
+    a frame to be read is counted as 'io', so it shows how much of the reading wasn't hidden.
+
+    :param read: A function taking an item and returning a (file name, XYC contents, DscFile or None) tuple
+    :param items: The items to read, in order
+    :param chunk: The ChunkAnalysis the frames are part of
+    """
+    frames = prefetch.Prefetcher(read, items, chunk.settings['prefetch'])
+    try:
+        for i in range(len(items)):
+            chunk.metrics.begin_frame()
+
+            start = chunk.metrics.start()
+            file, data, dsc = frames.get()
+            chunk.metrics.stop('io', start)
+
+            chunk.analyse(file, data, dsc)
+    finally:
+        frames.close()
+
+
+def analyse_chunk(args):
+    """
+    Analyse a chunk of frames. This is what runs inside each worker process, so it takes a single tuple to keep
+    Pool.imap happy.
+
+    :param args: A tuple of (folder, list of file names, settings)
+    :return: The chunk's result, see ChunkAnalysis.result. The rows are in the same order as the file names.
+    """
+    folder, files, settings = args
+    chunk = ChunkAnalysis(settings)
+    if settings['prefetch'] > 0:
+        analyse_prefetched(lambda file: read_frame(folder, file), files, chunk)
+    else:
+        for file in files:
+            analyse_frame(folder, file, chunk)
+    return chunk.result()
+
+
+def write_header(output):
+    """
+    Write the header row of the CSV file, unless we're appending to a file that already has one.
+
+    :param output: The file to write the CSV rows to
+    """
+    if output.tell() == 0:
+        csv.writer(output).writerow(CSV_HEADER)
+
+
+def list_frames(folder):
+    """
+    Get the names of the XYC frames in a folder, sorted so every run sees them in the same order.
+
+    :param folder: The folder containing the files to be analysed
+    :return: A sorted list of frame file names
+    """
     files = []
 
     for f in os.listdir(folder):
@@ -62,48 +662,501 @@ def analyse_folder(folder):
         if not f.endswith(".dsc"):
             files.append(f)
 
-    for file in files:
-        frame = xycreader.read(folder + "/" + file)
+    files.sort()
+    return files
+
+
+def collect_chunk(result, writer, output, cache, stats, checkpoint, metrics, clusters=None):
+    """
+    Take in the result of a chunk in the main process: write its rows (and checkpoint them), store its new results
+    in the cache, stream its clusters to the cluster table and add up its counters.
+
+    :param result: The result of the chunk, see ChunkAnalysis.result
+    :param writer: The CSV writer for the output file
+    :param output: The file to write the CSV rows to
+    :param cache: The ResultCache, or None
+    :param stats: The dict of counters for the whole run
+    :param checkpoint: The Checkpoint to record finished frames in, or None
+    :param metrics: The Metrics for the whole run
+    :param clusters: The clustertable.ClusterWriter, or None
+    """
+    start = metrics.start()
+    writer.writerows(result['rows'])
+
+    if checkpoint is not None:
+        checkpoint.record(output, [row[0] for row in result['rows']])
+    else:
+        output.flush()
+    metrics.stop('csv_write', start)
+
+    if metrics.enabled:
+        metrics.merge(result['metrics'])
+
+    if cache is not None:
+        cache.put_many(result['cached'])
+        cache.touch(result['hits'])
+
+    if clusters is not None:
+        clusters.add([row[0] for row in result['rows']], result['clusters'])
+
+    for stat, n in result['stats'].items():
+        stats[stat] = stats.get(stat, 0) + n
+
+
+def analyse_chunks(output, analyse, chunks, workers, settings, checkpoint=None):
+    """
+    Run an analysis function over chunks of frames and stream the rows it gives back to the CSV file. If more than
+    one worker is asked for, the chunks are analysed in a pool of processes.
+
+    The file is flushed after each chunk, so at most CHUNK_SIZE rows are held in memory and a job killed part way
+    through still leaves the rows it had finished.
+
+    :param output: The file to write the CSV rows to
+    :param analyse: A module level function taking a chunk and returning its result (see ChunkAnalysis.result)
+    :param chunks: The chunks to be analysed
+    :param workers: The number of processes to analyse frames with
+    :param settings: The analysis settings
+    :param checkpoint: The Checkpoint to record finished frames in, or None
+    :return: A dict of counters for the whole run, along with the run's Metrics under 'metrics'
+    """
+    writer = csv.writer(output)
+    stats = {}
+    metrics = Metrics(settings['metrics'])
 
+    # Only the main process writes to the cache. Opening it here also makes sure it exists before any worker reads it.
+    cache = None
+    if settings['cache'] is not None:
+        cache = resultcache.ResultCache(settings['cache'], settings['cache_size'])
+
+    clusters = None
+    if settings['clusters'] is not None:
+        clusters = clustertable.ClusterWriter(settings['clusters'])
+
+    try:
+        if workers > 1 and len(chunks) > 1:
+            pool = multiprocessing.Pool(min(workers, len(chunks)))
+            try:
+                # imap hands back the results in the order the chunks went in, so the CSV is deterministic
+                for result in pool.imap(analyse, chunks):
+                    collect_chunk(result, writer, output, cache, stats, checkpoint, metrics, clusters)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for chunk in chunks:
+                # Write the output of our analysis to the CSV file
+                collect_chunk(analyse(chunk), writer, output, cache, stats, checkpoint, metrics, clusters)
+
+        if cache is not None:
+            stats['cache_evicted'] = cache.evict()
+
+        if clusters is not None:
+            stats['clusters'] = clusters.close(classifier_name())
+    finally:
+        if cache is not None:
+            cache.close()
+
+        # Don't leave a half written cluster table behind if the run failed
+        if clusters is not None:
+            clusters.abort()
+
+    stats['metrics'] = metrics
+    return stats
+
+
+def analyse_folder(folder, output, workers=1, settings=None, checkpoint=None, frames=None):
+    """
+    Analyse a folder of XYC formatted files from a Timepix radiation detector, streaming the output to a CSV file.
+
+    If more than one worker is asked for, the frames are split into chunks of CHUNK_SIZE and analysed in a pool of
+    processes. The rows are always written in the same (sorted) frame order, however many workers are used.
+
+    :param folder: The folder containg the files to be analysed
+    :param output: The file to write the CSV rows to
+    :param workers: The number of processes to analyse frames with
+    :param settings: A dict of analysis settings, overriding DEFAULT_SETTINGS
+    :param checkpoint: A Checkpoint to record finished frames in, or None. Frames it already has are skipped.
+    :param frames: The frames to analyse, as given by dscindex.filter_frames for the archives extracted into the
+    folder, or None for all of them
+    :return: A dict of counters for the run, eg cache hits and misses
+    """
+    settings = make_settings(settings)
+
+    write_header(output)
+
+    files = list_frames(folder)
+
+    if frames is not None:
+        # Every archive is extracted into the same folder, so their member names all refer to it
+        wanted = set()
+        for members in frames.values():
+            wanted.update(members)
+        files = [f for f in files if f in wanted]
+
+    if checkpoint is not None:
+        files = [f for f in files if f not in checkpoint.done]
+
+    chunks = [(folder, files[i:i + CHUNK_SIZE], settings) for i in range(0, len(files), CHUNK_SIZE)]
+
+    return analyse_chunks(output, analyse_chunk, chunks, workers, settings, checkpoint)
+
+
+def analyse_member(archive, member, chunk):
+    """
+    Analyse a single frame straight out of a ZIP archive.
+
+    :param archive: An open ZipFile
+    :param member: A (frame name, XYC member name, DSC member name or None) tuple from list_members
+    :param chunk: The ChunkAnalysis the frame is part of
+    """
+    file, xyc_name, dsc_name = member
+
+    chunk.metrics.begin_frame()
+
+    dsc = None
+    if dsc_name is not None:
+        start = chunk.metrics.start()
+        content = archive.read(dsc_name).decode("latin-1")
+        chunk.metrics.stop('io', start)
+
+        dsc = chunk.read_dsc(dsc_name, content)
+
+    start = chunk.metrics.start()
+    data = archive.read(xyc_name)
+    chunk.metrics.stop('io', start)
+
+    chunk.analyse(file, data, dsc)
+
+
+def read_member(archive, member):
+    """
+    Read a frame out of a ZIP archive and parse its DSC file, ready to be analysed. This is what the prefetcher runs.
+
+    :param archive: An open ZipFile, only used by this thread
+    :param member: A (frame name, XYC member name, DSC member name or None) tuple from list_members
+    :return: A tuple of (frame name, contents of the XYC file, DscFile or None)
+    """
+    file, xyc_name, dsc_name = member
+
+    dsc = None
+    if dsc_name is not None:
         try:
-            dsc = dscreader.DscFile(folder + "/" + file + ".dsc")
+            dsc = dscreader.DscFile(dsc_name, archive.read(dsc_name).decode("latin-1"), lazy=True)
         except IOError:
             dsc = None
-        # Analyse every frame...
-        clusters = blobbing.find(frame)
 
-        counts = {'alpha': 0, 'beta': 0, 'gamma': 0, 'proton': 0, 'muon': 0, 'other': 0}
+    return file, archive.read(xyc_name), dsc
 
-        for cluster in clusters:
-            particle_type = classify(cluster)
-            counts[particle_type] += 1
 
-        # Write the output of our analysis to the CSV file (well... the CSV file which is actually a bytes object)
-        if dsc is not None:
-            writer.writerow([file, dsc.getStartTime(), dsc.getChipId(), dsc.getBiasVoltage(), dsc.getAcqTime(),
-                            counts['alpha'], counts['beta'], counts['gamma'], counts['proton'], counts['muon'],
-                            counts['other']])
+def analyse_archive_chunk(args):
+    """
+    Analyse a chunk of frames from a ZIP archive. Each worker process opens the archive for itself, as an open
+    ZipFile can't be shared between processes.
+
+    :param args: A tuple of (path to the ZIP file, list of members from list_members, settings)
+    :return: The chunk's result, see ChunkAnalysis.result. The rows are in the same order as the members.
+    """
+    user_zip, members, settings = args
+    chunk = ChunkAnalysis(settings)
+    archive = zipfile.ZipFile(user_zip, 'r')
+    try:
+        if settings['prefetch'] > 0:
+            analyse_prefetched(lambda member: read_member(archive, member), members, chunk)
         else:
-            writer.writerow([file, "", "", "", "", counts['alpha'], counts['beta'], counts['gamma'],
-                            counts['proton'], counts['muon'], counts['other']])
+            for member in members:
+                analyse_member(archive, member, chunk)
+    finally:
+        archive.close()
+    return chunk.result()
+
+
+def analyse_archive(user_zip, output, workers=1, settings=None, checkpoint=None, frames=None):
+    """
+    Analyse the XYC files in a ZIP archive without extracting it to disk first. Each frame and its DSC file are read
+    straight from the archive into memory.
+
+    :param user_zip: The path to the ZIP file
+    :param output: The file to write the CSV rows to
+    :param workers: The number of processes to analyse frames with
+    :param settings: A dict of analysis settings, overriding DEFAULT_SETTINGS
+    :param checkpoint: A Checkpoint to record finished frames in, or None. Frames it already has are skipped.
+    :param frames: The frames to analyse, as given by dscindex.filter_frames, or None for all of them
+    :return: A dict of counters for the run, eg cache hits and misses
+    """
+    return analyse_archives([user_zip], output, workers, settings, checkpoint, frames)
+
+
+def analyse_archives(user_zips, output, workers=1, settings=None, checkpoint=None, frames=None):
+    """
+    Analyse the XYC files in several ZIP archives (eg the bundles of a dataset, see bundlestore) one after the other,
+    into a single CSV file.
+
+    :param user_zips: The paths to the ZIP files
+    :param output: The file to write the CSV rows to
+    :param workers: The number of processes to analyse frames with
+    :param settings: A dict of analysis settings, overriding DEFAULT_SETTINGS
+    :param checkpoint: A Checkpoint to record finished frames in, or None. Frames it already has are skipped.
+    :param frames: The frames to analyse, as given by dscindex.filter_frames: a dict of {ZIP file path: set of XYC
+    member names}, or None for all of them
+    :return: A dict of counters for the run, eg cache hits and misses
+    """
+    settings = make_settings(settings)
+
+    write_header(output)
+
+    chunks = []
+
+    for user_zip in user_zips:
+        archive = zipfile.ZipFile(user_zip, 'r')
+        try:
+            members = list_members(archive)
+        finally:
+            archive.close()
+
+        if frames is not None:
+            wanted = frames.get(user_zip, set())
+            members = [m for m in members if m[1] in wanted]
+
+        if checkpoint is not None:
+            members = [m for m in members if m[0] not in checkpoint.done]
+
+        chunks.extend((user_zip, members[i:i + CHUNK_SIZE], settings) for i in range(0, len(members), CHUNK_SIZE))
+
+    return analyse_chunks(output, analyse_archive_chunk, chunks, workers, settings, checkpoint)
+
+
+def analyse_pack_chunk(args):
+    """
+    Analyse a chunk of frames from a pack file. The pack is memory mapped, so each worker process can open it for
+    itself without reading it all in.
+
+    :param args: A tuple of (path to the pack file, list of frame positions, analysis settings)
+    :return: The chunk's result, see ChunkAnalysis.result. The rows are in the same order as the positions.
+    """
+    path, indices, settings = args
+    chunk = ChunkAnalysis(settings)
+    pack = framepack.FramePack(path)
+
+    for i in indices:
+        chunk.metrics.begin_frame()
+
+        start = chunk.metrics.start()
+        x, y, c = pack.frame_pixels(i)
+        dsc = pack.dsc(i)
+        chunk.metrics.stop('io', start)
+
+        chunk.analyse_pixels(pack.name(i), x, y, c, dsc)
+
+    return chunk.result()
+
+
+def analyse_packs(paths, output, workers=1, settings=None, checkpoint=None):
+    """
+    Analyse the frames in one or more pack files (see framepack) one after the other, into a single CSV file. No text
+    is parsed at all: the pixels and DSC values are read straight from the packs.
+
+    :param paths: The paths to the pack files
+    :param output: The file to write the CSV rows to
+    :param workers: The number of processes to analyse frames with
+    :param settings: A dict of analysis settings, overriding DEFAULT_SETTINGS
+    :param checkpoint: A Checkpoint to record finished frames in, or None. Frames it already has are skipped.
+    :return: A dict of counters for the run, eg cache hits and misses
+    """
+    settings = make_settings(settings)
+
+    write_header(output)
+
+    chunks = []
+
+    for path in paths:
+        names = framepack.FramePack(path).names
+        indices = list(range(len(names)))
 
-    return output
+        if checkpoint is not None:
+            indices = [i for i in indices if names[i] not in checkpoint.done]
+
+        chunks.extend((path, indices[i:i + CHUNK_SIZE], settings) for i in range(0, len(indices), CHUNK_SIZE))
+
+    return analyse_chunks(output, analyse_pack_chunk, chunks, workers, settings, checkpoint)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='GridPP Analysis Script for Timepix data in the XYC format')
 
-    parser.add_argument('user_zip', metavar='user_zip', type=str,
-                   help='a path to the folder containing files to be analysed.')
+    parser.add_argument('user_zip', metavar='user_zip', type=str, nargs='+',
+                   help='a path to the folder containing files to be analysed. Several ZIP files (eg the bundles of '
+                        'a dataset) are analysed one after the other into the same CSV file. Pack files made by '
+                        'framepack.py can be given instead of ZIP files.')
+
+    parser.add_argument('--workers', '-w', metavar='N', type=int, default=multiprocessing.cpu_count(),
+                        help='the number of processes to analyse frames with (default: all available cores).')
+
+    parser.add_argument('--extract', action='store_true',
+                        help='extract the ZIP file to disk before analysing it, rather than reading it in memory.')
+
+    parser.add_argument('--cache', metavar='cache_file', type=str, default=None,
+                        help='a result cache file; frames already in it are not analysed again, and new results are '
+                             'added to it.')
+
+    parser.add_argument('--cache-size', metavar='N', type=int, default=resultcache.DEFAULT_MAX_ENTRIES,
+                        help='the most frames to keep in the result cache before evicting the least recently used.')
+
+    parser.add_argument('--resume', action='store_true',
+                        help='carry on from the last checkpoint of an interrupted run, skipping the frames it '
+                             'finished and appending to its CSV file.')
+
+    parser.add_argument('--columnar', choices=columnar.FORMATS, default=None,
+                        help='also write the results as a typed, compressed columnar file (.npz, or .parquet if '
+                             'pyarrow is installed).')
+
+    parser.add_argument('--no-csv', action='store_true',
+                        help='only keep the columnar file. The CSV file is still written while analysing (for '
+                             'checkpoints), then removed.')
+
+    parser.add_argument('--filter', metavar='expression', type=str, default=None,
+                        help='only analyse the frames whose DSC values match this expression, eg "chip_id = '
+                             '\'B06-W0212\' and bias_voltage >= 20" (see dscindex).')
+
+    parser.add_argument('--index', metavar='index_file', type=str, default=dscindex.DEFAULT_INDEX,
+                        help='the DSC metadata index to use with --filter (default: %s).' % dscindex.DEFAULT_INDEX)
+
+    parser.add_argument('--rates', metavar='seconds', type=float, default=None,
+                        help='also write per-chip particle rates in time bins of this many seconds to ' +
+                             rates.RATES_CSV + '.')
+
+    parser.add_argument('--hot-pixels', metavar='mask_file', type=str, nargs='?', default=None,
+                        const=hotpixels.HOT_PIXELS_FILE,
+                        help='mask out hot pixels before clustering, using the mask in mask_file (default: %s). If '
+                             'there isn\'t one yet, it\'s built with a pre-pass over the dataset and saved there for '
+                             'later runs.' % hotpixels.HOT_PIXELS_FILE)
+
+    parser.add_argument('--hot-pixel-threshold', metavar='fraction', type=float,
+                        default=hotpixels.DEFAULT_THRESHOLD,
+                        help='when building a hot pixel mask, pixels hit in more than this fraction of their chip\'s '
+                             'frames are hot (default: %s).' % hotpixels.DEFAULT_THRESHOLD)
+
+    parser.add_argument('--prefetch', metavar='N', type=int, default=0,
+                        help='read up to N frames ahead in a background thread while analysing, to hide slow '
+                             'storage (default: 0, off). Has no effect on pack files, which are memory mapped.')
+
+    parser.add_argument('--clusters', metavar='clusters_file', type=str, nargs='?', default=None,
+                        const=clustertable.CLUSTERS_FILE,
+                        help='also save every cluster, with its features and label, to a table in clusters_file '
+                             '(default: %s) so it can be studied or classified again without the frames (see '
+                             'clustertable.py).' % clustertable.CLUSTERS_FILE)
+
+    parser.add_argument('--metrics', action='store_true',
+                        help='time each stage of the analysis and write the timings, slowest frames and peak memory '
+                             'use to ' + METRICS_JSON + '.')
 
     args = parser.parse_args()
 
-    decompress(args.user_zip)
+    started = time.time()
+
+    if args.no_csv and args.columnar is None:
+        parser.error("--no-csv needs --columnar, or there would be no output at all")
+    if args.columnar is not None and not columnar.available(args.columnar):
+        parser.error("--columnar parquet needs pyarrow, which isn't installed")
+
+    packed = [framepack.is_pack(path) for path in args.user_zip]
+    if any(packed) and not all(packed):
+        parser.error("pack files and ZIP files can't be analysed together")
+    if all(packed) and args.extract:
+        parser.error("--extract only works with ZIP files")
+    if all(packed) and args.filter is not None:
+        parser.error("--filter only works with ZIP files; filter the archive before packing it")
+    if args.clusters is not None and (args.cache is not None or args.resume):
+        parser.error("--clusters needs every frame clustered in this run, so it can't be used with --cache or --resume")
+
+    frames = None
+    if args.filter is not None:
+        try:
+            frames = dscindex.filter_frames(args.user_zip, args.filter, args.index)
+        except ValueError as e:
+            parser.error(str(e))
+        print("Filter: %d frames match" % sum(len(members) for members in frames.values()))
+
+    # clustering.find is much quicker than blobbing.find, but only if it gives the same clusters in the same format
+    fast_clustering = clustering.matches_blobbing()
+    if not fast_clustering:
+        print("Clustering: this version of blobbing.find doesn't match clustering.find (see "
+              "clustering.matches_blobbing), so using blobbing.find")
+
+    settings = {'fast_clustering': fast_clustering, 'cache': args.cache, 'cache_size': args.cache_size,
+                'metrics': args.metrics, 'hot_pixels': args.hot_pixels, 'prefetch': args.prefetch,
+                'clusters': args.clusters}
+
+    prepass_time = None
+    if args.hot_pixels is not None:
+        if os.path.exists(args.hot_pixels):
+            mask = hotpixels.load(args.hot_pixels)
+        else:
+            prepass_start = time.time()
+            mask = hotpixels.build(args.user_zip, args.hot_pixel_threshold, args.workers)
+            mask.save(args.hot_pixels)
+            prepass_time = time.time() - prepass_start
+        print("Hot pixels: %d across %d chips" % (mask.hot_pixels(), len(mask.masks)))
+
+    # Every chunk of finished frames is checkpointed, so an interrupted run can be resumed
+    checkpoint = Checkpoint(OUTPUT_CSV + CHECKPOINT_SUFFIX)
+
+    if args.resume:
+        checkpoint.load()
+        print("Resuming: %d frames already done" % len(checkpoint.done))
+    else:
+        checkpoint.reset()
+
+    # Rows go through a buffered file handle as they're analysed, rather than being kept in memory until the end
+    with checkpoint.open_output(OUTPUT_CSV, BUFFER_SIZE) as output:
+        if all(packed):
+            stats = analyse_packs(args.user_zip, output, args.workers, settings, checkpoint)
+        elif args.extract:
+            decompress_start = time.time()
+            for user_zip in args.user_zip:
+                decompress(user_zip)
+            decompress_time = time.time() - decompress_start
+            stats = analyse_folder('decompressed_frames', output, args.workers, settings, checkpoint, frames)
+        else:
+            stats = analyse_archives(args.user_zip, output, args.workers, settings, checkpoint, frames)
+
+    metrics = stats['metrics']
+
+    if args.extract:
+        metrics.add('decompress', decompress_time)
+
+    if prepass_time is not None:
+        metrics.add('hot_pixel_prepass', prepass_time)
+
+    if args.rates is not None:
+        start = metrics.start()
+        rates.rates_from_csv(OUTPUT_CSV, args.rates)
+        metrics.stop('rates', start)
+
+    if args.columnar is not None:
+        start = metrics.start()
+        columnar.convert(OUTPUT_CSV, args.columnar)
+        metrics.stop('columnar', start)
+
+        if args.no_csv:
+            os.remove(OUTPUT_CSV)
+            os.remove(checkpoint.path)
+
+    if args.metrics:
+        metrics.add('total', time.time() - started)
+        metrics.write(METRICS_JSON)
+
+    print("Frames: %d empty, %d sparse, %d from the cache, %d analysed in full" % (stats.get('empty_frames', 0),
+                                                                              stats.get('sparse_frames', 0),
+                                                                              stats.get('cache_hits', 0),
+                                                                              stats.get('full_frames', 0)))
+
+    if args.hot_pixels is not None:
+        print("Hot pixels: %d hits masked" % stats.get('hot_pixel_hits', 0))
 
-    output = analyse_folder('decompressed_frames')
+    if args.clusters is not None:
+        print("Clusters: %d written to %s" % (stats['clusters'], args.clusters))
 
-    with open("grid-analysis-frames.csv", "wb") as f:
-        output.seek(0)
-        # Write the binary stream to the file. We do it here instead of line by line to save writing thousands of lines
-        # to a file. Quicker to keep things in memory up until we really need to write it.
-        f.write(output.getvalue())
+    if args.cache is not None:
+        print("Result cache: %d hits, %d misses, %d evicted" % (stats.get('cache_hits', 0),
+                                                               stats.get('cache_misses', 0),
+                                                               stats.get('cache_evicted', 0)))
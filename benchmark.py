@@ -0,0 +1,564 @@
+#!/usr/bin/env python
+"""
+
+grid-analysis benchmark.py
+
+Measures how fast each stage of analyse.py runs, on a synthetic Timepix dataset, so that we can tell whether an
+update to lucid-utils (or to this code, or a site change) has made jobs slower.
+
+The dataset generator writes a ZIP of XYC frames with a tunable number of clusters per frame and mix of cluster
+shapes, each with a valid DSC file. Each stage is then run in its own process, so its peak memory can be measured on
+its own, and the frames/sec and memory use of every stage are saved as JSON so runs can be compared over time. The
+memory a stage uses is how far its process's peak RSS rose while the stage ran, above what the set up needed.
+
+"""
+# Makes it easy to convert between Python 2 and Python 3
+from __future__ import print_function
+
+import argparse
+
+import csv
+
+import json
+
+import math
+
+import multiprocessing
+
+import os
+
+import platform
+
+import random
+
+import resource
+
+import shutil
+
+import tempfile
+
+import time
+
+import zipfile
+
+DSC_TEMPLATE = """A000000001
+[F0]
+Type=i16 [X,Y,C] width=%(width)d height=%(height)d
+"Acq mode" ("Acquisition mode"):
+i32[1]
+1
+
+"Acq time" ("Acquisition time [s]"):
+double[1]
+%(acq_time)f
+
+"ChipboardID" ("Medipix or chipboard ID"):
+char[9]
+%(chip_id)s
+
+"DACs" ("DACs values of all chips"):
+u16[14]
+1 100 255 127 127 0 405 7 130 128 80 85 128 128
+
+"Firmware" ("Firmware version"):
+char[7]
+5.0.1
+
+"HV" ("Bias voltage [V]"):
+double[1]
+%(hv)f
+
+"Hw timer" ("Hw timer mode"):
+i32[1]
+1
+
+"Interface" ("Medipix interface"):
+char[8]
+USB 1.0
+
+"Mpx clock" ("Medipix clock [MHz]"):
+double[1]
+10
+
+"Mpx type" ("Medipix type (1-2.1, 2-MXR, 3-TPX)"):
+i32[1]
+3
+
+"Pixelman version" ("Pixelman version"):
+char[5]
+2.2.2
+
+"Polarity" ("Detector polarity (0 negative, 1 positive)"):
+i32[1]
+1
+
+"Start time" ("Acquisition start time"):
+double[1]
+%(start_time)f
+
+"Timepix clock" ("Timepix clock (0-3: 10MHz, 20MHz, 40MHz, 80MHz)"):
+byte[1]
+0
+
+"Name+SN" ("Name and serial number"):
+char[13]
+MX-10 A01-W0001
+"""
+
+# The shapes of cluster the generator can make, and what they look like to the classifier
+CLUSTER_SHAPES = ['dot', 'blob', 'track', 'curly']
+
+DEFAULT_MIX = {'dot': 0.6, 'blob': 0.1, 'track': 0.1, 'curly': 0.2}
+
+STAGES = ['decompress', 'dsc_parse', 'read', 'blobbing', 'clustering', 'tiled_clustering', 'classify', 'csv_write']
+
+"""
+Synthetic dataset generation.
+"""
+
+
+def make_cluster(shape, width, height, rng):
+    """
+    Make the pixels of a single cluster.
+
+    :param shape: One of CLUSTER_SHAPES
+    :param width: The width of the frame
+    :param height: The height of the frame
+    :param rng: The random.Random to use
+    :return: A dict of counts keyed by (x, y)
+    """
+    x = rng.randrange(width)
+    y = rng.randrange(height)
+    pixels = {}
+
+    if shape == 'dot':
+        for i in range(rng.randint(1, 4)):
+            pixels[(x + i % 2, y + i // 2)] = rng.randint(10, 200)
+    elif shape == 'blob':
+        r = rng.uniform(2, 5)
+        for dx in range(-int(r), int(r) + 1):
+            for dy in range(-int(r), int(r) + 1):
+                if dx * dx + dy * dy <= r * r:
+                    pixels[(x + dx, y + dy)] = rng.randint(200, 2000)
+    elif shape == 'track':
+        angle = rng.uniform(0, math.pi)
+        for i in range(rng.randint(15, 80)):
+            pixels[(int(x + i * math.cos(angle)), int(y + i * math.sin(angle)))] = rng.randint(20, 100)
+    else:
+        for i in range(rng.randint(8, 60)):
+            pixels[(x, y)] = rng.randint(20, 150)
+            x += rng.choice([-1, 0, 1])
+            y += rng.choice([-1, 0, 1])
+
+    return dict((p, c) for p, c in pixels.items() if 0 <= p[0] < width and 0 <= p[1] < height)
+
+
+def make_frame(occupancy, mix, width, height, rng):
+    """
+    Make the contents of a single XYC file.
+
+    :param occupancy: The mean number of clusters per frame
+    :param mix: A dict of weights for each of CLUSTER_SHAPES
+    :param width: The width of the frame
+    :param height: The height of the frame
+    :param rng: The random.Random to use
+    :return: The XYC file contents
+    """
+    shapes = [s for s in CLUSTER_SHAPES if mix.get(s, 0) > 0]
+    weights = [mix[s] for s in shapes]
+    total = float(sum(weights))
+
+    # Poisson number of clusters, by counting exponential gaps
+    n = 0
+    t = rng.expovariate(1.0)
+    while t < occupancy:
+        n += 1
+        t += rng.expovariate(1.0)
+
+    pixels = {}
+    for i in range(n):
+        pick = rng.uniform(0, total)
+        for shape, weight in zip(shapes, weights):
+            pick -= weight
+            if pick <= 0:
+                break
+        pixels.update(make_cluster(shape, width, height, rng))
+
+    return "".join("%d\t%d\t%d\n" % (p[0], p[1], c) for p, c in sorted(pixels.items()))
+
+
+def generate(path, frames, occupancy=10.0, mix=None, width=256, height=256, seed=0):
+    """
+    Generate a synthetic dataset: a ZIP of XYC frames, each with a valid DSC file.
+
+    :param path: The path of the ZIP file to write
+    :param frames: The number of frames
+    :param occupancy: The mean number of clusters per frame
+    :param mix: A dict of weights for each of CLUSTER_SHAPES (defaults to DEFAULT_MIX)
+    :param width: The width of the frames
+    :param height: The height of the frames
+    :param seed: The random seed, so the same dataset can be made again
+    """
+    if mix is None:
+        mix = DEFAULT_MIX
+
+    rng = random.Random(seed)
+    archive = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+
+    try:
+        for i in range(frames):
+            name = "frame_%06d.txt" % i
+            archive.writestr(name, make_frame(occupancy, mix, width, height, rng))
+            archive.writestr(name + ".dsc", DSC_TEMPLATE % {
+                'width': width, 'height': height, 'acq_time': 1.0, 'chip_id': "A01-W0001", 'hv': 20.0,
+                'start_time': 1487400000.0 + i})
+    finally:
+        archive.close()
+
+
+"""
+The stages of analyse.py. Each one takes the path to the archive, a scratch folder and a dict of options, does any
+set up it needs (untimed), then runs its stage over every frame and gives back how long that took, and the peak RSS
+before it started. The set up only holds the archive's raw contents in memory; frames are laid out one at a time as
+they're needed.
+"""
+
+
+def load_members(user_zip):
+    """ Read every frame and DSC file of an archive into memory, still as text. """
+    from framearchive import list_members
+
+    archive = zipfile.ZipFile(user_zip, 'r')
+    try:
+        return [(file, archive.read(xyc), archive.read(dsc).decode("latin-1") if dsc else None)
+                for file, xyc, dsc in list_members(archive)]
+    finally:
+        archive.close()
+
+
+def member_size(file, dsc):
+    """ Get the size of a frame from its DSC file, or the standard 256x256 if it doesn't have a valid one. """
+    import dscreader
+
+    import xycarray
+
+    if dsc is not None:
+        try:
+            parsed = dscreader.DscFile(file + ".dsc", dsc, lazy=True)
+            return parsed.getFrameWidth(), parsed.getFrameHeight()
+        except IOError:
+            pass
+    return xycarray.DEFAULT_WIDTH, xycarray.DEFAULT_HEIGHT
+
+
+def member_frames(members):
+    """
+    Parse the frames of an archive one at a time, at the sizes their DSC files give. Only one frame is held at once,
+    so the memory a stage uses isn't swamped by the whole dataset laid out as frames.
+    """
+    import xycarray
+
+    for file, data, dsc in members:
+        width, height = member_size(file, dsc)
+        yield xycarray.parse_frame(data, width, height)
+
+
+def peak_rss_kb():
+    """ The peak RSS of this process so far (ru_maxrss is in kilobytes on Linux). """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def time_each(items, work):
+    """
+    Run work on every item, timing only work and not making the items.
+
+    :return: A tuple of (number of items, seconds spent in work, peak RSS before starting)
+    """
+    baseline = peak_rss_kb()
+    n = 0
+    seconds = 0.0
+    for item in items:
+        start = time.time()
+        work(item)
+        seconds += time.time() - start
+        n += 1
+    return n, seconds, baseline
+
+
+def stage_decompress(user_zip, workdir, options):
+    """ Extract the archive to disk. """
+    import analyse
+
+    os.chdir(workdir)
+    frames = len(load_members(user_zip))
+
+    baseline = peak_rss_kb()
+    start = time.time()
+    analyse.decompress(user_zip)
+    return frames, time.time() - start, baseline
+
+
+def stage_dsc_parse(user_zip, workdir, options):
+    """ Parse every DSC file. """
+    import dscreader
+
+    members = load_members(user_zip)
+
+    baseline = peak_rss_kb()
+    start = time.time()
+    for file, data, dsc in members:
+        dscreader.DscFile(file + ".dsc", dsc, lazy=True)
+    return len(members), time.time() - start, baseline
+
+
+def stage_read(user_zip, workdir, options):
+    """ Parse every XYC file into a frame. """
+    import xycarray
+
+    members = load_members(user_zip)
+    sized = [(data,) + member_size(file, dsc) for file, data, dsc in members]
+
+    baseline = peak_rss_kb()
+    start = time.time()
+    for data, width, height in sized:
+        xycarray.parse_frame(data, width, height)
+    return len(sized), time.time() - start, baseline
+
+
+def stage_blobbing(user_zip, workdir, options):
+    """ Find the clusters in every frame with lucid_utils' blobbing.find, the baseline clustering replaces. """
+    from lucid_utils import blobbing
+
+    return time_each(member_frames(load_members(user_zip)), blobbing.find)
+
+
+def stage_clustering(user_zip, workdir, options):
+    """ Find the clusters in every frame with clustering.find. """
+    import clustering
+
+    return time_each(member_frames(load_members(user_zip)), clustering.find)
+
+
+def stage_tiled_clustering(user_zip, workdir, options):
+    """
+    Find the clusters in every frame with clustering.find, labelled in tiles. Without a tile size, every frame is split
+    into four tiles, so the stage always tiles whatever the size of the frames.
+    """
+    import clustering
+
+    def work(frame):
+        tile_size = options['tile_size'] or max(1, (max(frame.shape) + 1) // 2)
+        clustering.find(frame, tile_size, options['tile_threads'])
+
+    return time_each(member_frames(load_members(user_zip)), work)
+
+
+def stage_classify(user_zip, workdir, options):
+    """ Find and classify the clusters in every frame, one cluster at a time. """
+    import analyse
+
+    import clustering
+
+    # Cluster the frames the same way analyse.py would
+    settings = analyse.make_settings({'fast_clustering': clustering.matches_blobbing()})
+
+    return time_each(member_frames(load_members(user_zip)), lambda frame: analyse.count_particles(frame, settings))
+
+
+def stage_csv_write(user_zip, workdir, options):
+    """ Write a row for every frame to the CSV file. """
+    import analyse
+
+    members = load_members(user_zip)
+    rows = [[file, 1487400000.0, "A01-W0001", 20.0, 1.0, 0, 1, 2, 0, 0, 3] for file, data, dsc in members]
+
+    baseline = peak_rss_kb()
+    start = time.time()
+    output = open(os.path.join(workdir, analyse.OUTPUT_CSV), "wb", analyse.BUFFER_SIZE)
+    try:
+        writer = csv.writer(output)
+        writer.writerow(analyse.CSV_HEADER)
+        for i in range(0, len(rows), analyse.CHUNK_SIZE):
+            writer.writerows(rows[i:i + analyse.CHUNK_SIZE])
+            output.flush()
+    finally:
+        output.close()
+    return len(rows), time.time() - start, baseline
+
+
+def run_stage(stage, user_zip, workdir, options, queue):
+    """
+    Run a stage (in its own process) and put its results on a queue.
+
+    :param stage: One of STAGES
+    :param user_zip: The path to the ZIP file
+    :param workdir: A scratch folder for the stage to use
+    :param options: A dict of options for the stages: tile_size and tile_threads
+    :param queue: The multiprocessing.Queue to put the results on
+    """
+    try:
+        # What the process needed before the stage started (the interpreter, the modules and the stage's set up) is
+        # taken off, leaving the extra memory the stage itself needed at its peak
+        frames, seconds, baseline = globals()['stage_' + stage](user_zip, workdir, options)
+        peak = peak_rss_kb()
+        queue.put({'frames': frames, 'seconds': seconds, 'frames_per_sec': frames / seconds if seconds > 0 else None,
+                   'peak_rss_kb': peak, 'stage_rss_kb': peak - baseline})
+    except Exception as e:
+        queue.put({'error': repr(e)})
+
+
+def benchmark(user_zip, stages=None, options=None):
+    """
+    Run every stage of the analysis over a dataset, each in its own process.
+
+    :param user_zip: The path to the ZIP file
+    :param stages: The stages to run (defaults to all of STAGES)
+    :param options: A dict of options for the stages: tile_size (None to split each frame into four tiles) and
+    tile_threads (defaults to None and clustering's default number of threads)
+    :return: A dict of results for each stage: frames, seconds, frames_per_sec, peak_rss_kb (of the whole process) and
+    stage_rss_kb (how far the peak rose during the stage), or error
+    """
+    if stages is None:
+        stages = STAGES
+
+    if options is None:
+        import clustering
+        options = {'tile_size': None, 'tile_threads': clustering.DEFAULT_TILE_THREADS}
+
+    results = {}
+
+    for stage in stages:
+        workdir = tempfile.mkdtemp(prefix="grid-analysis-bench-")
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run_stage,
+                                          args=(stage, os.path.abspath(user_zip), workdir, options, queue))
+        try:
+            process.start()
+            results[stage] = queue.get()
+            process.join()
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return results
+
+
+def print_results(results, previous=None):
+    """
+    Print a table of benchmark results, optionally compared with an earlier run.
+
+    :param results: The results of this run, as saved in the JSON file
+    :param previous: The results of an earlier run, or None
+    """
+    print("%-16s %10s %12s %14s %10s" % ("Stage", "Frames", "Frames/sec", "Stage RSS (MB)", "vs before"))
+
+    for stage in STAGES:
+        result = results['stages'].get(stage)
+        if result is None:
+            continue
+        if 'error' in result:
+            print("%-16s failed: %s" % (stage, result['error']))
+            continue
+
+        change = ""
+        if previous is not None:
+            before = previous['stages'].get(stage, {}).get('frames_per_sec')
+            if before and result['frames_per_sec']:
+                change = "%+.1f%%" % ((result['frames_per_sec'] / before - 1) * 100)
+
+        print("%-16s %10d %12.1f %14.1f %10s" % (stage, result['frames'], result['frames_per_sec'] or 0,
+                                                 result['stage_rss_kb'] / 1024.0, change))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark each stage of analyse.py on a synthetic Timepix dataset')
+
+    parser.add_argument('--frames', '-n', metavar='N', type=int, default=1000,
+                        help='the number of frames to generate.')
+
+    parser.add_argument('--occupancy', metavar='clusters', type=float, default=10.0,
+                        help='the mean number of clusters per frame.')
+
+    parser.add_argument('--mix', metavar='shape=weight', type=str, nargs='+', default=None,
+                        help='the mix of cluster shapes, eg dot=0.6 blob=0.1 track=0.1 curly=0.2.')
+
+    parser.add_argument('--size', metavar='pixels', type=int, default=256,
+                        help='the width and height of the frames.')
+
+    parser.add_argument('--seed', type=int, default=0,
+                        help='the random seed for the dataset.')
+
+    parser.add_argument('--zip', '-z', metavar='user_zip', type=str, default=None,
+                        help='benchmark an existing ZIP file instead of generating one.')
+
+    parser.add_argument('--stages', metavar='stage', choices=STAGES, nargs='+', default=None,
+                        help='the stages to run (default: all of them).')
+
+    parser.add_argument('--tile-size', metavar='N', type=int, default=None,
+                        help='the tile size for the tiled_clustering stage, which only tiles frames bigger than this '
+                             '(default: split every frame into four tiles).')
+
+    parser.add_argument('--tile-threads', metavar='N', type=int, default=None,
+                        help='how many tiles the tiled_clustering stage labels at once (default: clustering\'s '
+                             'default).')
+
+    parser.add_argument('--output', '-o', metavar='json_file', type=str, default=None,
+                        help='where to save the results (default: benchmark-<time>.json).')
+
+    parser.add_argument('--compare', metavar='json_file', type=str, default=None,
+                        help='the results of an earlier run to compare with.')
+
+    args = parser.parse_args()
+
+    mix = DEFAULT_MIX
+    if args.mix is not None:
+        mix = dict((m.split("=")[0], float(m.split("=")[1])) for m in args.mix)
+
+    if args.tile_size is not None and args.tile_size < 1:
+        parser.error("--tile-size must be at least 1")
+
+    tile_threads = args.tile_threads
+    if tile_threads is None:
+        import clustering
+        tile_threads = clustering.DEFAULT_TILE_THREADS
+
+    options = {'tile_size': args.tile_size, 'tile_threads': tile_threads}
+
+    dataset = {'frames': args.frames, 'occupancy': args.occupancy, 'mix': mix, 'size': args.size, 'seed': args.seed}
+
+    user_zip = args.zip
+    scratch = None
+    if user_zip is None:
+        scratch = tempfile.mkdtemp(prefix="grid-analysis-bench-")
+        user_zip = os.path.join(scratch, "synthetic.zip")
+        generate(user_zip, args.frames, args.occupancy, mix, args.size, args.size, args.seed)
+    else:
+        dataset = {'zip': os.path.abspath(user_zip)}
+
+    try:
+        results = {
+            'created': time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime()),
+            'host': platform.node(),
+            'python': platform.python_version(),
+            'dataset': dataset,
+            'options': options,
+            'stages': benchmark(user_zip, args.stages, options),
+        }
+    finally:
+        if scratch is not None:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    previous = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            previous = json.load(f)
+
+    print_results(results, previous)
+
+    output = args.output
+    if output is None:
+        output = "benchmark-%s.json" % time.strftime("%Y%m%d-%H%M%S", time.gmtime())
+
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    print("Results saved to " + output)
@@ -0,0 +1,200 @@
+"""
+
+grid-analysis bundlestore.py
+
+Uploads datasets to a storage element in bundles of a fixed number of frames, each named after a hash of its contents.
+A local manifest remembers which bundles are already on storage, so submitting the same dataset again (or a dataset
+with new frames added to it) only uploads the bundles that haven't been seen before.
+
+Where the bundles go is up to a storage object with a put method. DirectoryStorage copies them into a local folder,
+which can stand in for a grid storage element so all of this can be tried out offline.
+
+This only needs the standard library, so it can be used without Ganga.
+
+"""
+# Makes it easy to convert between Python 2 and Python 3
+from __future__ import print_function
+
+import hashlib
+
+import json
+
+import os
+
+import shutil
+
+import tempfile
+
+import threading
+
+import zipfile
+
+import framearchive
+
+# How many frames go into each bundle. Frames are sorted by name, so adding frames to the end of a dataset leaves all
+# but the last of its bundles unchanged.
+DEFAULT_BUNDLE_FRAMES = 1000
+
+# The manifest of bundles already on storage, shared by every dataset uploaded from this machine
+DEFAULT_MANIFEST = os.path.join(os.path.expanduser("~"), ".grid-analysis-bundles.json")
+
+BUNDLE_PREFIX = "bundle-"
+
+
+def bundle_key(archive, bundle):
+    """
+    Work out the content address of a bundle: a hash of the names and contents of all its XYC and DSC files.
+
+    :param archive: The open ZipFile the bundle's members are from
+    :param bundle: A list of members from framearchive.list_members
+    :return: The key, as a hex string
+    """
+    sha = hashlib.sha1()
+    for file, xyc_name, dsc_name in bundle:
+        for name in (xyc_name, dsc_name):
+            if name is not None:
+                data = archive.read(name)
+                # Lengths are included so the boundaries between files can't be shifted around
+                sha.update(("%s\0%d\0" % (name, len(data))).encode("utf-8"))
+                sha.update(data)
+    return sha.hexdigest()
+
+
+def bundle_name(key):
+    """
+    :param key: The key of a bundle, from bundle_key
+    :return: The file name the bundle is stored under
+    """
+    return BUNDLE_PREFIX + key + ".zip"
+
+
+class Manifest(object):
+    """
+    The local record of which bundles are on which storage, as a JSON file of {storage name: {key: reference}}.
+    """
+
+    def __init__(self, path=DEFAULT_MANIFEST):
+        """
+        :param path: The path to the manifest file
+        """
+        self.path = path
+        self.entries = {}
+        # Several datasets can be uploaded at once (see run.submit_manifest), all recording their bundles here
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            f = open(path, "r")
+            try:
+                self.entries = json.load(f)
+            finally:
+                f.close()
+
+    def get(self, storage, key):
+        """
+        :param storage: The storage the bundle would be on
+        :param key: The key of the bundle
+        :return: The storage's reference to the bundle, or None if it hasn't been uploaded
+        """
+        return self.entries.get(storage.name, {}).get(key)
+
+    def add(self, storage, key, reference):
+        """
+        Record that a bundle has been uploaded, and save the manifest straight away so a failed upload later on
+        doesn't lose track of it.
+
+        :param storage: The storage the bundle was uploaded to
+        :param key: The key of the bundle
+        :param reference: The storage's reference to the bundle
+        """
+        with self.lock:
+            self.entries.setdefault(storage.name, {})[key] = reference
+
+            # Write a new file and move it into place, so the manifest is never left half written
+            tmp = self.path + ".tmp"
+            f = open(tmp, "w")
+            try:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            finally:
+                f.close()
+            os.rename(tmp, self.path)
+
+
+class DirectoryStorage(object):
+    """
+    A local folder standing in for a storage element.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: The folder to keep bundles in
+        """
+        self.path = os.path.abspath(path)
+        self.name = "dir:" + self.path
+
+    def put(self, local_path):
+        """
+        Copy a bundle into the folder.
+
+        :param local_path: The path to the bundle ZIP file
+        :return: The path of the copy, as the reference to it
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        target = os.path.join(self.path, os.path.basename(local_path))
+        tmp = target + ".part"
+        shutil.copyfile(local_path, tmp)
+        os.rename(tmp, target)
+        return target
+
+    def exists(self, reference):
+        """
+        :param reference: A reference from put
+        :return: Whether the bundle is still there
+        """
+        return os.path.exists(reference)
+
+
+def upload_bundles(zip_name, storage, manifest=None, frames_per_bundle=DEFAULT_BUNDLE_FRAMES):
+    """
+    Upload a dataset to storage in bundles, skipping the bundles the manifest says are already there.
+
+    :param zip_name: The path to the ZIP file of the dataset
+    :param storage: Where to put the bundles, eg a DirectoryStorage. It needs a name, a put(local_path) method that
+    returns a reference to the uploaded file and, optionally, an exists(reference) method.
+    :param manifest: The Manifest of bundles already uploaded (defaults to the one at DEFAULT_MANIFEST)
+    :param frames_per_bundle: The number of frames in each bundle
+    :return: A tuple of (a list of (bundle file name, reference) tuples in frame order, the number of bundles that
+    had to be uploaded)
+    """
+    if manifest is None:
+        manifest = Manifest()
+
+    bundles = []
+    uploaded = 0
+
+    work_dir = tempfile.mkdtemp(prefix="grid-analysis-bundles-")
+    archive = zipfile.ZipFile(zip_name, 'r')
+    try:
+        for bundle in framearchive.split_by_count(framearchive.list_members(archive), frames_per_bundle):
+            key = bundle_key(archive, bundle)
+            name = bundle_name(key)
+
+            reference = manifest.get(storage, key)
+            if reference is not None and hasattr(storage, 'exists') and not storage.exists(reference):
+                # The manifest is out of date, eg the bundle was cleaned off the storage
+                reference = None
+
+            if reference is None:
+                path = os.path.join(work_dir, name)
+                framearchive.write_members(archive, bundle, path)
+                reference = storage.put(path)
+                os.remove(path)
+                manifest.add(storage, key, reference)
+                uploaded += 1
+
+            bundles.append((name, reference))
+    finally:
+        archive.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return bundles, uploaded
@@ -0,0 +1,107 @@
+"""
+
+grid-analysis checkpoint.py
+
+Checkpoints for long analysis runs, so a job that's killed part way through can pick up where it left off instead
+of analysing the whole archive again.
+
+The checkpoint is a sidecar file next to the CSV file. Every time a chunk of rows has been written out, a line is
+added to it with the frames in that chunk and how far through the CSV file their rows go. When resuming, the CSV file
+is cut back to the last checkpoint (dropping any rows written after it) and the frames already done are skipped.
+
+"""
+# Makes it easy to convert between Python 2 and Python 3
+from __future__ import print_function
+
+import json
+
+import os
+
+CHECKPOINT_SUFFIX = ".checkpoint"
+
+
+class Checkpoint(object):
+    """
+    The checkpoint sidecar file for a CSV file.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: The path to the checkpoint file
+        """
+        self.path = path
+        # The frames whose rows are safely in the CSV file, and where the last of those rows ends
+        self.done = set()
+        self.offset = 0
+
+    def load(self):
+        """
+        Read the checkpoint file, if there is one, to find out which frames are done.
+        """
+        if not os.path.exists(self.path):
+            return
+
+        f = open(self.path, "r+")
+        try:
+            good = 0
+            for line in iter(f.readline, ""):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The job was killed while writing this line, so it (and anything after it) doesn't count
+                    break
+                self.done.update(entry['frames'])
+                self.offset = entry['offset']
+                good = f.tell()
+
+            # Drop anything after the last good line, so new checkpoints start on a line of their own
+            f.truncate(good)
+        finally:
+            f.close()
+
+    def reset(self):
+        """
+        Start a fresh checkpoint file, forgetting about any frames done before.
+        """
+        open(self.path, "w").close()
+        self.done = set()
+        self.offset = 0
+
+    def open_output(self, csv_path, buffer_size):
+        """
+        Open the CSV file for writing. If frames have already been done, the file is cut back to the end of their rows
+        and opened for appending, otherwise it's started again from scratch.
+
+        :param csv_path: The path to the CSV file
+        :param buffer_size: The size of the write buffer, in bytes
+        :return: The open file
+        """
+        if self.offset > 0 and os.path.exists(csv_path):
+            output = open(csv_path, "r+b", buffer_size)
+            output.truncate(self.offset)
+            output.seek(self.offset)
+            return output
+
+        return open(csv_path, "wb", buffer_size)
+
+    def record(self, output, frames):
+        """
+        Record that some frames are done. Their rows must already have been written to the CSV file.
+
+        :param output: The CSV file
+        :param frames: The names of the frames
+        """
+        # Make sure the rows are really on disk before saying they're done
+        output.flush()
+        os.fsync(output.fileno())
+
+        self.offset = output.tell()
+        self.done.update(frames)
+
+        f = open(self.path, "a")
+        try:
+            f.write(json.dumps({'offset': self.offset, 'frames': frames}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
@@ -0,0 +1,79 @@
+"""
+
+grid-analysis clusterfeatures.py
+
+Works out the geometric features of every cluster in a frame (or a chunk of frames) at once - size, total counts,
+centroid, radius, density and linearity (the RMS distance of a cluster's pixels from its principal axis) - with NumPy
+reductions over arrays of labelled pixels, for the cluster table (see clustertable).
+
+These are only for studying the clusters afterwards. The particle types are always those given by lucid_utils'
+classify, one cluster at a time, which works out its own features.
+
+"""
+# Makes it easy to convert between Python 2 and Python 3
+from __future__ import print_function
+
+import numpy
+
+# The particle types, in the order of the columns in the CSV file. Labels are indices into this list.
+PARTICLES = ['alpha', 'beta', 'gamma', 'proton', 'muon', 'other']
+
+
+def features(ids, x, y, c, n=None):
+    """
+    Work out the features of a set of clusters from their pixels.
+
+    :param ids: The cluster each pixel belongs to, numbered from 0
+    :param x: The x coordinate of each pixel
+    :param y: The y coordinate of each pixel
+    :param c: The counts of each pixel
+    :param n: The number of clusters (worked out from ids if not given)
+    :return: A dict of arrays with an element per cluster: size, total (counts), x, y (centroid), radius, density and
+    linearity (RMS distance of the pixels from the cluster's principal axis)
+    """
+    if n is None:
+        n = int(ids.max()) + 1 if len(ids) else 0
+
+    x = numpy.asarray(x, numpy.float64)
+    y = numpy.asarray(y, numpy.float64)
+
+    size = numpy.bincount(ids, minlength=n).astype(numpy.float64)
+    total = numpy.bincount(ids, c, minlength=n)
+
+    # Guard against empty cluster ids so we never divide by zero
+    safe = numpy.maximum(size, 1)
+
+    cx = numpy.bincount(ids, x, minlength=n) / safe
+    cy = numpy.bincount(ids, y, minlength=n) / safe
+
+    dx = x - cx[ids]
+    dy = y - cy[ids]
+
+    radius = numpy.zeros(n)
+    numpy.maximum.at(radius, ids, numpy.sqrt(dx * dx + dy * dy))
+
+    # Pixels are squares, so even a single pixel covers some area
+    density = size / (numpy.pi * (radius + 0.5) ** 2)
+
+    # The smallest eigenvalue of each cluster's covariance matrix is the spread across its principal axis
+    sxx = numpy.bincount(ids, dx * dx, minlength=n) / safe
+    syy = numpy.bincount(ids, dy * dy, minlength=n) / safe
+    sxy = numpy.bincount(ids, dx * dy, minlength=n) / safe
+    across = (sxx + syy) / 2 - numpy.sqrt(((sxx - syy) / 2) ** 2 + sxy ** 2)
+    linearity = numpy.sqrt(numpy.maximum(across, 0))
+
+    return {'size': size.astype(numpy.int64), 'total': total, 'x': cx, 'y': cy, 'radius': radius,
+            'density': density, 'linearity': linearity}
+
+
+def count(labels, frame_ids, n_frames):
+    """
+    Count the particles of each type in each frame, in one pass.
+
+    :param labels: The label of each cluster, indices into PARTICLES
+    :param frame_ids: The frame each cluster is in
+    :param n_frames: The number of frames
+    :return: An n_frames x len(PARTICLES) array of counts
+    """
+    flat = numpy.asarray(frame_ids, numpy.int64) * len(PARTICLES) + labels
+    return numpy.bincount(flat, minlength=n_frames * len(PARTICLES)).reshape(n_frames, len(PARTICLES))
@@ -0,0 +1,520 @@
+#!/usr/bin/env python
+"""
+
+grid-analysis clustering.py
+
+Finds clusters of hit pixels in Timepix frames by labelling connected components over the whole pixel grid at once,
+rather than walking the frame pixel by pixel like lucid_utils' blobbing.find. Pixels are connected if they touch,
+diagonals included, which gives the same clusters as blobbing.find.
+
+Uses scipy.ndimage for the labelling if it's available, otherwise falls back to a union-find written in NumPy.
+
+Large frames (eg from quad detectors) can be labelled in tiles instead, with the tiles labelled at the same time in a
+pool of threads. Clusters that cross from one tile into the next are stitched back together by looking across each
+tile boundary, and the clusters are then numbered just as they would be for the whole frame, so the labels are
+exactly the same either way. This is experimental: stitching and numbering the tiles is done serially, and on a
+single core tiling is about three times slower than labelling whole 1024x1024 frames. It has yet to be shown to be
+faster on a multi-core node (benchmark.py's tiled_clustering stage measures it), so analyse.py doesn't use it.
+
+analyse.py only uses this in place of blobbing.find when matches_blobbing shows that lucid_utils' blobbing.find gives
+the same clusters, with the same pixel format, for a reference frame. Running this file directly checks that too, and
+then that they find the same clusters for every frame in a ZIP archive.
+
+"""
+# Makes it easy to convert between Python 2 and Python 3
+from __future__ import print_function
+
+import atexit
+
+import os
+
+from multiprocessing.pool import ThreadPool
+
+import numpy
+
+try:
+    from scipy import ndimage
+except ImportError:
+    ndimage = None
+
+# Bump this whenever a change could give different clusters, so cached results from an older version aren't reused
+CLUSTERING_VERSION = "clustering-1"
+
+# Neighbouring pixels in a frame are connected, diagonals included
+STRUCTURE = numpy.ones((3, 3), dtype=bool)
+
+# When frames are stacked into a batch, pixels are only connected to pixels in the same frame
+BATCH_STRUCTURE = numpy.zeros((3, 3, 3), dtype=bool)
+BATCH_STRUCTURE[1] = True
+
+# Half of the neighbours of a pixel (the rest are found by symmetry), as (dx, dy) offsets
+FORWARD_NEIGHBOURS = [(0, 1), (1, -1), (1, 0), (1, 1)]
+
+# The hit pixels of a small test frame, with pixels touching side by side, diagonally, in lines and in blocks, lone
+# pixels and clusters on the edges of the frame. See matches_blobbing.
+REFERENCE_PIXELS = [(0, 0), (0, 1), (1, 0), (0, 255), (255, 255), (255, 0), (254, 1),
+                    (10, 10), (11, 11), (12, 12), (12, 10), (20, 20), (20, 22), (30, 5), (31, 5), (32, 5), (33, 6),
+                    (40, 40), (40, 41), (41, 40), (41, 41), (42, 42), (50, 50), (52, 52), (60, 30), (61, 29), (62, 28)]
+
+# How many threads label the tiles of a frame at once, by default
+DEFAULT_TILE_THREADS = 4
+
+# The thread pool for labelling tiles, and the process it belongs to (a pool doesn't survive a fork)
+_tile_pool = None
+_tile_pool_owner = None
+
+
+def _shifted_pairs(ids, dx, dy):
+    """
+    Find pairs of hit pixels that are neighbours along an offset, in the last two axes of an array of pixel ids.
+
+    :param ids: An array of pixel ids, -1 where there's no hit
+    :param dx: The offset in the second to last axis
+    :param dy: The offset in the last axis
+    :return: A tuple of two arrays of pixel ids
+    """
+    width, height = ids.shape[-2:]
+
+    a = ids[..., 0:width - dx, max(0, -dy):height - max(0, dy)]
+    b = ids[..., dx:width, max(0, dy):height - max(0, -dy)]
+
+    both = (a >= 0) & (b >= 0)
+    return a[both], b[both]
+
+
+def _label_numpy(mask):
+    """
+    Label the connected components of a mask without SciPy, using a vectorised union-find over the hit pixels.
+    Only the last two axes are spatial, so a stack of frames is labelled frame by frame.
+
+    :param mask: A boolean array, True where a pixel is hit
+    :return: A tuple of (array of labels, number of labels), with labels numbered from 1 in raster order like
+    scipy.ndimage.label
+    """
+    n = int(mask.sum())
+    labels = numpy.zeros(mask.shape, numpy.int32)
+
+    if n == 0:
+        return labels, 0
+
+    ids = numpy.full(mask.shape, -1, numpy.int64)
+    ids[mask] = numpy.arange(n)
+
+    pairs = [_shifted_pairs(ids, dx, dy) for dx, dy in FORWARD_NEIGHBOURS]
+    parent = _union(n, numpy.concatenate([pair[0] for pair in pairs]), numpy.concatenate([pair[1] for pair in pairs]))
+
+    # Each root is the first pixel of its cluster in raster order, so numbering the roots in order matches SciPy
+    roots, numbered = numpy.unique(parent, return_inverse=True)
+    labels[mask] = numbered + 1
+
+    return labels, len(roots)
+
+
+def _union(n, a, b):
+    """
+    Join up the items connected by a set of edges.
+
+    :param n: The number of items
+    :param a: The first item of each edge
+    :param b: The second item of each edge
+    :return: The root of each item: the lowest numbered item it's connected to
+    """
+    parent = numpy.arange(n)
+
+    while True:
+        ra = parent[a]
+        rb = parent[b]
+        differ = ra != rb
+
+        if not differ.any():
+            break
+
+        # Hook the larger root of every edge onto the smaller one...
+        numpy.minimum.at(parent, numpy.maximum(ra, rb)[differ], numpy.minimum(ra, rb)[differ])
+
+        # ...then flatten the trees so every item points straight at its root
+        while True:
+            grandparent = parent[parent]
+            if (grandparent == parent).all():
+                break
+            parent = grandparent
+
+    return parent
+
+
+def _label_mask(mask):
+    """
+    :param mask: A 2D boolean array, True where a pixel is hit
+    :return: A tuple of (array of labels, number of labels), see label
+    """
+    if ndimage is not None:
+        return ndimage.label(mask, structure=STRUCTURE)
+    return _label_numpy(mask)
+
+
+def label(frame, tile_size=None, threads=DEFAULT_TILE_THREADS):
+    """
+    Label the clusters in a frame.
+
+    :param frame: A 2D array of counts, frame[x][y]
+    :param tile_size: Label frames bigger than this in tiles of tile_size x tile_size pixels (see label_tiled), or
+    None to always label the whole frame at once
+    :param threads: How many tiles to label at once
+    :return: A tuple of (array of labels the same shape as the frame, number of clusters). Pixels that aren't hit
+    are labelled 0.
+    """
+    mask = numpy.asarray(frame) > 0
+
+    if tile_size and max(mask.shape) > tile_size:
+        return label_tiled(mask, tile_size, threads)
+    return _label_mask(mask)
+
+
+def _tile_threads(threads):
+    """
+    :param threads: How many threads to label tiles with
+    :return: The ThreadPool, started the first time it's needed in each process (and again if the number of threads
+    changes)
+    """
+    global _tile_pool, _tile_pool_owner
+
+    if _tile_pool is not None and _tile_pool_owner != (os.getpid(), threads):
+        close_tile_threads()
+
+    if _tile_pool is None:
+        _tile_pool = ThreadPool(threads)
+        _tile_pool_owner = (os.getpid(), threads)
+    return _tile_pool
+
+
+def close_tile_threads():
+    """
+    Shut down the pool of threads for labelling tiles, if one has been started. It's started again if it's needed.
+    """
+    global _tile_pool, _tile_pool_owner
+
+    # A pool inherited from the parent process has no threads in this one, so it's just dropped
+    if _tile_pool is not None and _tile_pool_owner[0] == os.getpid():
+        _tile_pool.close()
+        _tile_pool.join()
+
+    _tile_pool = None
+    _tile_pool_owner = None
+
+
+atexit.register(close_tile_threads)
+
+
+def label_tiled(mask, tile_size, threads=DEFAULT_TILE_THREADS):
+    """
+    Label the clusters in a large frame tile by tile, labelling the tiles at the same time in a pool of threads. This
+    gives exactly the same labels as labelling the whole frame at once.
+
+    Each tile is labelled on its own, then the pixels either side of every tile boundary (the one pixel halo each tile
+    shares with its neighbours) are compared to find the clusters that carry on into the next tile, and those are
+    joined up. Finally the clusters are numbered in raster order of their first pixel, like label.
+
+    :param mask: A 2D boolean array, True where a pixel is hit
+    :param tile_size: The width and height of each tile, in pixels
+    :param threads: How many tiles to label at once
+    :return: A tuple of (array of labels the same shape as the frame, number of clusters)
+    """
+    width, height = mask.shape
+    tiles = [(x, y) for x in range(0, width, tile_size) for y in range(0, height, tile_size)]
+
+    if threads > 1 and len(tiles) > 1:
+        run = _tile_threads(threads).map
+    else:
+        run = lambda work, items: [work(item) for item in items]
+
+    def tile_of(array, i):
+        x, y = tiles[i]
+        return array[x:x + tile_size, y:y + tile_size]
+
+    results = run(lambda i: _label_mask(tile_of(mask, i)), range(len(tiles)))
+
+    # Give every tile's labels their own range, so each (tile, label) is a label of the whole frame
+    offsets = numpy.cumsum([0] + [tile_n for tile_labels, tile_n in results]).tolist()
+    n = offsets[-1]
+
+    labels = numpy.zeros(mask.shape, numpy.int32)
+    if n == 0:
+        return labels, 0
+
+    # The position (in raster order over the whole frame) of the first pixel with each label
+    first = numpy.zeros(n, numpy.int64)
+
+    def place_tile(i):
+        tile_labels = results[i][0]
+        xs, ys = numpy.nonzero(tile_labels)
+        if len(xs) == 0:
+            return
+        tile_ids = tile_labels[xs, ys]
+        tile_of(labels, i)[xs, ys] = tile_ids + offsets[i]
+
+        # A tile's labels are numbered in raster order of their first pixels, and raster order within a tile is
+        # raster order in the frame, so each label's first pixel is where the running highest label goes up
+        starts = numpy.flatnonzero(numpy.diff(numpy.maximum.accumulate(numpy.concatenate(([0], tile_ids)))) > 0)
+        x, y = tiles[i]
+        first[offsets[i]:offsets[i + 1]] = (x + xs[starts]) * height + y + ys[starts]
+
+    run(place_tile, range(len(tiles)))
+
+    # Clusters that cross a boundary show up as neighbouring pixels with different labels in the two pixel wide
+    # strips either side of it (each tile's one pixel halo). ids are labels counting from 0, -1 for pixels not hit.
+    strips = ([labels[x - 1:x + 1, :] for x in range(tile_size, width, tile_size)] +
+              [labels[:, y - 1:y + 1] for y in range(tile_size, height, tile_size)])
+    pairs = [_shifted_pairs(strip.astype(numpy.int64) - 1, dx, dy) for strip in strips for dx, dy in FORWARD_NEIGHBOURS]
+    roots = _union(n, numpy.concatenate([pair[0] for pair in pairs] + [numpy.empty(0, numpy.int64)]),
+                   numpy.concatenate([pair[1] for pair in pairs] + [numpy.empty(0, numpy.int64)]))
+
+    # Number the joined up clusters in raster order of their first pixels, as labelling the whole frame would
+    cluster_first = numpy.full(n, mask.size, numpy.int64)
+    numpy.minimum.at(cluster_first, roots, first)
+
+    clusters = numpy.flatnonzero(cluster_first < mask.size)
+    numbers = numpy.zeros(n, numpy.int32)
+    numbers[clusters[numpy.argsort(cluster_first[clusters], kind='mergesort')]] = numpy.arange(1, len(clusters) + 1)
+
+    lookup = numpy.concatenate(([0], numbers[roots])).astype(numpy.int32)
+
+    def number_tile(i):
+        tile = tile_of(labels, i)
+        tile[...] = lookup[tile]
+
+    run(number_tile, range(len(tiles)))
+    return labels, len(clusters)
+
+
+def label_batch(frames):
+    """
+    Label the clusters in a stack of frames in a single call. Clusters never cross from one frame into another.
+
+    :param frames: A 3D array of counts, frames[i][x][y], or a list of equally sized 2D frames
+    :return: A tuple of (array of labels the same shape as the stack, number of clusters). Labels run on from one
+    frame to the next, so every cluster in the batch has its own label.
+    """
+    mask = numpy.asarray(frames) > 0
+
+    if ndimage is not None:
+        return ndimage.label(mask, structure=BATCH_STRUCTURE)
+    return _label_numpy(mask)
+
+
+def _split_clusters(labels, coords):
+    """
+    Group the coordinates of labelled pixels into clusters.
+
+    :param labels: The label of each hit pixel
+    :param coords: A list of coordinate arrays for the hit pixels, the same length as labels
+    :return: A list of clusters in label order, each a list of coordinate tuples
+    """
+    if len(labels) == 0:
+        return []
+
+    # A stable sort keeps the pixels of each cluster in raster order
+    order = numpy.argsort(labels, kind='mergesort')
+    pixels = list(zip(*[c[order].tolist() for c in coords]))
+    bounds = numpy.cumsum(numpy.bincount(labels)[1:]).tolist()
+
+    clusters = []
+    start = 0
+    for end in bounds:
+        clusters.append(pixels[start:end])
+        start = end
+
+    return clusters
+
+
+def find(frame, tile_size=None, threads=DEFAULT_TILE_THREADS):
+    """
+    Find the clusters in a frame. This finds the same clusters as blobbing.find.
+
+    :param frame: A 2D array of counts, frame[x][y]
+    :param tile_size: Label frames bigger than this in tiles (see label), or None
+    :param threads: How many tiles to label at once
+    :return: A list of clusters, each a list of (x, y) tuples of the pixels in it, which is what blobbing.Blob takes
+    if matches_blobbing passes
+    """
+    labels, n = label(frame, tile_size, threads)
+    xs, ys = numpy.nonzero(labels)
+
+    return _split_clusters(labels[xs, ys], [xs, ys])
+
+
+def label_pixels(x, y):
+    """
+    Label the clusters among a handful of hit pixels straight from their coordinates, without laying them out in a
+    frame first. Every pair of pixels is compared, so this is only quicker than label for very sparse frames.
+
+    :param x: The x coordinates of the hit pixels, in raster order with no repeats (see xycarray.hit_pixels)
+    :param y: The y coordinates of the hit pixels
+    :return: A tuple of (the label of each pixel, numbered from 1 in raster order like label, number of clusters)
+    """
+    x = numpy.asarray(x, numpy.int64)
+    y = numpy.asarray(y, numpy.int64)
+    n = len(x)
+
+    if n == 0:
+        return numpy.zeros(0, numpy.int64), 0
+
+    near = (numpy.abs(x[:, numpy.newaxis] - x) <= 1) & (numpy.abs(y[:, numpy.newaxis] - y) <= 1)
+
+    # Spread the lowest index through each cluster, which ends up as the cluster's first pixel in raster order
+    roots = numpy.arange(n)
+    while True:
+        spread = numpy.where(near, roots, n).min(axis=1)
+        if (spread == roots).all():
+            break
+        roots = spread
+
+    firsts = numpy.unique(roots)
+    return numpy.searchsorted(firsts, roots) + 1, len(firsts)
+
+
+def find_pixels(x, y):
+    """
+    Find the clusters among a handful of hit pixels, see label_pixels. This gives the same clusters as find would for
+    the frame.
+
+    :param x: The x coordinates of the hit pixels, in raster order with no repeats (see xycarray.hit_pixels)
+    :param y: The y coordinates of the hit pixels
+    :return: A list of clusters, each a list of (x, y) tuples of the pixels in it
+    """
+    labels, n = label_pixels(x, y)
+    return _split_clusters(labels, [numpy.asarray(x), numpy.asarray(y)])
+
+
+def find_batch(frames):
+    """
+    Find the clusters in a stack of frames in a single call.
+
+    :param frames: A 3D array of counts, frames[i][x][y], or a list of equally sized 2D frames
+    :return: A list with an entry for each frame, each a list of clusters as given by find
+    """
+    frames = numpy.asarray(frames)
+    labels, n = label_batch(frames)
+    fs, xs, ys = numpy.nonzero(labels)
+    pixel_labels = labels[fs, xs, ys]
+
+    clusters = _split_clusters(pixel_labels, [xs, ys])
+
+    # Labels are numbered in raster order, so each frame's clusters are one run of the list
+    firsts = numpy.unique(pixel_labels, return_index=True)[1]
+    counts = numpy.bincount(fs[firsts], minlength=len(frames))
+
+    batch = []
+    start = 0
+    for count in counts.tolist():
+        batch.append(clusters[start:start + count])
+        start += count
+
+    return batch
+
+
+def reference_frame():
+    """
+    :return: A 256x256 frame with REFERENCE_PIXELS hit
+    """
+    frame = numpy.zeros((256, 256))
+    for i, (x, y) in enumerate(REFERENCE_PIXELS):
+        frame[x, y] = 10 + i
+    return frame
+
+
+def matches_blobbing(blobbing=None):
+    """
+    Check that lucid_utils' blobbing.find gives exactly the same clusters as find for the reference frame, with every
+    pixel held the same way, as an (x, y) tuple. Clusters from find are only wrapped up as Blobs for classify in place
+    of the ones from blobbing.find when this passes.
+
+    :param blobbing: The blobbing module to check (defaults to lucid_utils')
+    :return: Whether they match
+    """
+    if blobbing is None:
+        from lucid_utils import blobbing
+
+    frame = reference_frame()
+    blobs = [list(blob.pixels) for blob in blobbing.find(frame)]
+
+    if not all(type(pixel) is tuple and len(pixel) == 2 for pixels in blobs for pixel in pixels):
+        return False
+
+    return sorted(sorted(pixels) for pixels in blobs) == sorted(find(frame))
+
+
+def check_parity(user_zip, tile_size=None):
+    """
+    Check that find gives the same clusters as lucid_utils' blobbing.find for every frame in a ZIP archive.
+
+    :param user_zip: The path to the ZIP file
+    :param tile_size: Label the frames in tiles of this size (see label_tiled), or None to label them whole
+    :return: A list of the names of frames where the clusters differ
+    """
+    import zipfile
+
+    from lucid_utils import blobbing
+
+    import xycarray
+
+    import dscreader
+
+    archive = zipfile.ZipFile(user_zip, 'r')
+    mismatches = []
+
+    try:
+        names = set(archive.namelist())
+        for name in sorted(names):
+            if name.endswith(".dsc") or name.endswith("/"):
+                continue
+
+            # Large format frames only fit at the size their DSC files give
+            width, height = xycarray.DEFAULT_WIDTH, xycarray.DEFAULT_HEIGHT
+            if name + ".dsc" in names:
+                try:
+                    dsc = dscreader.DscFile(name + ".dsc", archive.read(name + ".dsc").decode("latin-1"), lazy=True)
+                    width, height = dsc.getFrameWidth(), dsc.getFrameHeight()
+                except IOError:
+                    pass
+
+            frame = xycarray.parse_frame(archive.read(name), width, height)
+
+            # matches_blobbing checks how a Blob holds its pixels, so only the clusters themselves are compared here
+            expected = sorted(sorted(tuple(p) for p in blob.pixels) for blob in blobbing.find(frame))
+            found = sorted(sorted(cluster) for cluster in find(frame, tile_size))
+
+            if expected != found:
+                mismatches.append(name)
+    finally:
+        archive.close()
+
+    return mismatches
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Check clustering.find against blobbing.find for a ZIP of XYC files')
+
+    parser.add_argument('user_zip', metavar='user_zip', type=str,
+                        help='a path to the zip file containing the frames to check.')
+
+    parser.add_argument('--tile-size', metavar='N', type=int, default=None,
+                        help='label the frames in N x N tiles, to check the tiled labelling too.')
+
+    args = parser.parse_args()
+
+    if not matches_blobbing():
+        print("blobbing.find doesn't give the same clusters as find for the reference frame (or holds its pixels "
+              "differently), so analyse.py will keep using it")
+        raise SystemExit(1)
+
+    mismatches = check_parity(args.user_zip, args.tile_size)
+
+    for name in mismatches:
+        print("Clusters differ in " + name)
+
+    if mismatches:
+        raise SystemExit(1)
+
+    print("All frames match blobbing.find")
@@ -0,0 +1,245 @@
+"""
+
+grid-analysis clustertable.py
+
+Keeps every cluster found by the analysis, rather than just the particle counts, so new cuts and studies can be run
+locally against the saved features instead of clustering the raw frames again.
+
+The table has a row per cluster: the frame it's in (an index into the table's list of frames, which are in the same
+order as the CSV rows), its centroid, size, total counts, the geometric features clusterfeatures works out (radius,
+density and linearity) and the label lucid_utils' classify gave it, an index into clusterfeatures.PARTICLES. Rows are
+streamed to disk as fixed size records while the analysis runs, and gathered up into a compressed .npz file of columns
+at the end.
+
+The columns have the same names as clusterfeatures.features, so new cuts can be tried out on them directly. classify
+works its own features out, so the saved ones aren't what the labels were cut on.
+
+"""
+# Makes it easy to convert between Python 2 and Python 3
+from __future__ import print_function
+
+import argparse
+
+import csv
+
+import os
+
+import numpy
+
+import clusterfeatures
+
+CLUSTERS_FILE = "grid-analysis-clusters.npz"
+
+# Each cluster, as written while the analysis runs
+CLUSTER_DTYPE = numpy.dtype([('frame', '<u4'), ('x', '<f4'), ('y', '<f4'), ('size', '<u4'), ('total', '<i8'),
+                             ('radius', '<f4'), ('density', '<f4'), ('linearity', '<f4'), ('label', 'i1')])
+
+PART_SUFFIX = ".part"
+
+
+def records(frame, ids, x, y, c, n, labels):
+    """
+    Work out the table rows for the clusters of a frame.
+
+    :param frame: The index of the frame
+    :param ids: The cluster each pixel belongs to, numbered from 0
+    :param x: The x coordinate of each pixel
+    :param y: The y coordinate of each pixel
+    :param c: The counts of each pixel
+    :param n: The number of clusters
+    :param labels: The label each cluster was given, indices into clusterfeatures.PARTICLES
+    :return: An array of CLUSTER_DTYPE records, one per cluster
+    """
+    feats = clusterfeatures.features(ids, x, y, c, n)
+
+    rows = numpy.empty(n, CLUSTER_DTYPE)
+    rows['frame'] = frame
+    for name in CLUSTER_DTYPE.names[1:-1]:
+        rows[name] = feats[name]
+    rows['label'] = labels
+    return rows
+
+
+def cluster_pixels(clusters, frame):
+    """
+    Get the pixels of a list of clusters as arrays.
+
+    :param clusters: A list of clusters, each a list of (x, y) tuples, as given by clustering.find
+    :param frame: The frame the clusters are in, frame[x][y]
+    :return: A tuple of (cluster ids numbered from 0, x, y, C)
+    """
+    sizes = [len(cluster) for cluster in clusters]
+    xy = numpy.array([pixel for cluster in clusters for pixel in cluster], numpy.int64).reshape(-1, 2)
+    frame = numpy.asarray(frame)
+
+    return (numpy.repeat(numpy.arange(len(clusters)), sizes), xy[:, 0], xy[:, 1], frame[xy[:, 0], xy[:, 1]])
+
+
+class ClusterWriter(object):
+    """
+    Streams the clusters of a run to disk, chunk by chunk, and writes the table out when it's closed.
+    """
+
+    def __init__(self, path=CLUSTERS_FILE):
+        """
+        :param path: The path of the .npz file to write
+        """
+        self.path = path
+        self.part = open(path + PART_SUFFIX, "wb")
+        self.frames = []
+
+    def add(self, frames, rows):
+        """
+        Add a chunk of frames and their clusters.
+
+        :param frames: The names of the chunk's frames, in order
+        :param rows: The chunk's CLUSTER_DTYPE records, with frame indices counting from the chunk's first frame
+        """
+        if len(rows):
+            rows = rows.copy()
+            rows['frame'] += len(self.frames)
+            self.part.write(rows.tobytes())
+        self.frames.extend(frames)
+
+    def close(self, classifier):
+        """
+        Gather up the streamed clusters into the table file.
+
+        :param classifier: The name of the classifier that labelled the clusters
+        :return: The number of clusters written
+        """
+        self.part.close()
+        rows = numpy.fromfile(self.path + PART_SUFFIX, CLUSTER_DTYPE)
+
+        save(self.path, self.frames, dict((name, rows[name]) for name in CLUSTER_DTYPE.names), classifier)
+
+        os.remove(self.path + PART_SUFFIX)
+        self.part = None
+        return len(rows)
+
+    def abort(self):
+        """
+        Throw the streamed clusters away, eg if the run fails. Does nothing once the table has been written.
+        """
+        if self.part is None:
+            return
+        self.part.close()
+        self.part = None
+        if os.path.exists(self.path + PART_SUFFIX):
+            os.remove(self.path + PART_SUFFIX)
+
+
+def save(path, frames, columns, classifier):
+    """
+    Write a cluster table.
+
+    :param path: The path of the .npz file
+    :param frames: The names of the frames, in order
+    :param columns: A dict of an array per column of CLUSTER_DTYPE
+    :param classifier: The name of the classifier that labelled the clusters
+    """
+    f = open(path, "wb")
+    try:
+        numpy.savez_compressed(f, frames=numpy.array(frames, str), classifier=numpy.array(classifier),
+                               particles=numpy.array(clusterfeatures.PARTICLES), **columns)
+    finally:
+        f.close()
+
+
+def load(path=CLUSTERS_FILE):
+    """
+    Load a cluster table.
+
+    :param path: The path of the .npz file
+    :return: A tuple of (list of frame names, dict of columns, name of the classifier that labelled the clusters)
+    """
+    npz = numpy.load(path)
+    try:
+        columns = dict((name, npz[name]) for name in CLUSTER_DTYPE.names)
+        return npz['frames'].tolist(), columns, str(npz['classifier'])
+    finally:
+        npz.close()
+
+
+def merge_files(paths, path=CLUSTERS_FILE):
+    """
+    Merge the cluster tables from separate runs (eg subjobs) into one, with their frames one after the other.
+
+    :param paths: The paths of the tables, in order
+    :param path: The path of the merged table
+    :return: The number of clusters in the merged table
+    """
+    frames = []
+    parts = dict((name, []) for name in CLUSTER_DTYPE.names)
+    classifiers = set()
+
+    for p in paths:
+        table_frames, columns, classifier = load(p)
+        columns['frame'] = columns['frame'] + len(frames)
+        for name in CLUSTER_DTYPE.names:
+            parts[name].append(columns[name])
+        frames.extend(table_frames)
+        classifiers.add(classifier)
+
+    if len(classifiers) > 1:
+        raise ValueError("Can't merge tables labelled by different classifiers: %s" % sorted(classifiers))
+
+    columns = dict((name, numpy.concatenate(parts[name] + [numpy.empty(0, CLUSTER_DTYPE[name])]))
+                   for name in CLUSTER_DTYPE.names)
+    save(path, frames, columns, classifiers.pop() if classifiers else "")
+    return len(columns['frame'])
+
+
+def count_frames(columns, n_frames, labels=None):
+    """
+    Count the particles of each type in each frame of a table.
+
+    :param columns: The table's columns, from load
+    :param n_frames: The number of frames in the table
+    :param labels: The label of each cluster (defaults to the labels saved in the table)
+    :return: An n_frames x len(PARTICLES) array of counts
+    """
+    if labels is None:
+        labels = columns['label']
+    return clusterfeatures.count(labels.astype(numpy.int64), columns['frame'], n_frames)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Summarise a cluster table written by analyse.py --clusters, and '
+                                                 'count the particles in each frame from it.')
+
+    parser.add_argument('tables', metavar='clusters_file', type=str, nargs='+',
+                        help='the cluster table, or with --merge, the tables to merge.')
+
+    parser.add_argument('--merge', metavar='merged_file', type=str, default=None,
+                        help='merge the tables from separate subjobs into this file first, and use that.')
+
+    parser.add_argument('--output', '-o', metavar='csv_file', type=str, default=None,
+                        help='write the particle counts of each frame to this CSV file.')
+
+    args = parser.parse_args()
+
+    table = args.tables[0]
+    if args.merge is not None:
+        merge_files(args.tables, args.merge)
+        table = args.merge
+    elif len(args.tables) != 1:
+        parser.error("give one cluster table, or use --merge")
+
+    frames, columns, classifier = load(table)
+
+    counts = count_frames(columns, len(frames))
+
+    print("%d clusters in %d frames, labelled by %s" % (len(columns['frame']), len(frames), classifier))
+    for i, particle in enumerate(clusterfeatures.PARTICLES):
+        print("%s: %d" % (particle, int(counts[:, i].sum())))
+
+    if args.output is not None:
+        output = open(args.output, "wb")
+        try:
+            writer = csv.writer(output)
+            writer.writerow(["File"] + [particle.capitalize() for particle in clusterfeatures.PARTICLES])
+            for name, row in zip(frames, counts.tolist()):
+                writer.writerow([name] + row)
+        finally:
+            output.close()
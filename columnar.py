@@ -0,0 +1,171 @@
+"""
+
+grid-analysis columnar.py
+
+Writes the per-frame results as a typed, compressed columnar file rather than rows of text, which is much smaller and
+much quicker to load for time-series and per-detector studies.
+
+The columns are the same as the CSV file's header row. A NumPy .npz file is always available; Parquet is written with
+pyarrow if it's installed.
+
+"""
+# Makes it easy to convert between Python 2 and Python 3
+from __future__ import print_function
+
+import array
+
+import csv
+
+import numpy
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+FORMATS = ['npz', 'parquet']
+
+# How each column of the CSV file is stored: 'str', 'float' (missing values become NaN) or 'int'
+COLUMN_TYPES = [
+    ("Frame Name", 'str'),
+    ("Capture Time", 'float'),
+    ("Detector ID", 'str'),
+    ("Bias Voltage", 'float'),
+    ("Acquisition Time", 'float'),
+    ("Alpha", 'int'),
+    ("Beta", 'int'),
+    ("Gamma", 'int'),
+    ("Proton", 'int'),
+    ("Muon", 'int'),
+    ("Other", 'int'),
+]
+
+
+def output_path(csv_path, fmt):
+    """
+    Get the path of the columnar file to go alongside a CSV file.
+
+    :param csv_path: The path of the CSV file
+    :param fmt: The columnar format, one of FORMATS
+    :return: The path of the columnar file
+    """
+    if csv_path.endswith(".csv"):
+        csv_path = csv_path[:-4]
+    return csv_path + "." + fmt
+
+
+def read_columns(csv_path):
+    """
+    Read a CSV file of results into typed columns. Rows are read one at a time into compact arrays, so this never
+    holds the text of the whole file in memory.
+
+    :param csv_path: The path of the CSV file
+    :return: A dict of NumPy arrays, keyed by the names in the header row
+    """
+    store = []
+    for name, kind in COLUMN_TYPES:
+        if kind == 'str':
+            store.append([])
+        elif kind == 'float':
+            store.append(array.array('d'))
+        else:
+            store.append(array.array('l'))
+
+    f = open(csv_path, "rb")
+    try:
+        reader = csv.reader(f)
+        next(reader)  # The header row
+
+        for row in reader:
+            for value, column, (name, kind) in zip(row, store, COLUMN_TYPES):
+                if kind == 'float':
+                    column.append(float(value) if value != "" else numpy.nan)
+                elif kind == 'int':
+                    column.append(int(value))
+                else:
+                    column.append(value)
+    finally:
+        f.close()
+
+    columns = {}
+    for column, (name, kind) in zip(store, COLUMN_TYPES):
+        if kind == 'str':
+            columns[name] = numpy.array(column, dtype=str)
+        elif kind == 'float':
+            columns[name] = numpy.frombuffer(column, numpy.float64).copy()
+        else:
+            columns[name] = numpy.array(column, numpy.int32)
+
+    return columns
+
+
+def available(fmt):
+    """
+    Check whether a columnar format can be written here, so a run can refuse it up front rather than failing once
+    the analysis is done.
+
+    :param fmt: The columnar format, one of FORMATS
+    :return: Whether write supports it
+    """
+    return fmt != 'parquet' or pyarrow is not None
+
+
+def write(columns, path, fmt):
+    """
+    Write typed columns to a compressed columnar file.
+
+    :param columns: A dict of NumPy arrays, keyed by the names in the header row
+    :param path: The path of the file to write
+    :param fmt: The columnar format, one of FORMATS
+    """
+    if fmt == 'npz':
+        f = open(path, "wb")
+        try:
+            numpy.savez_compressed(f, **columns)
+        finally:
+            f.close()
+    elif fmt == 'parquet':
+        if pyarrow is None:
+            raise ImportError("pyarrow is needed to write Parquet files")
+        names = [name for name, kind in COLUMN_TYPES]
+        table = pyarrow.Table.from_arrays([pyarrow.array(columns[name]) for name in names], names)
+        pyarrow.parquet.write_table(table, path, compression='snappy')
+    else:
+        raise ValueError("Unknown columnar format: " + fmt)
+
+
+def convert(csv_path, fmt, path=None):
+    """
+    Convert a CSV file of results to a columnar file.
+
+    :param csv_path: The path of the CSV file
+    :param fmt: The columnar format, one of FORMATS
+    :param path: The path of the file to write (defaults to the CSV path with the format's extension)
+    :return: The path of the file written
+    """
+    if path is None:
+        path = output_path(csv_path, fmt)
+
+    write(read_columns(csv_path), path, fmt)
+    return path
+
+
+def load(path):
+    """
+    Load a columnar file of results.
+
+    :param path: The path of the .npz or .parquet file
+    :return: A dict of NumPy arrays, keyed by the names in the CSV file's header row
+    """
+    if path.endswith(".parquet"):
+        if pyarrow is None:
+            raise ImportError("pyarrow is needed to read Parquet files")
+        table = pyarrow.parquet.read_table(path)
+        return dict((name, table.column(name).to_numpy()) for name in table.column_names)
+
+    npz = numpy.load(path)
+    try:
+        return dict((name, npz[name]) for name in npz.files)
+    finally:
+        npz.close()
@@ -0,0 +1,299 @@
+"""
+
+grid-analysis dscindex.py
+
+A persistent index of the DSC metadata of every frame in an archive, so frames can be picked out (by chip ID, bias
+voltage, acquisition time, start time...) without extracting the archive and reading every DSC file each time.
+
+Each archive's DSC files are parsed once into an SQLite file, with a column for each value DscFile has a getter for.
+An archive is only indexed again if its size or modification time changes.
+
+Frames are picked with a filter expression, eg
+
+    chip_id = 'B06-W0212' and bias_voltage >= 20 and start_time between 1400000000 and 1400003600
+
+Expressions can use the column names in COLUMNS (plus frame), numbers, quoted strings, comparisons (=, !=, <, <=, >,
+>=), and, or, not, between, in (...), like, is null and brackets. Frames without a valid DSC file have no values, so
+they never match a comparison.
+
+"""
+# Makes it easy to convert between Python 2 and Python 3
+from __future__ import print_function
+
+import argparse
+
+import os
+
+import re
+
+import sqlite3
+
+import zipfile
+
+import dscreader
+
+from framearchive import list_members
+
+# The index shared by every archive looked at from this machine
+DEFAULT_INDEX = os.path.join(os.path.expanduser("~"), ".grid-analysis-index.db")
+
+# Bump this whenever the tables change, so an index written by an older version is built again from scratch
+SCHEMA_VERSION = 2
+
+# The columns of the index: (name, SQLite type, DscFile getter)
+COLUMNS = [
+    ('width', 'INTEGER', 'getFrameWidth'),
+    ('height', 'INTEGER', 'getFrameHeight'),
+    ('acq_mode', 'INTEGER', 'getAcqMode'),
+    ('acq_time', 'REAL', 'getAcqTime'),
+    ('chip_id', 'TEXT', 'getChipId'),
+    ('firmware_version', 'TEXT', 'getFirmwareVersion'),
+    ('bias_voltage', 'REAL', 'getBiasVoltage'),
+    ('hw_timer_mode', 'INTEGER', 'getHwTimerMode'),
+    ('interface', 'TEXT', 'getInterface'),
+    ('mpx_clock', 'REAL', 'getMpxClock'),
+    ('mpx_type', 'INTEGER', 'getMpxType'),
+    ('pixelman_version', 'TEXT', 'getPixelmanVersion'),
+    ('polarity', 'INTEGER', 'getPolarity'),
+    ('start_time', 'REAL', 'getStartTime'),
+    ('start_time_string', 'TEXT', 'getStartTimeS'),
+    ('tpx_clock', 'REAL', 'getTpxClock'),
+    ('name_and_serial_number', 'TEXT', 'getNameAndSerialNumber'),
+    ('ikrum', 'INTEGER', 'getIKrum'),
+    ('disc', 'INTEGER', 'getDisc'),
+    ('preamp', 'INTEGER', 'getPreamp'),
+    ('buff_analog_a', 'INTEGER', 'getBuffAnalogA'),
+    ('buff_analog_b', 'INTEGER', 'getBuffAnalogB'),
+    ('hist', 'INTEGER', 'getHist'),
+    ('thl', 'INTEGER', 'getTHL'),
+    ('thl_coarse', 'INTEGER', 'getTHLCoarse'),
+    ('vcas', 'INTEGER', 'getVcas'),
+    ('fbk', 'INTEGER', 'getFBK'),
+    ('gnd', 'INTEGER', 'getGND'),
+    ('ths', 'INTEGER', 'getTHS'),
+    ('bias_lvds', 'INTEGER', 'getBiasLVDS'),
+    ('ref_lvds', 'INTEGER', 'getRefLVDS'),
+]
+
+# The columns most often filtered on get an SQLite index of their own
+INDEXED_COLUMNS = ['chip_id', 'bias_voltage', 'acq_time', 'start_time']
+
+COLUMN_NAMES = set(['frame'] + [name for name, kind, getter in COLUMNS])
+
+KEYWORDS = set(['and', 'or', 'not', 'between', 'in', 'like', 'is', 'null'])
+
+OPERATORS = {'=': '=', '==': '=', '!=': '!=', '<>': '!=', '<': '<', '<=': '<=', '>': '>', '>=': '>=', '(': '(',
+             ')': ')', ',': ','}
+
+TOKEN_RE = re.compile(r"""\s*(?:
+    (?P<number>-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?) |
+    (?P<string>'[^']*'|"[^"]*") |
+    (?P<word>[A-Za-z_][A-Za-z_0-9]*) |
+    (?P<operator><=|>=|==|!=|<>|[=<>(),])
+)""", re.VERBOSE)
+
+
+def compile_filter(expression):
+    """
+    Turn a filter expression into an SQL condition. Only the column names, keywords and operators listed in the
+    module docstring are let through, and every number and string becomes a query parameter.
+
+    :param expression: The filter expression
+    :return: A tuple of (SQL condition, list of parameters)
+    """
+    sql = []
+    params = []
+
+    pos = 0
+    expression = expression.strip()
+    while pos < len(expression):
+        match = TOKEN_RE.match(expression, pos)
+        if match is None or match.end() == pos:
+            raise ValueError("Bad filter expression, at: " + expression[pos:])
+        pos = match.end()
+
+        if match.group('number') is not None:
+            number = match.group('number')
+            params.append(float(number) if re.search(r"[.eE]", number) else int(number))
+            sql.append("?")
+        elif match.group('string') is not None:
+            params.append(match.group('string')[1:-1])
+            sql.append("?")
+        elif match.group('word') is not None:
+            word = match.group('word').lower()
+            if word in KEYWORDS:
+                sql.append(word.upper())
+            elif word in COLUMN_NAMES:
+                sql.append(word)
+            else:
+                raise ValueError("Unknown column in filter expression: " + match.group('word'))
+        else:
+            sql.append(OPERATORS[match.group('operator')])
+
+    if not sql:
+        raise ValueError("Empty filter expression")
+
+    return " ".join(sql), params
+
+
+def archive_stamp(zip_name):
+    """
+    :param zip_name: The path to a ZIP file
+    :return: A tuple of (absolute path, size, modification time), which changes whenever the file does
+    """
+    st = os.stat(zip_name)
+    return os.path.abspath(zip_name), st.st_size, st.st_mtime
+
+
+def dsc_values(dsc):
+    """
+    :param dsc: A DscFile, or None if the frame doesn't have a valid one
+    :return: A list of the frame's values for each of COLUMNS
+    """
+    if dsc is None:
+        return [None] * len(COLUMNS)
+    return [getattr(dsc, getter)() for name, kind, getter in COLUMNS]
+
+
+class DscIndex(object):
+    """
+    An SQLite index of the DSC metadata of the frames in any number of archives.
+    """
+
+    def __init__(self, path=DEFAULT_INDEX):
+        """
+        Open (or create) an index.
+
+        :param path: The path to the SQLite file (or ":memory:" for an index that's thrown away afterwards)
+        """
+        self.path = path
+        self.db = sqlite3.connect(path)
+
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            self.db.execute("DROP TABLE IF EXISTS frames")
+            self.db.execute("DROP TABLE IF EXISTS archives")
+            self.db.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+
+        # Frames are keyed on their full member name, as frames in different folders of an archive can share a name
+        columns = ", ".join("%s %s" % (name, kind) for name, kind, getter in COLUMNS)
+        self.db.execute("CREATE TABLE IF NOT EXISTS archives (archive TEXT PRIMARY KEY, size INTEGER, mtime REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS frames (archive TEXT, frame TEXT, xyc_name TEXT, dsc_name TEXT, "
+                        "%s, PRIMARY KEY (archive, xyc_name))" % columns)
+        for name in INDEXED_COLUMNS:
+            self.db.execute("CREATE INDEX IF NOT EXISTS frames_%s ON frames (archive, %s)" % (name, name))
+        self.db.commit()
+
+    def add_archive(self, zip_name, force=False):
+        """
+        Index the DSC files of an archive, unless it's already indexed and hasn't changed since.
+
+        :param zip_name: The path to the ZIP file
+        :param force: Index the archive again even if it hasn't changed
+        :return: The number of frames indexed (0 if the index was already up to date)
+        """
+        archive_path, size, mtime = archive_stamp(zip_name)
+
+        row = self.db.execute("SELECT size, mtime FROM archives WHERE archive = ?", (archive_path,)).fetchone()
+        if row is not None and tuple(row) == (size, mtime) and not force:
+            return 0
+
+        rows = []
+        archive = zipfile.ZipFile(zip_name, 'r')
+        try:
+            for file, xyc_name, dsc_name in list_members(archive):
+                dsc = None
+                if dsc_name is not None:
+                    try:
+                        dsc = dscreader.DscFile(dsc_name, archive.read(dsc_name).decode("latin-1"), lazy=True)
+                    except IOError:
+                        dsc = None
+                rows.append([archive_path, file, xyc_name, dsc_name] + dsc_values(dsc))
+        finally:
+            archive.close()
+
+        with self.db:
+            self.db.execute("DELETE FROM frames WHERE archive = ?", (archive_path,))
+            self.db.executemany("INSERT INTO frames VALUES (%s)" % ", ".join(["?"] * (len(COLUMNS) + 4)), rows)
+            self.db.execute("INSERT OR REPLACE INTO archives VALUES (?, ?, ?)", (archive_path, size, mtime))
+
+        return len(rows)
+
+    def select(self, zip_name, expression=None):
+        """
+        Find the frames in an archive that match a filter expression. The archive must have been indexed.
+
+        :param zip_name: The path to the ZIP file
+        :param expression: The filter expression, or None for every frame
+        :return: A list of (frame name, XYC member name, DSC member name or None) tuples, sorted by frame name, in the
+        same form as framearchive.list_members
+        """
+        sql = "SELECT frame, xyc_name, dsc_name FROM frames WHERE archive = ?"
+        params = [os.path.abspath(zip_name)]
+
+        if expression is not None:
+            condition, condition_params = compile_filter(expression)
+            sql += " AND (" + condition + ")"
+            params.extend(condition_params)
+
+        try:
+            return [tuple(row) for row in self.db.execute(sql + " ORDER BY frame, xyc_name", params)]
+        except sqlite3.OperationalError as e:
+            raise ValueError("Bad filter expression: %s (%s)" % (expression, e))
+
+    def close(self):
+        """
+        Close the index.
+        """
+        self.db.close()
+
+
+def filter_frames(zip_names, expression, index_path=DEFAULT_INDEX):
+    """
+    Find the frames matching a filter expression in some archives, indexing them first if need be.
+
+    :param zip_names: The paths to the ZIP files
+    :param expression: The filter expression
+    :param index_path: The path to the index
+    :return: A dict of {ZIP file path, as given: set of the XYC member names of its matching frames}
+    """
+    index = DscIndex(index_path)
+    try:
+        frames = {}
+        for zip_name in zip_names:
+            index.add_archive(zip_name)
+            frames[zip_name] = set(xyc_name for frame, xyc_name, dsc_name in index.select(zip_name, expression))
+        return frames
+    finally:
+        index.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Index the DSC files of ZIP archives, and list the frames matching a '
+                                                 'filter expression.')
+
+    parser.add_argument('user_zip', metavar='user_zip', type=str, nargs='+',
+                        help='the ZIP files to index.')
+
+    parser.add_argument('--filter', metavar='expression', type=str, default=None,
+                        help='list the frames matching this expression, eg "chip_id = \'B06-W0212\' and '
+                             'bias_voltage >= 20".')
+
+    parser.add_argument('--index', metavar='index_file', type=str, default=DEFAULT_INDEX,
+                        help='the index file (default: %s).' % DEFAULT_INDEX)
+
+    parser.add_argument('--force', action='store_true',
+                        help='index the archives again even if they haven\'t changed.')
+
+    args = parser.parse_args()
+
+    index = DscIndex(args.index)
+    try:
+        for zip_name in args.user_zip:
+            print("%s: indexed %d frames" % (zip_name, index.add_archive(zip_name, args.force)))
+
+        if args.filter is not None:
+            for zip_name in args.user_zip:
+                for frame, xyc_name, dsc_name in index.select(zip_name, args.filter):
+                    print(frame)
+    finally:
+        index.close()
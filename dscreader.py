@@ -3,6 +3,7 @@ Wrapper class and helper methods for the Timepix DSC files. This file is primari
 been modified by Will Furnell for just getting values from the DSC files (removing non relevant parts and includes).
 """
 
+import math
 import time
 import re
 
@@ -59,14 +60,14 @@ TPX_CLOCK_VALS = {
 Handler methods for various parts of the Timepix datafiles.
 """
 
+## The regex for the chipboard ID, compiled once rather than for every file.
+CHIP_ID_RE = re.compile(r'[A-Z]\d{2,2}-[A-Z]\d{4,4}')
+
 
 def isChipIdValid(chipid):
     """ Does the chip ID conform to the UVV-XYYYY format? """
 
-    # regex match for the chipboard ID.
-    r = re.compile(r'[A-Z]\d{2,2}-[A-Z]\d{4,4}')
-
-    if r.match(chipid) is not None:
+    if CHIP_ID_RE.match(chipid) is not None:
         return True
     else:
         return False
@@ -91,18 +92,48 @@ def getPixelmanTimeString(st):
 
     return sec, sub, sts
 
+
+def getHeaderName(l):
+    """
+    Get the name of a DSC header line, ie the first quoted string, in lower case.
+    Lines which aren't headers give None.
+    """
+
+    l = l.lstrip()
+
+    if l[:1] != '"':
+        return None
+
+    return l.split('"', 2)[1].lower()
+
 """
 The actual parsing code is HERE!
 """
 
 
-class DscFile:
+class DscFile(object):
     """
     A wrapper class for the Pixelman DSC files.
+
+    The file is read in a single pass, looking up each header line in a table of handlers rather than checking it
+    against every known header. If lazy is set, rarely used values (the DACs and the start time string) are only
+    decoded when they're first asked for.
     """
 
-    def __init__(self, dscfilename):
-        """ The constructor. """
+    __slots__ = ('__fWidth', '__fHeight', '__acqMode', '__acqTime', '__chipid', '__dacs', '__dacsRaw',
+                 '__firmwarev', '__hv', '__hwTimerMode', '__interface', '__mpxClock', '__mpxType', '__pixelmanv',
+                 '__polarity', '__startTime', '__startTimeS', '__tpxClock', '__nameAndSN', '__dscfilename',
+                 '__datafilename', '__content', '__lazy')
+
+    def __init__(self, dscfilename, content=None, lazy=False):
+        """
+        The constructor.
+
+        :param dscfilename: The path of the DSC file
+        :param content: The text of the DSC file, if it has already been read (eg from a ZIP archive). When given,
+        dscfilename is only used for naming and the file isn't opened.
+        :param lazy: Only decode the DACs and start time string when they're asked for
+        """
 
         ## The frame width.
         self.__fWidth = None
@@ -122,6 +153,9 @@ class DscFile:
         ## The DAC values.
         self.__dacs = None
 
+        ## The DAC values as they appear in the file, before being decoded.
+        self.__dacsRaw = None
+
         ## The firmware version.
         self.__firmwarev = None
 
@@ -158,14 +192,17 @@ class DscFile:
         ## The name and serial number.
         self.__nameAndSN = None
 
-        # BiasLVDS defined here as it breaks if not defined in the file
-        self.__BiasLVDS = None
-
         ## The DSC file name.
         self.__dscfilename = dscfilename
 
         self.__datafilename = dscfilename[:-4]
 
+        ## The DSC file contents, if they were passed in.
+        self.__content = content
+
+        ## Whether to decode rarely used values lazily.
+        self.__lazy = lazy
+
         # Process the DSC file.
         self.processDscFile()
 
@@ -194,6 +231,8 @@ class DscFile:
         return self.__chipid
 
     def getDACs(self):
+        if self.__dacs is None and self.__dacsRaw is not None:
+            self.__decodeDACs()
         return self.__dacs
 
     def getFirmwareVersion(self):
@@ -202,47 +241,54 @@ class DscFile:
     def getBiasVoltage(self):
         return self.__hv
 
+    def __getDAC(self, index):
+        """ Get a single DAC value, or None if the file didn't have any. """
+        dacs = self.getDACs()
+        if dacs is None:
+            return None
+        return dacs[index]
+
     def getIKrum(self):
-        return self.__IKrum
+        return self.__getDAC(0)
 
     def getDisc(self):
-        return self.__Disc
+        return self.__getDAC(1)
 
     def getPreamp(self):
-        return self.__Preamp
+        return self.__getDAC(2)
 
     def getBuffAnalogA(self):
-        return self.__BuffAnalogA
+        return self.__getDAC(3)
 
     def getBuffAnalogB(self):
-        return self.__BuffAnalogB
+        return self.__getDAC(4)
 
     def getHist(self):
-        return self.__Hist
+        return self.__getDAC(5)
 
     def getTHL(self):
-        return self.__THL
+        return self.__getDAC(6)
 
     def getTHLCoarse(self):
-        return self.__THLCoarse
+        return self.__getDAC(7)
 
     def getVcas(self):
-        return self.__Vcas
+        return self.__getDAC(8)
 
     def getFBK(self):
-        return self.__FBK
+        return self.__getDAC(9)
 
     def getGND(self):
-        return self.__GND
+        return self.__getDAC(10)
 
     def getTHS(self):
-        return self.__THS
+        return self.__getDAC(11)
 
     def getBiasLVDS(self):
-        return self.__BiasLVDS
+        return self.__getDAC(12)
 
     def getRefLVDS(self):
-        return self.__RefLVDS
+        return self.__getDAC(13)
 
     def getHwTimerMode(self):
         return self.__hwTimerMode
@@ -266,6 +312,9 @@ class DscFile:
         return self.__startTime
 
     def getStartTimeS(self):
+        if self.__startTimeS is None and self.__startTime is not None:
+            sec, sub, sts = getPixelmanTimeString(self.__startTime)
+            self.__startTimeS = sts
         return self.__startTimeS
 
     def getTpxClock(self):
@@ -274,166 +323,223 @@ class DscFile:
     def getNameAndSerialNumber(self):
         return self.__nameAndSN
 
+    def __decodeDACs(self):
+        """ Break down the DAC string. """
+        try:
+            self.__dacs = [int(x) for x in self.__dacsRaw.split(" ")]
+        except ValueError:
+            raise IOError("BAD_DACS")
+
+    """
+    Handlers for each of the headers in the DSC file. Each one is given the lines of the file and the index of the
+    header line - the value is two lines below it, with its type in between.
+    """
 
-    def processDscFile(self):
-        """ Process the detector settings file (.dsc). """
+    def __handleAcqMode(self, ls, i):
+        try:
+            self.__acqMode = int(ls[i+2].strip())
+        except ValueError:
+            raise IOError("BAD_ACQ_MODE")
+
+    def __handleAcqTime(self, ls, i):
+        try:
+            self.__acqTime = float(ls[i+2].strip())
+        except ValueError:
+            raise IOError("BAD_ACQ_TIME")
+
+    def __handleChipId(self, ls, i):
+        chipid = ls[i+2].strip()
+        if not isChipIdValid(chipid):
+            raise IOError("Invalid chip ID in the DSC file.")
+        self.__chipid = chipid
+
+    def __handleDACs(self, ls, i):
+        self.__dacsRaw = ls[i+2].strip()
+        self.__dacs = None
+        if not self.__lazy:
+            self.__decodeDACs()
 
-        # The DSC file.
-        f = open(self.__dscfilename, "r")
+    def __handleFirmware(self, ls, i):
+        self.__firmwarev = ls[i+2].strip()
 
-        ## The lines of the DSC file.
-        ls = f.readlines()
+    def __handleBiasVoltage(self, ls, i):
+        try:
+            hv = float(ls[i+2].strip())
+        except ValueError:
+            raise IOError("BAD_HV_VALUE")
 
-        # Close the DSC file.
-        f.close()
+        if hv < 0.0 or hv > 100.0:
+            raise IOError("BAD_HV_VALUE")
 
-        # The frame width and height.
-        whvals = ls[2].strip().split(" ")
+        self.__hv = hv
 
+    def __handleHwTimer(self, ls, i):
         try:
-            self.__fWidth = int(whvals[2].split("=")[1])
-        except TypeError:
-            raise IOError("BAD_WIDTH")
+            self.__hwTimerMode = int(ls[i+2].strip())
+        except ValueError:
+            raise IOError("BAD_HW_TIMER_MODE")
 
-        if self.__fWidth < 256 or self.__fWidth > 1024:
-            raise IOError("BAD_WIDTH")
+    def __handleInterface(self, ls, i):
+        self.__interface = ls[i+2].strip()
 
+    def __handleMpxClock(self, ls, i):
         try:
-            self.__fHeight = int(whvals[3].split("=")[1])
-        except TypeError:
-            raise IOError("BAD_HEIGHT")
+            mpxClock = float(ls[i+2].strip())
+        except ValueError:
+            raise IOError("BAD_MPX_CLOCK")
+        self.__mpxClock = mpxClock
 
-        if self.__fHeight < 256 or self.__fHeight > 1024:
-            raise IOError("BAD_HEIGHT")
+    def __handleMpxType(self, ls, i):
+        try:
+            mpxType = int(ls[i+2].strip())
+        except ValueError:
+            raise IOError("BAD_MPX_TYPE")
+        if mpxType not in [1,2,3]:
+            raise IOError("BAD_MPX_TYPE")
+        self.__mpxType = mpxType
 
+    def __handlePixelmanVersion(self, ls, i):
+        self.__pixelmanv = ls[i+2].strip()
 
-        # Loop over the lines of the DSC file.
-        for i, l in enumerate(ls):
-            #print("%5d: %s" % (i, l.strip()))
+    def __handlePolarity(self, ls, i):
+        try:
+            pol = int(ls[i+2].strip())
+        except ValueError:
+            raise IOError("BAD_POLARITY")
+        if pol not in [0,1]:
+            raise IOError("BAD_POLARITY")
+        self.__polarity = pol
+
+    def __handleStartTime(self, ls, i):
+        try:
+            ## The full start time.
+            st = float(ls[i+2].strip())
 
-            # Acquisition mode.
-            if DSC_ACQ_MODE_STRING in l:
-                try:
-                    self.__acqMode = int(ls[i+2].strip())
-                except ValueError:
-                    raise IOError("BAD_ACQ_MODE")
+        except ValueError:
+            raise IOError("BAD_START_TIME")
 
-            elif DSC_ACQ_TIME_STRING in l:
-                try:
-                    self.__acqTime = float(ls[i+2].strip())
-                except ValueError:
-                    raise IOError("BAD_ACQ_TIME")
-
-            elif DSC_CHIPID_STRING in l:
-
-                chipid = ls[i+2].strip()
-                if not isChipIdValid(chipid):
-                    raise IOError("Invalid chip ID in the DSC file.")
-                self.__chipid = chipid
-
-            elif DSC_DACS_STRING in l:
-
-                # Break down the DAC string.
-                self.__dacs = [int(x) for x in ls[i+2].strip().split(" ")]
-
-                self.__IKrum       = self.__dacs[0]
-                self.__Disc        = self.__dacs[1]
-                self.__Preamp      = self.__dacs[2]
-                self.__BuffAnalogA = self.__dacs[3]
-                self.__BuffAnalogB = self.__dacs[4]
-                self.__Hist        = self.__dacs[5]
-                self.__THL         = self.__dacs[6]
-                self.__THLCoarse   = self.__dacs[7]
-                self.__Vcas        = self.__dacs[8]
-                self.__FBK         = self.__dacs[9]
-                self.__GND         = self.__dacs[10]
-                self.__THS         = self.__dacs[11]
-                self.__BiasLVDS    = self.__dacs[12]
-                self.__RefLVDS     = self.__dacs[13]
-
-
-            elif DSC_FIRMWARE_STRING in l:
-                self.__firmwarev = ls[i+2].strip()
-
-            # Note - needs 'lower()' because of a 2.1.1/2.2.2 mismatch...
-            elif DSC_BIAS_VOLTAGE_STRING.lower() in l.lower():
-                try:
-                    hv = float(ls[i+2].strip())
-                except ValueError:
-                    raise IOError("BAD_HV_VALUE")
+        # It has to be a real time to turn into a time string
+        if math.isinf(st) or math.isnan(st):
+            raise IOError("BAD_START_TIME")
 
-                if hv < 0.0 or hv > 100.0:
-                    raise IOError("BAD_HV_VALUE")
+        self.__startTime = st
 
-                self.__hv = hv
+        self.__startTimeS = None
+        if not self.__lazy:
+            sec, sub, sts = getPixelmanTimeString(st)
+            self.__startTimeS = sts
+
+    def __handleTpxClock(self, ls, i):
+        if "byte[1]" in ls[i+1]:
+            try:
+                val = int(ls[i+2].strip())
+            except ValueError:
+                raise IOError("BAD_TPX_CLOCK_MODE")
+
+            if val not in [0,1,2,3]:
+                raise IOError("BAD_TPX_CLOCK_MODE")
+
+            self.__tpxClock = TPX_CLOCK_VALS[val]
+
+        elif "double[1]" in ls[i+1]:
+            try:
+                self.__tpxClock = float(ls[i+2].strip())
+            except ValueError:
+                raise IOError("BAD_TPX_CLOCK")
+        else:
+            raise IOError("BAD_TPX_CLOCK")
+
+    def __handleNameAndSN(self, ls, i):
+        self.__nameAndSN = ls[i+2].strip()
+
+    ## The handler for each header, keyed by its (lower case) name.
+    HANDLERS = {
+        getHeaderName(DSC_ACQ_MODE_STRING): __handleAcqMode,
+        getHeaderName(DSC_ACQ_TIME_STRING): __handleAcqTime,
+        getHeaderName(DSC_CHIPID_STRING): __handleChipId,
+        getHeaderName(DSC_DACS_STRING): __handleDACs,
+        getHeaderName(DSC_FIRMWARE_STRING): __handleFirmware,
+        getHeaderName(DSC_BIAS_VOLTAGE_STRING): __handleBiasVoltage,
+        getHeaderName(DSC_HW_TIMER_STRING): __handleHwTimer,
+        getHeaderName(DSC_INTERFACE_STRING): __handleInterface,
+        getHeaderName(DSC_MPX_CLOCK_STRING): __handleMpxClock,
+        getHeaderName(DSC_MPX_TYPE_STRING): __handleMpxType,
+        getHeaderName(DSC_PIXELMAN_VERSION_STRING): __handlePixelmanVersion,
+        getHeaderName(DSC_POLARITY_STRING): __handlePolarity,
+        getHeaderName(DSC_START_TIME_STRING): __handleStartTime,
+        getHeaderName('"' + DSC_TPX_CLOCK_STRING + '"'): __handleTpxClock,
+        getHeaderName(DSC_NAME_SN_STRING): __handleNameAndSN,
+    }
 
-            elif DSC_HW_TIMER_STRING in l:
-                try:
-                    self.__hwTimerMode = int(ls[i+2].strip())
-                except ValueError:
-                    raise IOError("BAD_HW_TIMER_MODE")
+    def processDscFile(self):
+        """ Process the detector settings file (.dsc). """
 
-            elif DSC_INTERFACE_STRING in l:
-                self.__interface = ls[i+2].strip()
+        if self.__content is not None:
+            ## The lines of the DSC file.
+            ls = self.__content.splitlines()
+        else:
+            # The DSC file.
+            f = open(self.__dscfilename, "r")
 
-            elif DSC_MPX_CLOCK_STRING in l:
-                try:
-                    mpxClock = float(ls[i+2].strip())
-                except ValueError:
-                    raise IOError("BAD_MPX_CLOCK")
-                self.__mpxClock = mpxClock
+            ## The lines of the DSC file.
+            ls = f.read().splitlines()
 
-            elif DSC_MPX_TYPE_STRING in l:
-                try:
-                    mpxType = int(ls[i+2].strip())
-                except ValueError:
-                    raise IOError("BAD_MPX_TYPE")
-                if mpxType not in [1,2,3]:
-                    raise IOError("BAD_MPX_TYPE")
-                self.__mpxType = mpxType
+            # Close the DSC file.
+            f.close()
 
-            elif DSC_PIXELMAN_VERSION_STRING in l:
-                self.__pixelmanv = ls[i+2].strip()
+        # A DSC file has at least an ID line, a frame line and the frame's type line.
+        if len(ls) < 3:
+            raise IOError("TRUNCATED_DSC_FILE")
 
-            elif DSC_POLARITY_STRING in l:
-                try:
-                    pol = int(ls[i+2].strip())
-                except ValueError:
-                    raise IOError("BAD_POLARITY")
-                if pol not in [0,1]:
-                    raise IOError("BAD_POLARITY")
-                self.__polarity = pol
+        # The frame width and height.
+        whvals = ls[2].strip().split(" ")
 
-            elif DSC_START_TIME_STRING in l:
+        try:
+            self.__fWidth = int(whvals[2].split("=")[1])
+        except (IndexError, TypeError, ValueError):
+            raise IOError("BAD_WIDTH")
 
-                try:
-                    ## The full start time.
-                    st = float(ls[i+2].strip())
+        if self.__fWidth < 256 or self.__fWidth > 1024:
+            raise IOError("BAD_WIDTH")
 
-                    self.__startTime = st
+        try:
+            self.__fHeight = int(whvals[3].split("=")[1])
+        except (IndexError, TypeError, ValueError):
+            raise IOError("BAD_HEIGHT")
 
-                except:
-                    raise IOError("BAD_START_TIME")
+        if self.__fHeight < 256 or self.__fHeight > 1024:
+            raise IOError("BAD_HEIGHT")
 
-                sec, sub, sts = getPixelmanTimeString(st)
+        handlers = self.HANDLERS
+
+        # Loop over the lines of the DSC file, once.
+        for i, l in enumerate(ls):
 
-                self.__startTimeS = sts
+            handler = handlers.get(getHeaderName(l))
 
-            elif DSC_TPX_CLOCK_STRING.lower() in l.lower():
+            if handler is not None:
+                try:
+                    handler(self, ls, i)
+                except IndexError:
+                    # The file ends before the header's type or value line.
+                    raise IOError("TRUNCATED_DSC_FILE")
 
-                if "byte[1]" in ls[i+1].strip():
 
-                    val = int(ls[i+2].strip())
+def parse_many(dscfilenames, lazy=True):
+    """
+    Parse the DSC files for a whole dataset.
 
-                    if val not in [0,1,2,3]:
-                        raise("BAD_TPX_CLOCK_MODE")
+    :param dscfilenames: An iterable of paths to DSC files
+    :param lazy: Only decode the DACs and start time strings when they're asked for
+    :return: A list with a DscFile for each path, in the same order. Files which fail validation give None.
+    """
 
-                    self.__tpxClock = TPX_CLOCK_VALS[val]
+    dscs = []
 
-                elif "double[1]" in ls[i+1].strip():
-                    self.__tpxClock = float(ls[i+2].strip())
-                else:
-                    raise IOError("BAD_TPX_CLOCK")
+    for dscfilename in dscfilenames:
+        try:
+            dscs.append(DscFile(dscfilename, lazy=lazy))
+        except IOError:
+            dscs.append(None)
 
-            elif DSC_NAME_SN_STRING in l:
-                self.__nameAndSN = ls[i+2].strip()
+    return dscs
@@ -0,0 +1,162 @@
+"""
+
+grid-analysis framearchive.py
+
+Helpers for ZIP archives of XYC frames and their DSC files: pairing frames up with their DSC files, and sharding an
+archive into smaller ones so it can be analysed by many subjobs at once.
+
+This only needs the standard library, so it can be used both when submitting jobs and when analysing them.
+
+"""
+# Makes it easy to convert between Python 2 and Python 3
+from __future__ import print_function
+
+import bisect
+
+import os
+
+import posixpath
+
+import zipfile
+
+
+def list_members(archive):
+    """
+    Pair each XYC frame in a ZIP archive with its DSC file, without extracting anything.
+
+    :param archive: An open ZipFile
+    :return: A list of (frame name, XYC member name, DSC member name or None) tuples, sorted by frame name
+    """
+    names = [name for name in archive.namelist() if not name.endswith("/")]
+    dscs = set(name for name in names if name.endswith(".dsc"))
+
+    members = []
+
+    for name in names:
+        # We don't want to add DSC files to the list, they can't be read by the xyc reader!
+        if not name.endswith(".dsc"):
+            dsc = name + ".dsc"
+            members.append((posixpath.basename(name), name, dsc if dsc in dscs else None))
+
+    members.sort()
+    return members
+
+
+def split_by_count(members, frames_per_shard):
+    """
+    Split a list of members into shards of (at most) a fixed number of frames.
+
+    :param members: A list of members from list_members
+    :param frames_per_shard: The number of frames in each shard
+    :return: A list of lists of members
+    """
+    return [members[i:i + frames_per_shard] for i in range(0, len(members), frames_per_shard)]
+
+
+def split_balanced(archive, members, shards):
+    """
+    Split a list of members into a number of shards with about the same amount of XYC data in each, as that's what
+    the analysis time depends on. Frames stay in order, so each shard is a run of the sorted list.
+
+    :param archive: The open ZipFile the members are from
+    :param members: A list of members from list_members
+    :param shards: The number of shards to split into
+    :return: A list of lists of members, with no empty shards
+    """
+    if not members:
+        return []
+
+    shards = max(1, min(shards, len(members)))
+
+    # The amount of XYC data before each frame
+    before = []
+    done = 0
+    for file, xyc_name, dsc_name in members:
+        before.append(done)
+        done += archive.getinfo(xyc_name).file_size
+
+    bounds = [0]
+    for k in range(1, shards):
+        # Start the next shard at the first frame past its share of the data, but keep at least one frame in this
+        # shard and in every shard still to come
+        start = bisect.bisect_left(before, done * k / float(shards))
+        start = max(start, bounds[-1] + 1)
+        start = min(start, len(members) - (shards - k))
+        bounds.append(start)
+    bounds.append(len(members))
+
+    return [members[bounds[k]:bounds[k + 1]] for k in range(shards)]
+
+
+def write_members(archive, members, path):
+    """
+    Write some members of an archive out as a ZIP file of their own, with their XYC files and their DSC files.
+
+    :param archive: The open ZipFile the members are from
+    :param members: A list of members from list_members
+    :param path: The path of the ZIP file to write
+    """
+    out = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+    try:
+        for file, xyc_name, dsc_name in members:
+            for name in (xyc_name, dsc_name):
+                if name is not None:
+                    # Passing the ZipInfo keeps the original name, date and compression
+                    out.writestr(archive.getinfo(name), archive.read(name))
+    finally:
+        out.close()
+
+
+def write_shards(zip_name, shards, out_dir=None):
+    """
+    Write each shard of an archive out as its own ZIP file, with its XYC files and their DSC files.
+
+    :param zip_name: The path to the original ZIP file
+    :param shards: A list of lists of members, from split_by_count or split_balanced
+    :param out_dir: The folder to write the shards to (defaults to <zip_name>.shards)
+    :return: A list of the paths of the new ZIP files
+    """
+    if out_dir is None:
+        out_dir = zip_name + ".shards"
+
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    base = os.path.splitext(os.path.basename(zip_name))[0]
+
+    archive = zipfile.ZipFile(zip_name, 'r')
+    paths = []
+
+    try:
+        for i, shard in enumerate(shards):
+            path = os.path.join(out_dir, "%s_part%04d.zip" % (base, i))
+            write_members(archive, shard, path)
+            paths.append(path)
+    finally:
+        archive.close()
+
+    return paths
+
+
+def shard_archive(zip_name, frames_per_shard=None, shards=None, out_dir=None):
+    """
+    Shard an archive into smaller ZIP files, either with a fixed number of frames in each or into a fixed number of
+    shards balanced by the amount of XYC data.
+
+    :param zip_name: The path to the ZIP file
+    :param frames_per_shard: The number of frames in each shard
+    :param shards: The number of shards, used if frames_per_shard isn't given
+    :param out_dir: The folder to write the shards to (defaults to <zip_name>.shards)
+    :return: A list of the paths of the new ZIP files
+    """
+    archive = zipfile.ZipFile(zip_name, 'r')
+    try:
+        members = list_members(archive)
+        if frames_per_shard is not None:
+            split = split_by_count(members, frames_per_shard)
+        else:
+            split = split_balanced(archive, members, shards)
+    finally:
+        archive.close()
+
+    return write_shards(zip_name, split, out_dir)
@@ -0,0 +1,331 @@
+"""
+
+grid-analysis framepack.py
+
+Packs a ZIP archive of XYC frames and DSC files into a single binary container, so the same data can be analysed
+again and again (eg while tuning the classification) without parsing any text.
+
+A pack file is laid out as:
+
+    MAGIC
+    pixel records     every frame's hit pixels as (x, y, C) records, one frame after another
+    offsets           int64, frame i's pixels are records offsets[i]:offsets[i + 1]
+    table             a fixed width record per frame: its name and its decoded DSC metadata (see table_dtype)
+    trailer           uint64 positions of the offsets and table, the number of frames and the widths of the name and
+                      chip ID fields, then MAGIC again
+
+Since the index and table are written after the pixels, packing streams through the archive a frame at a time. The
+file is read through a memory map and nothing in it is parsed, so opening it is instant however many frames it has:
+each frame's pixels and table record are zero-copy slices of it, and only the values a frame needs are converted.
+
+"""
+# Makes it easy to convert between Python 2 and Python 3
+from __future__ import print_function
+
+import argparse
+
+import struct
+
+import zipfile
+
+import numpy
+
+import dscreader
+
+import xycarray
+
+from framearchive import list_members
+
+MAGIC = b"GAFPACK2"
+
+PACK_SUFFIX = ".fpack"
+
+# Each hit pixel, as stored in the pack
+PIXEL_DTYPE = numpy.dtype([('x', '<u2'), ('y', '<u2'), ('c', '<i4')])
+
+OFFSET_DTYPE = numpy.dtype('<i8')
+
+TRAILER = struct.Struct("<QQQQQ8s")
+
+# The DSC values kept in the table, the DscFile getters they come from, and how they're stored ('S' fields are
+# sized to fit the longest value in the pack)
+DSC_COLUMNS = [
+    ('width', 'getFrameWidth', '<i4'),
+    ('height', 'getFrameHeight', '<i4'),
+    ('start_time', 'getStartTime', '<f8'),
+    ('chip_id', 'getChipId', 'S'),
+    ('bias_voltage', 'getBiasVoltage', '<f8'),
+    ('acq_time', 'getAcqTime', '<f8'),
+]
+
+
+def table_dtype(name_width, chip_width):
+    """
+    :param name_width: The length of the longest frame name, in bytes
+    :param chip_width: The length of the longest chip ID, in bytes
+    :return: The dtype of a table record. Besides the DSC values, 'has_dsc' is whether the frame has a (valid) DSC
+    file and bit i of 'known' is set if the DSC file has a value for DSC_COLUMNS[i].
+    """
+    fields = [('name', 'S%d' % max(1, name_width)), ('has_dsc', '?'), ('known', '<u1')]
+    for column, getter, kind in DSC_COLUMNS:
+        fields.append((column, 'S%d' % max(1, chip_width) if kind == 'S' else kind))
+    return numpy.dtype(fields)
+
+
+def encode(value):
+    """
+    :param value: A frame name or chip ID
+    :return: The value as bytes, for an 'S' field of the table
+    """
+    return value.encode("utf-8") if not isinstance(value, bytes) else value
+
+
+def pack_path(zip_name):
+    """
+    :param zip_name: The path to a ZIP file
+    :return: The path of the pack file to go alongside it
+    """
+    if zip_name.endswith(".zip"):
+        zip_name = zip_name[:-4]
+    return zip_name + PACK_SUFFIX
+
+
+def is_pack(path):
+    """
+    :param path: The path to a file
+    :return: Whether the file is a pack file
+    """
+    f = open(path, "rb")
+    try:
+        return f.read(len(MAGIC)) == MAGIC
+    finally:
+        f.close()
+
+
+def pack(zip_name, path=None):
+    """
+    Pack the frames in a ZIP archive into a pack file. Frames whose DSC files are missing or invalid are packed without
+    metadata, just as analyse.py would analyse them.
+
+    :param zip_name: The path to the ZIP file
+    :param path: The path of the pack file to write (defaults to the ZIP path with PACK_SUFFIX)
+    :return: The path of the pack file written
+    """
+    if path is None:
+        path = pack_path(zip_name)
+
+    names = []
+    dscs = []
+    offsets = [0]
+
+    archive = zipfile.ZipFile(zip_name, 'r')
+    out = open(path, "wb")
+    try:
+        out.write(MAGIC)
+
+        for file, xyc_name, dsc_name in list_members(archive):
+            dsc = None
+            if dsc_name is not None:
+                try:
+                    dsc = dscreader.DscFile(dsc_name, archive.read(dsc_name).decode("latin-1"), lazy=True)
+                except IOError:
+                    dsc = None
+
+            x, y, c = xycarray.parse(archive.read(xyc_name))
+            pixels = numpy.empty(len(x), PIXEL_DTYPE)
+            pixels['x'] = x
+            pixels['y'] = y
+            pixels['c'] = c
+            out.write(pixels.tobytes())
+
+            names.append(encode(file))
+            offsets.append(offsets[-1] + len(x))
+            values = None
+            if dsc is not None:
+                values = [getattr(dsc, getter)() for column, getter, kind in DSC_COLUMNS]
+                values = [encode(value) if kind == 'S' and value is not None else value
+                          for value, (column, getter, kind) in zip(values, DSC_COLUMNS)]
+            dscs.append(values)
+
+        offsets_pos = out.tell()
+        out.write(numpy.array(offsets, OFFSET_DTYPE).tobytes())
+
+        name_width = max([len(name) for name in names] + [1])
+        chip_width = max([len(value) for values in dscs if values is not None
+                          for value, (column, getter, kind) in zip(values, DSC_COLUMNS)
+                          if kind == 'S' and value is not None] + [1])
+
+        table = numpy.zeros(len(names), table_dtype(name_width, chip_width))
+        table['name'] = names
+        for i, values in enumerate(dscs):
+            if values is None:
+                continue
+            table['has_dsc'][i] = True
+            for j, (column, getter, kind) in enumerate(DSC_COLUMNS):
+                if values[j] is not None:
+                    table[column][i] = values[j]
+                    table['known'][i] |= 1 << j
+
+        table_pos = out.tell()
+        out.write(table.tobytes())
+        out.write(TRAILER.pack(offsets_pos, table_pos, len(names), name_width, chip_width, MAGIC))
+    finally:
+        out.close()
+        archive.close()
+
+    return path
+
+
+class PackedDsc(object):
+    """
+    A frame's DSC metadata from a pack's table. It has the same getters as DscFile for the values analyse.py uses, so
+    it can be used in its place.
+    """
+
+    __slots__ = ('__values',)
+
+    def __init__(self, values):
+        """
+        :param values: A dict of the frame's values, keyed by the column names in DSC_COLUMNS
+        """
+        self.__values = values
+
+    def __lt__(self, other):
+        return self.getStartTime() < other.getStartTime()
+
+    def getFrameWidth(self):
+        return self.__values['width']
+
+    def getFrameHeight(self):
+        return self.__values['height']
+
+    def getStartTime(self):
+        return self.__values['start_time']
+
+    def getChipId(self):
+        return self.__values['chip_id']
+
+    def getBiasVoltage(self):
+        return self.__values['bias_voltage']
+
+    def getAcqTime(self):
+        return self.__values['acq_time']
+
+
+class FramePack(object):
+    """
+    A pack file, opened through a memory map.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: The path to the pack file
+        """
+        self.path = path
+        self.data = numpy.memmap(path, numpy.uint8, mode='r')
+
+        if len(self.data) < len(MAGIC) + TRAILER.size or self.data[:len(MAGIC)].tobytes() != MAGIC:
+            raise IOError("BAD_PACK_FILE")
+
+        offsets_pos, table_pos, frames, name_width, chip_width, magic = TRAILER.unpack(
+            self.data[-TRAILER.size:].tobytes())
+        if magic != MAGIC:
+            # The trailer is written last, so the pack was never finished
+            raise IOError("BAD_PACK_FILE")
+
+        dtype = table_dtype(name_width, chip_width)
+        self.table = self.data[table_pos:table_pos + frames * dtype.itemsize].view(dtype)
+        self.offsets = self.data[offsets_pos:table_pos].view(OFFSET_DTYPE)
+        self.pixels = self.data[len(MAGIC):offsets_pos].view(PIXEL_DTYPE)
+
+        self.__names = None
+        self.__index = None
+
+    def __len__(self):
+        return len(self.table)
+
+    def name(self, i):
+        """
+        :param i: The position of a frame in the pack
+        :return: The frame's name
+        """
+        return self.table['name'][i].decode("utf-8")
+
+    @property
+    def names(self):
+        """
+        The names of every frame in the pack, in order. These are only decoded the first time they're asked for.
+        """
+        if self.__names is None:
+            self.__names = [name.decode("utf-8") for name in self.table['name'].tolist()]
+        return self.__names
+
+    def index(self, name):
+        """
+        :param name: The name of a frame
+        :return: The frame's position in the pack
+        """
+        if self.__index is None:
+            self.__index = dict((n, i) for i, n in enumerate(self.names))
+        return self.__index[name]
+
+    def frame_pixels(self, i):
+        """
+        Get a frame's hit pixels, without copying them out of the file.
+
+        :param i: The position of the frame in the pack
+        :return: A tuple of (x, y, C) arrays, one element per hit pixel
+        """
+        pixels = self.pixels[self.offsets[i]:self.offsets[i + 1]]
+        return pixels['x'], pixels['y'], pixels['c']
+
+    def dsc(self, i):
+        """
+        :param i: The position of the frame in the pack
+        :return: The frame's metadata as a PackedDsc, or None if it didn't have a (valid) DSC file
+        """
+        record = self.table[i]
+        if not record['has_dsc']:
+            return None
+
+        values = {}
+        known = int(record['known'])
+        for j, (column, getter, kind) in enumerate(DSC_COLUMNS):
+            value = None
+            if known & (1 << j):
+                value = record[column].decode("utf-8") if kind == 'S' else record[column].item()
+            values[column] = value
+        return PackedDsc(values)
+
+    def frame(self, i):
+        """
+        Get a full frame, laid out the same way as xycarray.to_frame.
+
+        :param i: The position of the frame in the pack
+        :return: A width x height array of counts
+        """
+        dsc = self.dsc(i)
+        if dsc is None:
+            width, height = xycarray.DEFAULT_WIDTH, xycarray.DEFAULT_HEIGHT
+        else:
+            width, height = dsc.getFrameWidth(), dsc.getFrameHeight()
+
+        x, y, c = self.frame_pixels(i)
+        return xycarray.to_frame(x, y, c, width, height)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Pack a ZIP file of XYC and DSC files into a binary pack file, '
+                                                 'which analyse.py can read without parsing any text.')
+
+    parser.add_argument('user_zip', metavar='user_zip', type=str,
+                        help='the ZIP file to pack.')
+
+    parser.add_argument('--output', '-o', metavar='pack_file', type=str, default=None,
+                        help='the pack file to write (default: the ZIP file name ending in ' + PACK_SUFFIX + ').')
+
+    args = parser.parse_args()
+
+    written = pack(args.user_zip, args.output)
+    pack_file = FramePack(written)
+    print("Packed %d frames (%d hit pixels) into %s" % (len(pack_file), len(pack_file.pixels), written))
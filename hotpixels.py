@@ -0,0 +1,315 @@
+"""
+
+grid-analysis hotpixels.py
+
+Masks out hot (noisy) pixels. A pre-pass over the dataset counts, for each chip, how many frames each pixel is hit
+in. Pixels that are hit in more than a threshold fraction of a chip's frames are flagged as hot, and are then dropped
+from every frame from that chip before clustering.
+
+The mask is saved to a file, keyed by chip ID, so it can be reused for later runs of the same detectors without
+doing the pre-pass again.
+
+"""
+# Makes it easy to convert between Python 2 and Python 3
+from __future__ import print_function
+
+import hashlib
+
+import multiprocessing
+
+import zipfile
+
+import numpy
+
+import dscreader
+
+import framepack
+
+import xycarray
+
+from framearchive import list_members
+
+HOT_PIXELS_FILE = "grid-analysis-hotpixels.npz"
+
+# A pixel is hot if it's hit in more than this fraction of its chip's frames
+DEFAULT_THRESHOLD = 0.25
+
+# Chips with fewer frames than this aren't masked at all, as there isn't enough data to tell a hot pixel from a track
+MIN_FRAMES = 20
+
+# How many frames are handed to a worker process at a time
+CHUNK_SIZE = 256
+
+
+def chip_of(dsc):
+    """
+    :param dsc: The DscFile for a frame, or None if it doesn't have one
+    :return: The frame's chip ID, or "" if it's not known
+    """
+    if dsc is None:
+        return ""
+    return dsc.getChipId() or ""
+
+
+class HotPixelMask(object):
+    """
+    The hot pixels of each chip.
+    """
+
+    def __init__(self, masks, frames, threshold):
+        """
+        :param masks: A dict of {chip ID: width x height boolean array, True for hot pixels}
+        :param frames: A dict of {chip ID: the number of frames the mask was worked out from}
+        :param threshold: The fraction of frames a pixel had to be hit in to be hot
+        """
+        self.masks = masks
+        self.frames = frames
+        self.threshold = threshold
+
+        # A short digest of each chip's mask, so cached results from a different mask aren't reused
+        self.versions = {}
+        for chip, mask in masks.items():
+            self.versions[chip] = hashlib.sha1(numpy.packbits(mask).tobytes()).hexdigest()[:12]
+
+    def hot_pixels(self):
+        """
+        :return: The total number of hot pixels across all chips
+        """
+        return sum(int(mask.sum()) for mask in self.masks.values())
+
+    def version(self, chip):
+        """
+        :param chip: A chip ID
+        :return: A string identifying the chip's mask, or None if it doesn't have one
+        """
+        return self.versions.get(chip)
+
+    def apply(self, chip, x, y, c):
+        """
+        Drop a chip's hot pixels from a frame's pixels.
+
+        :param chip: The chip ID of the frame
+        :param x: The x coordinates of the frame's pixels
+        :param y: The y coordinates of the frame's pixels
+        :param c: The counts of the frame's pixels
+        :return: A tuple of (x, y, C) arrays without the hot pixels
+        """
+        mask = self.masks.get(chip)
+        if mask is None or len(x) == 0:
+            return x, y, c
+
+        # Pixels outside the mask are left alone, for the analysis to complain about
+        inside = (x < mask.shape[0]) & (y < mask.shape[1])
+        hot = numpy.zeros(len(x), bool)
+        hot[inside] = mask[x[inside], y[inside]]
+
+        if not hot.any():
+            return x, y, c
+
+        keep = ~hot
+        return x[keep], y[keep], c[keep]
+
+    def save(self, path=HOT_PIXELS_FILE):
+        """
+        Save the mask to a file.
+
+        :param path: The path of the .npz file
+        """
+        chips = sorted(self.masks)
+        hot = [numpy.nonzero(self.masks[chip]) for chip in chips]
+
+        f = open(path, "wb")
+        try:
+            numpy.savez_compressed(
+                f,
+                chips=numpy.array(chips, str),
+                widths=numpy.array([self.masks[chip].shape[0] for chip in chips], numpy.int32),
+                heights=numpy.array([self.masks[chip].shape[1] for chip in chips], numpy.int32),
+                frames=numpy.array([self.frames[chip] for chip in chips], numpy.int64),
+                # The hot pixels of chip i are hot_x[offsets[i]:offsets[i + 1]] (and the same for hot_y)
+                offsets=numpy.concatenate(([0], numpy.cumsum([len(xs) for xs, ys in hot]))).astype(numpy.int64),
+                hot_x=numpy.concatenate([xs for xs, ys in hot] + [numpy.empty(0, numpy.int64)]),
+                hot_y=numpy.concatenate([ys for xs, ys in hot] + [numpy.empty(0, numpy.int64)]),
+                threshold=numpy.array(self.threshold))
+        finally:
+            f.close()
+
+
+def load(path=HOT_PIXELS_FILE):
+    """
+    Load a mask saved by HotPixelMask.save.
+
+    :param path: The path of the .npz file
+    :return: The HotPixelMask
+    """
+    npz = numpy.load(path)
+    try:
+        masks = {}
+        frames = {}
+        offsets = npz['offsets']
+        for i, chip in enumerate(npz['chips'].tolist()):
+            mask = numpy.zeros((npz['widths'][i], npz['heights'][i]), bool)
+            mask[npz['hot_x'][offsets[i]:offsets[i + 1]], npz['hot_y'][offsets[i]:offsets[i + 1]]] = True
+            masks[chip] = mask
+            frames[chip] = int(npz['frames'][i])
+        return HotPixelMask(masks, frames, float(npz['threshold']))
+    finally:
+        npz.close()
+
+
+class Occupancy(object):
+    """
+    How many frames each pixel of each chip is hit in, added up a frame at a time.
+    """
+
+    def __init__(self):
+        # Chip ID -> [width, height, number of frames, list of arrays of hit positions (x * height + y)]
+        self.chips = {}
+
+    def add(self, chip, width, height, x, y, c):
+        """
+        Add a frame.
+
+        :param chip: The chip ID of the frame
+        :param width: The width of the frame
+        :param height: The height of the frame
+        :param x: The x coordinates of the frame's pixels
+        :param y: The y coordinates of the frame's pixels
+        :param c: The counts of the frame's pixels
+        """
+        entry = self.chips.get(chip)
+        if entry is None or (entry[0], entry[1]) != (width, height):
+            # Frames of a different size from the same chip would be odd; start again with the new size
+            entry = self.chips[chip] = [width, height, 0, []]
+
+        x, y, c = xycarray.hit_pixels(x, y, c)
+        inside = (x < width) & (y < height)
+        entry[2] += 1
+        entry[3].append(x[inside].astype(numpy.int64) * height + y[inside])
+
+    def counts(self):
+        """
+        :return: A dict of {chip ID: (number of frames, width x height array of how many frames each pixel is hit in)}
+        """
+        result = {}
+        for chip, (width, height, frames, positions) in self.chips.items():
+            hits = numpy.bincount(numpy.concatenate(positions + [numpy.empty(0, numpy.int64)]),
+                                  minlength=width * height)
+            result[chip] = (frames, hits.reshape(width, height))
+        return result
+
+
+def occupancy_archive_chunk(args):
+    """
+    Work out the occupancy of a chunk of frames from a ZIP archive, in a worker process.
+
+    :param args: A tuple of (path to the ZIP file, list of members from list_members)
+    :return: The chunk's counts, see Occupancy.counts
+    """
+    user_zip, members = args
+    occupancy = Occupancy()
+
+    archive = zipfile.ZipFile(user_zip, 'r')
+    try:
+        for file, xyc_name, dsc_name in members:
+            dsc = None
+            if dsc_name is not None:
+                try:
+                    dsc = dscreader.DscFile(dsc_name, archive.read(dsc_name).decode("latin-1"), lazy=True)
+                except IOError:
+                    dsc = None
+
+            width, height = xycarray.DEFAULT_WIDTH, xycarray.DEFAULT_HEIGHT
+            if dsc is not None:
+                width, height = dsc.getFrameWidth(), dsc.getFrameHeight()
+
+            x, y, c = xycarray.parse(archive.read(xyc_name))
+            occupancy.add(chip_of(dsc), width, height, x, y, c)
+    finally:
+        archive.close()
+
+    return occupancy.counts()
+
+
+def occupancy_pack_chunk(args):
+    """
+    Work out the occupancy of a chunk of frames from a pack file, in a worker process.
+
+    :param args: A tuple of (path to the pack file, list of frame positions)
+    :return: The chunk's counts, see Occupancy.counts
+    """
+    path, indices = args
+    occupancy = Occupancy()
+    pack = framepack.FramePack(path)
+
+    for i in indices:
+        dsc = pack.dsc(i)
+        width, height = xycarray.DEFAULT_WIDTH, xycarray.DEFAULT_HEIGHT
+        if dsc is not None:
+            width, height = dsc.getFrameWidth(), dsc.getFrameHeight()
+
+        x, y, c = pack.frame_pixels(i)
+        occupancy.add(chip_of(dsc), width, height, x, y, c)
+
+    return occupancy.counts()
+
+
+def build(paths, threshold=DEFAULT_THRESHOLD, workers=1, min_frames=MIN_FRAMES):
+    """
+    Do the pre-pass over a dataset, and work out the hot pixels of each chip in it.
+
+    :param paths: The paths to the ZIP files (or pack files) of the dataset
+    :param threshold: A pixel is hot if it's hit in more than this fraction of its chip's frames
+    :param workers: The number of processes to read frames with
+    :param min_frames: Chips with fewer frames than this get no mask
+    :return: The HotPixelMask
+    """
+    archive_chunks = []
+    pack_chunks = []
+
+    for path in paths:
+        if framepack.is_pack(path):
+            n = len(framepack.FramePack(path))
+            pack_chunks.extend((path, list(range(i, min(i + CHUNK_SIZE, n)))) for i in range(0, n, CHUNK_SIZE))
+        else:
+            archive = zipfile.ZipFile(path, 'r')
+            try:
+                members = list_members(archive)
+            finally:
+                archive.close()
+            archive_chunks.extend((path, members[i:i + CHUNK_SIZE]) for i in range(0, len(members), CHUNK_SIZE))
+
+    totals = {}
+
+    def add_up(counts):
+        for chip, (frames, hits) in counts.items():
+            if chip in totals and totals[chip][1].shape == hits.shape:
+                totals[chip][0] += frames
+                totals[chip][1] += hits
+            else:
+                totals[chip] = [frames, hits]
+
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            for counts in pool.imap_unordered(occupancy_archive_chunk, archive_chunks):
+                add_up(counts)
+            for counts in pool.imap_unordered(occupancy_pack_chunk, pack_chunks):
+                add_up(counts)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for chunk in archive_chunks:
+            add_up(occupancy_archive_chunk(chunk))
+        for chunk in pack_chunks:
+            add_up(occupancy_pack_chunk(chunk))
+
+    masks = {}
+    frames = {}
+    for chip, (n, hits) in totals.items():
+        if n >= min_frames:
+            masks[chip] = hits > threshold * n
+            frames[chip] = n
+
+    return HotPixelMask(masks, frames, threshold)
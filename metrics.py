@@ -0,0 +1,173 @@
+"""
+
+grid-analysis metrics.py
+
+Instrumentation for analyse.py: how long each stage (decompression, DSC parsing, frame reading, clustering,
+classification...) takes in total and per frame, which frames were the slowest, and the peak memory use. It's written
+out as a small JSON file next to the CSV file, so a slow grid job can be diagnosed after the fact.
+
+When metrics are switched off, the timers do nothing but return, so they cost next to nothing.
+
+"""
+# Makes it easy to convert between Python 2 and Python 3
+from __future__ import print_function
+
+import heapq
+
+import json
+
+import resource
+
+import time
+
+METRICS_JSON = "grid-analysis-metrics.json"
+
+# How many of the slowest frames to keep
+DEFAULT_SLOWEST = 10
+
+
+class Metrics(object):
+    """
+    Timers for each stage of the analysis, and a record of the slowest frames.
+
+    Use start() and stop() around each stage, and begin_frame() and end_frame() around each frame. Metrics from
+    worker processes are sent back with to_dict() and added up with merge().
+    """
+
+    def __init__(self, enabled=True, slowest=DEFAULT_SLOWEST):
+        """
+        :param enabled: Whether to record anything at all
+        :param slowest: How many of the slowest frames to keep
+        """
+        self.enabled = enabled
+        self.slowest = slowest
+        # Stage name -> [total seconds, number of times, longest time]
+        self.stages = {}
+        # A min-heap of (seconds, frame name, clusters, seconds per stage) for the slowest frames
+        self.frames = []
+        # The seconds per stage of the frame being analysed
+        self.frame = None
+
+    def start(self):
+        """
+        Start timing a stage.
+
+        :return: A token to pass to stop
+        """
+        if not self.enabled:
+            return None
+        return time.time()
+
+    def stop(self, stage, start):
+        """
+        Stop timing a stage.
+
+        :param stage: The name of the stage
+        :param start: The token from start
+        """
+        if start is None:
+            return
+
+        self.add(stage, time.time() - start)
+
+    def add(self, stage, elapsed):
+        """
+        Record time spent in a stage that was timed some other way.
+
+        :param stage: The name of the stage
+        :param elapsed: The time spent, in seconds
+        """
+        if not self.enabled:
+            return
+
+        totals = self.stages.get(stage)
+        if totals is None:
+            totals = self.stages[stage] = [0.0, 0, 0.0]
+        totals[0] += elapsed
+        totals[1] += 1
+        if elapsed > totals[2]:
+            totals[2] = elapsed
+
+        if self.frame is not None:
+            self.frame[stage] = self.frame.get(stage, 0.0) + elapsed
+
+    def begin_frame(self):
+        """
+        Start recording the stages of a frame.
+        """
+        if self.enabled:
+            self.frame = {}
+
+    def end_frame(self, name, clusters):
+        """
+        Finish recording a frame, keeping it if it's one of the slowest.
+
+        :param name: The name of the frame
+        :param clusters: The number of clusters in the frame
+        """
+        if self.frame is None:
+            return
+
+        entry = (sum(self.frame.values()), name, clusters, self.frame)
+        self.frame = None
+
+        if len(self.frames) < self.slowest:
+            heapq.heappush(self.frames, entry)
+        else:
+            heapq.heappushpop(self.frames, entry)
+
+    def merge(self, other):
+        """
+        Add the metrics from another process to these.
+
+        :param other: A dict from to_dict
+        """
+        for stage, (total, count, longest) in other['stages'].items():
+            totals = self.stages.get(stage)
+            if totals is None:
+                totals = self.stages[stage] = [0.0, 0, 0.0]
+            totals[0] += total
+            totals[1] += count
+            totals[2] = max(totals[2], longest)
+
+        for entry in other['frames']:
+            entry = tuple(entry)
+            if len(self.frames) < self.slowest:
+                heapq.heappush(self.frames, entry)
+            else:
+                heapq.heappushpop(self.frames, entry)
+
+    def to_dict(self):
+        """
+        :return: The metrics as a dict which can be pickled or merged
+        """
+        return {'stages': self.stages, 'frames': self.frames}
+
+    def report(self):
+        """
+        Build the report that gets written to the JSON file.
+
+        :return: A dict with the time spent in each stage, the slowest frames and the peak memory use
+        """
+        stages = {}
+        for stage, (total, count, longest) in self.stages.items():
+            stages[stage] = {'total_seconds': total, 'count': count, 'mean_seconds': total / count if count else 0.0,
+                             'max_seconds': longest}
+
+        slowest = [{'frame': name, 'seconds': seconds, 'clusters': clusters, 'stages': breakdown}
+                   for seconds, name, clusters, breakdown in sorted(self.frames, reverse=True)]
+
+        # ru_maxrss is in kilobytes on Linux. The workers only count once they've finished.
+        peak = {'main_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                'workers_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss}
+
+        return {'stages': stages, 'slowest_frames': slowest, 'peak_rss': peak}
+
+    def write(self, path=METRICS_JSON):
+        """
+        Write the report to a JSON file.
+
+        :param path: The path of the JSON file
+        """
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
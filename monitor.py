@@ -0,0 +1,344 @@
+"""
+
+grid-analysis monitor.py
+
+Keeps an eye on many grid-analysis jobs (or subjobs) at once: polls their status with a pool of threads, downloads the
+CSV files of the ones that have finished in parallel (retrying polls and downloads that fail), and merges the partial
+CSV files into a single one ordered by capture time.
+
+The jobs are found through a backend object, so the same code works with Ganga (see run.GangaJobs) or with
+FakeJobs, which keeps everything in memory for trying this out without a grid. A backend has three methods:
+
+    units()                 the ids of every job, or every subjob of a split job, eg "12" or "13.4"
+    status(unit)            the unit's status: 'new', 'submitted', 'running', 'completed', 'failed'...
+    download(unit, path)    copy the unit's CSV file to path, raising an exception if it can't
+
+This only needs the standard library, so it can be used without Ganga.
+
+"""
+# Makes it easy to convert between Python 2 and Python 3
+from __future__ import print_function
+
+import csv
+
+import heapq
+
+import os
+
+import sys
+
+import time
+
+from multiprocessing.pool import ThreadPool
+
+# Jobs submitted by run.py are all named like this
+JOB_PREFIX = "grid-analysis_"
+
+# How many jobs to poll or download at once
+DEFAULT_THREADS = 8
+
+# How many times to try each poll or download, and how long to wait before the first retry (doubling after that), in
+# seconds
+DEFAULT_ATTEMPTS = 3
+DEFAULT_RETRY_DELAY = 2.0
+
+FINISHED = 'completed'
+
+# The status of a job that couldn't be polled
+UNKNOWN = 'unknown'
+
+# The column of the CSV file to order by
+CAPTURE_TIME_COLUMN = 1
+
+
+def open_csv(path, mode):
+    """
+    Open a CSV file the way the csv module wants it: in binary mode on Python 2, and as text with no newline
+    translation on Python 3.
+
+    :param path: The path to the file
+    :param mode: "r" or "w"
+    :return: The open file
+    """
+    if sys.version_info[0] < 3:
+        return open(path, mode + "b")
+    return open(path, mode, newline="")
+
+
+def retry(action, description, attempts=DEFAULT_ATTEMPTS, delay=DEFAULT_RETRY_DELAY):
+    """
+    Run an action, trying again (after a longer wait each time) if it raises an exception.
+
+    :param action: A function taking no arguments
+    :param description: What the action does, for the messages about failed attempts
+    :param attempts: How many times to try
+    :param delay: How long to wait before the first retry, in seconds
+    :return: A tuple of (True, what the action returned), or (False, None) if every attempt failed
+    """
+    for attempt in range(attempts):
+        try:
+            return True, action()
+        except Exception as e:
+            print("%s failed (attempt %d of %d): %s" % (description, attempt + 1, attempts, e))
+            if attempt + 1 < attempts:
+                time.sleep(delay * 2 ** attempt)
+
+    return False, None
+
+
+def poll(backend, threads=DEFAULT_THREADS, attempts=DEFAULT_ATTEMPTS, delay=DEFAULT_RETRY_DELAY):
+    """
+    Get the status of every job at once.
+
+    :param backend: The job backend, eg run.GangaJobs or FakeJobs
+    :param threads: How many jobs to poll at a time
+    :param attempts: How many times to try polling each job
+    :param delay: How long to wait before the first retry, in seconds
+    :return: A dict of {unit: status}, with UNKNOWN for the jobs that couldn't be polled
+    """
+    units = backend.units()
+
+    def status(unit):
+        ok, value = retry(lambda: backend.status(unit), "Polling job %s" % unit, attempts, delay)
+        return value if ok else UNKNOWN
+
+    pool = ThreadPool(max(1, min(threads, len(units))))
+    try:
+        statuses = pool.map(status, units)
+    finally:
+        pool.close()
+        pool.join()
+
+    return dict(zip(units, statuses))
+
+
+def summarise(statuses):
+    """
+    Count how many jobs there are with each status.
+
+    :param statuses: A dict of {unit: status}, from poll
+    :return: A dict of {status: number of jobs}
+    """
+    counts = {}
+    for status in statuses.values():
+        counts[status] = counts.get(status, 0) + 1
+    return counts
+
+
+def download(backend, unit, path, attempts=DEFAULT_ATTEMPTS, delay=DEFAULT_RETRY_DELAY):
+    """
+    Download a job's CSV file, trying again (after a longer wait each time) if it fails.
+
+    :param backend: The job backend
+    :param unit: The id of the job
+    :param path: Where to save the CSV file
+    :param attempts: How many times to try
+    :param delay: How long to wait before the first retry, in seconds
+    :return: A tuple of (unit, path), or (unit, None) if every attempt failed
+    """
+    ok, value = retry(lambda: backend.download(unit, path), "Download of job %s" % unit, attempts, delay)
+    return unit, path if ok else None
+
+
+def retrieve(backend, out_dir, statuses=None, threads=DEFAULT_THREADS, attempts=DEFAULT_ATTEMPTS,
+             delay=DEFAULT_RETRY_DELAY):
+    """
+    Download the CSV files of all the finished jobs in parallel.
+
+    :param backend: The job backend
+    :param out_dir: The folder to save the CSV files in, one per job
+    :param statuses: A dict of {unit: status} from poll (polls the jobs if not given)
+    :param threads: How many downloads to run at a time
+    :param attempts: How many times to try each download
+    :param delay: How long to wait before the first retry, in seconds
+    :return: A tuple of (the paths of the CSV files downloaded, in job order, the units whose downloads failed)
+    """
+    if statuses is None:
+        statuses = poll(backend, threads)
+
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    finished = sorted((u for u, status in statuses.items() if status == FINISHED), key=unit_order)
+    if not finished:
+        return [], []
+
+    def fetch(unit):
+        return download(backend, unit, os.path.join(out_dir, unit + ".csv"), attempts, delay)
+
+    pool = ThreadPool(max(1, min(threads, len(finished))))
+    try:
+        results = pool.map(fetch, finished)
+    finally:
+        pool.close()
+        pool.join()
+
+    paths = [path for unit, path in results if path is not None]
+    failed = [unit for unit, path in results if path is None]
+    return paths, failed
+
+
+def unit_order(unit):
+    """
+    :param unit: The id of a job or subjob, eg "13.4"
+    :return: A key to sort ids by, numerically
+    """
+    return [int(part) if part.isdigit() else part for part in unit.split(".")]
+
+
+def capture_time(row):
+    """
+    :param row: A row of the CSV file
+    :return: A key to order rows by, with frames that have no capture time last
+    """
+    value = row[CAPTURE_TIME_COLUMN]
+    return (float(value) if value != "" else float("inf")), row[0]
+
+
+def is_ordered(path):
+    """
+    Check whether the rows of a CSV file are already in capture time order, as they are when frame names follow the
+    capture time. Only one row is held in memory at a time.
+
+    :param path: The path to the CSV file
+    :return: True if the rows are in order
+    """
+    f = open_csv(path, "r")
+    try:
+        reader = csv.reader(f)
+        next(reader, None)  # The header row
+
+        last = None
+        for row in reader:
+            key = capture_time(row)
+            if last is not None and key < last:
+                return False
+            last = key
+    finally:
+        f.close()
+
+    return True
+
+
+def read_rows(path):
+    """
+    Read the rows of a partial CSV file in capture time order, along with their sort keys. Rows are streamed straight
+    from the file if they're already in order, otherwise that one file is sorted in memory.
+
+    :param path: The path to the CSV file
+    :return: A generator of (key, row) tuples
+    """
+    ordered = is_ordered(path)
+
+    f = open_csv(path, "r")
+    try:
+        reader = csv.reader(f)
+        next(reader, None)  # The header row
+
+        rows = ((capture_time(row), row) for row in reader)
+        if not ordered:
+            rows = sorted(rows)
+
+        for key, row in rows:
+            yield key, row
+    finally:
+        f.close()
+
+
+def numbered_rows(path, i):
+    """
+    :param path: The path to a partial CSV file
+    :param i: The number of the file, which breaks ties between rows with the same key so rows are never compared
+    :return: A generator of (key, i, row) tuples, in capture time order
+    """
+    for key, row in read_rows(path):
+        yield key, i, row
+
+
+def merge(paths, output_path):
+    """
+    Merge partial CSV files into a single one, ordered by capture time. The files are read a row at a time and
+    merged as they're read, rather than all loaded into memory.
+
+    :param paths: The paths to the partial CSV files
+    :param output_path: The path of the merged CSV file
+    :return: The number of rows written
+    """
+    header = None
+    for path in paths:
+        f = open_csv(path, "r")
+        try:
+            header = next(csv.reader(f), None)
+        finally:
+            f.close()
+        if header is not None:
+            break
+
+    streams = [numbered_rows(path, i) for i, path in enumerate(paths)]
+
+    n = 0
+    output = open_csv(output_path, "w")
+    try:
+        writer = csv.writer(output)
+        if header is not None:
+            writer.writerow(header)
+        for key, i, row in heapq.merge(*streams):
+            writer.writerow(row)
+            n += 1
+    finally:
+        output.close()
+
+    return n
+
+
+class FakeJobs(object):
+    """
+    An in-memory job backend, standing in for Ganga. Each job is given a list of statuses it goes through (one per
+    poll) and the text of its CSV file. Polls and downloads can be made to fail a number of times first, to try out
+    retries.
+    """
+
+    def __init__(self, jobs, poll_failures=None):
+        """
+        :param jobs: A dict of {unit: (list of statuses, CSV text, number of downloads to fail)}
+        :param poll_failures: A dict of {unit: number of polls to fail}, for the jobs whose polls should fail
+        """
+        self.jobs = jobs
+        self.polls = dict((unit, 0) for unit in jobs)
+        self.failures = dict((unit, jobs[unit][2]) for unit in jobs)
+        self.poll_failures = dict(poll_failures or {})
+
+    def units(self):
+        """
+        :return: The ids of all the jobs
+        """
+        return sorted(self.jobs, key=unit_order)
+
+    def status(self, unit):
+        """
+        :param unit: The id of a job
+        :return: The job's next status
+        """
+        if self.poll_failures.get(unit, 0) > 0:
+            self.poll_failures[unit] -= 1
+            raise IOError("FAKE_POLL_FAILED")
+
+        statuses = self.jobs[unit][0]
+        status = statuses[min(self.polls[unit], len(statuses) - 1)]
+        self.polls[unit] += 1
+        return status
+
+    def download(self, unit, path):
+        """
+        :param unit: The id of a job
+        :param path: Where to write the job's CSV file
+        """
+        if self.failures[unit] > 0:
+            self.failures[unit] -= 1
+            raise IOError("FAKE_DOWNLOAD_FAILED")
+
+        f = open_csv(path, "w")
+        try:
+            f.write(self.jobs[unit][1])
+        finally:
+            f.close()
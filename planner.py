@@ -0,0 +1,330 @@
+"""
+
+grid-analysis planner.py
+
+Looks over a ZIP archive before it's submitted, so problems turn up before a grid job fails rather than after. Only
+the archive's central directory is read for the inventory: which frames there are, which have DSC files, which DSC
+files have no frame, and how much XYC data each frame has. A sample of frames spread through the archive is then
+read (checking them against their CRCs) and analysed, to measure the pixel occupancy and how long a frame takes.
+
+The time each sampled frame takes is fitted against its XYC size, and that fit is applied to the size of every
+frame in the archive to predict the total CPU time, and so how many subjobs to split it into.
+
+Timing frames needs analyse.py, and so lucid_utils. Without it the inventory and occupancy are still worked out, but
+there's no CPU time estimate.
+
+"""
+# Makes it easy to convert between Python 2 and Python 3
+from __future__ import print_function
+
+import argparse
+
+import json
+
+import math
+
+import time
+
+import zipfile
+
+import zlib
+
+import numpy
+
+import dscreader
+
+import xycarray
+
+from framearchive import list_members
+
+try:
+    import analyse
+except ImportError:
+    analyse = None
+
+# How many frames to read and analyse
+DEFAULT_SAMPLES = 50
+
+# How long each subjob should take, in CPU seconds
+DEFAULT_TARGET_SECONDS = 2 * 3600
+
+# The compression methods zipfile can read
+READABLE_COMPRESSION = set([zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])
+
+
+def inventory(archive):
+    """
+    Take stock of an archive from its central directory alone, without reading any of its members.
+
+    :param archive: An open ZipFile
+    :return: A dict of the members from list_members, the XYC size of each frame (as an array), the frames with no
+    DSC file, the DSC files with no frame, and the members that can't be decompressed
+    """
+    members = list_members(archive)
+    infos = dict((info.filename, info) for info in archive.infolist())
+
+    framed = set(dsc_name for file, xyc_name, dsc_name in members if dsc_name is not None)
+
+    return {
+        'members': members,
+        'sizes': numpy.array([infos[xyc_name].file_size for file, xyc_name, dsc_name in members], numpy.int64),
+        'compressed': sum(info.compress_size for info in infos.values()),
+        'missing_dsc': [file for file, xyc_name, dsc_name in members if dsc_name is None],
+        'orphan_dsc': sorted(name for name in infos if name.endswith(".dsc") and name not in framed),
+        'unreadable': sorted(name for name, info in infos.items() if info.compress_type not in READABLE_COMPRESSION),
+    }
+
+
+def sample_positions(n, samples):
+    """
+    :param n: The number of frames
+    :param samples: How many of them to sample
+    :return: The positions of the sampled frames, spread evenly from the first frame to the last
+    """
+    if n == 0 or samples <= 0:
+        return []
+    return sorted(set(numpy.linspace(0, n - 1, min(samples, n)).round().astype(int).tolist()))
+
+
+def sample_frames(archive, members, positions, settings=None):
+    """
+    Read some frames and, if analyse.py can be imported, time how long each one takes to analyse (including reading
+    it out of the archive).
+
+    :param archive: An open ZipFile
+    :param members: The members from list_members
+    :param positions: The positions of the frames to sample
+    :param settings: The analysis settings (see analyse.make_settings)
+    :return: A dict of the XYC size, hit pixel count and time (or NaN) of each frame read, the frames whose members
+    are corrupt and the frames whose DSC files are invalid
+    """
+    sizes = []
+    pixels = []
+    seconds = []
+    corrupt = []
+    bad_dsc = []
+
+    if analyse is not None:
+        # Time the frames with the same clustering analyse.py would use
+        full = {'fast_clustering': analyse.clustering.matches_blobbing()}
+        full.update(settings or {})
+        settings = analyse.make_settings(full)
+
+    for i in positions:
+        file, xyc_name, dsc_name = members[i]
+
+        start = time.time()
+        try:
+            data = archive.read(xyc_name)
+            content = archive.read(dsc_name).decode("latin-1") if dsc_name is not None else None
+        except (zipfile.BadZipfile, zlib.error, EOFError, IOError, NotImplementedError) as e:
+            # NotImplementedError is what zipfile raises for a compression method it can't decompress
+            corrupt.append((file, str(e)))
+            continue
+        read_time = time.time() - start
+
+        dsc = None
+        if content is not None:
+            try:
+                # Not lazy, so the DACs and start time are checked as well
+                dsc = dscreader.DscFile(dsc_name, content)
+            except IOError:
+                bad_dsc.append(file)
+
+        elapsed = float("nan")
+        try:
+            hit = len(xycarray.parse(data)[0])
+            if analyse is not None:
+                chunk = analyse.ChunkAnalysis(settings)
+                start = time.time()
+                chunk.analyse(file, data, dsc)
+                elapsed = read_time + time.time() - start
+        except IOError as e:
+            # The XYC file is malformed, or has pixels outside the frame
+            corrupt.append((file, str(e)))
+            continue
+
+        sizes.append(len(data))
+        pixels.append(hit)
+        seconds.append(elapsed)
+
+    return {
+        'sizes': numpy.array(sizes, numpy.int64),
+        'pixels': numpy.array(pixels, numpy.int64),
+        'seconds': numpy.array(seconds),
+        'corrupt': corrupt,
+        'bad_dsc': bad_dsc,
+    }
+
+
+def predict_seconds(sizes, sample_sizes, sample_seconds):
+    """
+    Predict how long every frame will take from the sampled ones, with a straight line fit of time against XYC size.
+
+    :param sizes: The XYC size of every frame
+    :param sample_sizes: The XYC size of each sampled frame
+    :param sample_seconds: How long each sampled frame took
+    :return: An array of the predicted time of every frame, in seconds
+    """
+    if len(sample_sizes) == 0:
+        return numpy.zeros(len(sizes))
+
+    if len(set(sample_sizes.tolist())) < 2:
+        # Nothing to fit a slope to, so every frame is taken to cost the average
+        return numpy.full(len(sizes), sample_seconds.mean())
+
+    slope, intercept = numpy.polyfit(sample_sizes, sample_seconds, 1)
+    # A line through noisy timings can dip below zero for small frames, which no frame actually takes
+    return numpy.maximum(intercept + slope * sizes, sample_seconds.min())
+
+
+def recommend_subjobs(total_seconds, frames, target_seconds=DEFAULT_TARGET_SECONDS):
+    """
+    :param total_seconds: The predicted CPU time of the whole dataset
+    :param frames: The number of frames in the dataset
+    :param target_seconds: How long each subjob should take
+    :return: How many subjobs to split the dataset into
+    """
+    if frames == 0:
+        return 1
+    return int(max(1, min(frames, math.ceil(total_seconds / float(target_seconds)))))
+
+
+def plan(zip_name, samples=DEFAULT_SAMPLES, target_seconds=DEFAULT_TARGET_SECONDS, settings=None):
+    """
+    Work out the inventory, occupancy and cost of an archive, and how to split it.
+
+    :param zip_name: The path to the ZIP file
+    :param samples: How many frames to sample
+    :param target_seconds: How long each subjob should take, in CPU seconds
+    :param settings: The analysis settings to time the frames with
+    :return: A dict describing the plan, which can be written out as JSON
+    """
+    archive = zipfile.ZipFile(zip_name, 'r')
+    try:
+        stock = inventory(archive)
+
+        # Frames that can't be decompressed are already listed as unreadable, so sample from the rest
+        unreadable = set(stock['unreadable'])
+        readable = [i for i, (file, xyc_name, dsc_name) in enumerate(stock['members'])
+                    if xyc_name not in unreadable and dsc_name not in unreadable]
+        positions = [readable[i] for i in sample_positions(len(readable), samples)]
+
+        sample = sample_frames(archive, stock['members'], positions, settings)
+    finally:
+        archive.close()
+
+    sizes = stock['sizes']
+    frames = len(sizes)
+
+    result = {
+        'zip': zip_name,
+        'frames': frames,
+        'xyc_bytes': int(sizes.sum()),
+        'compressed_bytes': stock['compressed'],
+        'empty_frames': int((sizes == 0).sum()),
+        'missing_dsc': stock['missing_dsc'],
+        'orphan_dsc': stock['orphan_dsc'],
+        'unreadable': stock['unreadable'],
+        'sampled': len(sample['sizes']),
+        'corrupt': sample['corrupt'],
+        'bad_dsc': sample['bad_dsc'],
+        'mean_pixels': float(sample['pixels'].mean()) if len(sample['pixels']) else 0.0,
+        'max_pixels': int(sample['pixels'].max()) if len(sample['pixels']) else 0,
+        'seconds_per_frame': None,
+        'total_seconds': None,
+        'subjobs': None,
+        'frames_per_subjob': None,
+    }
+
+    if analyse is not None and len(sample['sizes']):
+        total = float(predict_seconds(sizes, sample['sizes'], sample['seconds']).sum())
+        subjobs = recommend_subjobs(total, frames, target_seconds)
+        result.update({
+            'seconds_per_frame': total / frames,
+            'total_seconds': total,
+            'subjobs': subjobs,
+            'frames_per_subjob': int(math.ceil(frames / float(subjobs))),
+        })
+
+    return result
+
+
+def problems(result):
+    """
+    :param result: A plan, from plan
+    :return: A list of descriptions of what's wrong with the archive, empty if nothing is
+    """
+    found = []
+    if result['frames'] == 0:
+        found.append("no frames in the archive")
+    if result['missing_dsc']:
+        found.append("%d frames have no DSC file, eg %s" % (len(result['missing_dsc']), result['missing_dsc'][0]))
+    if result['orphan_dsc']:
+        found.append("%d DSC files have no frame, eg %s" % (len(result['orphan_dsc']), result['orphan_dsc'][0]))
+    if result['unreadable']:
+        found.append("%d members use an unsupported compression method, eg %s" % (len(result['unreadable']),
+                                                                                result['unreadable'][0]))
+    if result['corrupt']:
+        found.append("%d of the sampled frames are corrupt, eg %s (%s)" % ((len(result['corrupt']),) +
+                                                                          tuple(result['corrupt'][0])))
+    if result['bad_dsc']:
+        found.append("%d of the sampled frames have invalid DSC files, eg %s" % (len(result['bad_dsc']),
+                                                                                result['bad_dsc'][0]))
+    return found
+
+
+def print_plan(result):
+    """
+    Print a plan out for the user.
+
+    :param result: A plan, from plan
+    """
+    print("%s: %d frames (%d empty), %.1f MB of XYC data, %.1f MB compressed" %
+          (result['zip'], result['frames'], result['empty_frames'], result['xyc_bytes'] / 1e6,
+           result['compressed_bytes'] / 1e6))
+    print("Sampled %d frames: %.1f hit pixels per frame on average, %d at most" %
+          (result['sampled'], result['mean_pixels'], result['max_pixels']))
+
+    if result['total_seconds'] is not None:
+        print("Predicted CPU time: %.1f ms per frame, %.1f hours in total" %
+              (result['seconds_per_frame'] * 1000, result['total_seconds'] / 3600))
+        print("Recommended split: --subjobs %d (about %d frames each)" %
+              (result['subjobs'], result['frames_per_subjob']))
+    else:
+        print("No CPU time estimate, as analyse.py couldn't be imported (is lucid_utils installed?)")
+
+    for problem in problems(result):
+        print("Problem: " + problem)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Check a ZIP file of XYC and DSC files and estimate how long it will '
+                                                 'take to analyse, without extracting it.')
+
+    parser.add_argument('user_zip', metavar='user_zip', type=str, nargs='+',
+                        help='the ZIP files to plan.')
+
+    parser.add_argument('--samples', metavar='N', type=int, default=DEFAULT_SAMPLES,
+                        help='how many frames to sample from each archive (default: %d).' % DEFAULT_SAMPLES)
+
+    parser.add_argument('--target-hours', metavar='hours', type=float, default=DEFAULT_TARGET_SECONDS / 3600.0,
+                        help='how long each subjob should take, in CPU hours (default: %g).' %
+                             (DEFAULT_TARGET_SECONDS / 3600.0))
+
+    parser.add_argument('--json', metavar='plan_file', type=str, default=None,
+                        help='also write the plans to this JSON file.')
+
+    args = parser.parse_args()
+
+    plans = []
+    for zip_name in args.user_zip:
+        plans.append(plan(zip_name, args.samples, args.target_hours * 3600))
+        print_plan(plans[-1])
+
+    if args.json is not None:
+        f = open(args.json, "w")
+        try:
+            json.dump(plans, f, indent=1)
+        finally:
+            f.close()
@@ -0,0 +1,117 @@
+"""
+
+grid-analysis prefetch.py
+
+Reads frames in a background thread while the current one is being analysed, so the CPU isn't left idle waiting on
+slow (eg network mounted) storage. File reads and decompression release the GIL, so even a single core gets to
+overlap them with clustering.
+
+Frames are read ahead into a bounded queue, so at most a fixed number of them are held in memory however slow the
+analysis is.
+
+This only needs the standard library.
+
+"""
+# Makes it easy to convert between Python 2 and Python 3
+from __future__ import print_function
+
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# How long the reader waits for room in the queue before checking whether it's been stopped, in seconds
+POLL_INTERVAL = 0.1
+
+# Put on the queue after the last item
+DONE = object()
+
+
+class Prefetcher(object):
+    """
+    Runs a read function over a list of items in a background thread, keeping up to a fixed number of results ready.
+    Results come back in the same order as the items.
+    """
+
+    def __init__(self, read, items, size):
+        """
+        Start reading.
+
+        :param read: A function taking an item and returning what was read for it
+        :param items: The items to read, in order
+        :param size: The most results to hold at once (at least 1)
+        """
+        self.read = read
+        self.items = items
+        self.queue = queue.Queue(max(1, size))
+        self.stopped = threading.Event()
+        self.finished = False
+
+        self.thread = threading.Thread(target=self.run)
+        # A consumer that dies shouldn't keep the process alive
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        """
+        The background thread: read each item and queue the result, or the exception if reading fails.
+        """
+        try:
+            for item in self.items:
+                if not self.put((True, self.read(item))):
+                    return
+        except Exception as e:
+            self.put((False, e))
+            return
+        self.put((True, DONE))
+
+    def put(self, entry):
+        """
+        Wait for room in the queue, unless the prefetcher is closed in the meantime.
+
+        :param entry: The entry to queue
+        :return: False if the prefetcher was closed
+        """
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(entry, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(self):
+        """
+        Get the next result, waiting for it to be read if need be.
+
+        :return: The result
+        :raises StopIteration: If every item has been read
+        """
+        if self.finished:
+            raise StopIteration
+
+        ok, value = self.queue.get()
+        if not ok:
+            self.finished = True
+            raise value
+        if value is DONE:
+            self.finished = True
+            raise StopIteration
+        return value
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.get()
+
+    next = __next__
+
+    def close(self):
+        """
+        Stop reading ahead, and wait for the background thread to finish.
+        """
+        self.stopped.set()
+        self.thread.join()
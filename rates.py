@@ -0,0 +1,252 @@
+"""
+
+grid-analysis rates.py
+
+Particle rates over time: for each chip and each time bin, how many particles of each type were seen per second of
+acquisition time. Everything is worked out with NumPy over whole columns, rather than a row at a time.
+
+Bins are aligned to multiples of the bin width (counting from the Unix epoch), so the rates from separate subjobs line
+up and can be merged. The rates file keeps the raw counts and live time for each bin as well as the rates, and merging
+just adds those up - the per-frame rows are never needed again.
+
+"""
+# Makes it easy to convert between Python 2 and Python 3
+from __future__ import print_function
+
+import argparse
+
+import csv
+
+import numpy
+
+import columnar
+
+RATES_CSV = "grid-analysis-rates.csv"
+
+# The particle columns of the per-frame CSV file, which are also the count columns of the rates file
+PARTICLE_COLUMNS = ["Alpha", "Beta", "Gamma", "Proton", "Muon", "Other"]
+
+RATES_HEADER = (["Detector ID", "Bin Start", "Bin Width", "Frames", "Live Time"] + PARTICLE_COLUMNS +
+                [particle + " Rate" for particle in PARTICLE_COLUMNS])
+
+
+class Rates(object):
+    """
+    Counts and live time per chip and time bin, one element of each array per (chip, bin).
+    """
+
+    def __init__(self, width, chips, bins, frames, live, counts):
+        """
+        :param width: The width of the bins, in seconds
+        :param chips: The chip ID of each bin
+        :param bins: The number of each bin, so it starts at bins * width
+        :param frames: The number of frames in each bin
+        :param live: The total acquisition time of the frames in each bin, in seconds
+        :param counts: A (bins x len(PARTICLE_COLUMNS)) array of particle counts
+        """
+        self.width = width
+        self.chips = chips
+        self.bins = bins
+        self.frames = frames
+        self.live = live
+        self.counts = counts
+
+    def __len__(self):
+        return len(self.bins)
+
+    def rates(self):
+        """
+        :return: A (bins x len(PARTICLE_COLUMNS)) array of particles per second, NaN for bins with no live time
+        """
+        live = self.live[:, numpy.newaxis]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return numpy.where(live > 0, self.counts / live, numpy.nan)
+
+
+def group(width, chips, order_by, bins, frames, live, counts):
+    """
+    Add up the entries with the same chip and bin.
+
+    :param width: The width of the bins, in seconds
+    :param chips: The chip ID of each entry
+    :param order_by: What to order the entries by within each chip (start times, or bin numbers)
+    :param bins: The bin number of each entry
+    :param frames: The number of frames in each entry
+    :param live: The acquisition time of each entry
+    :param counts: An (entries x len(PARTICLE_COLUMNS)) array of particle counts
+    :return: The Rates, ordered by chip and then bin
+    """
+    if len(bins) == 0:
+        return Rates(width, numpy.array([], str), numpy.empty(0, numpy.int64), numpy.empty(0, numpy.int64),
+                     numpy.empty(0), numpy.empty((0, len(PARTICLE_COLUMNS)), numpy.int64))
+
+    chip_names, chip_codes = numpy.unique(chips, return_inverse=True)
+
+    order = numpy.lexsort((order_by, chip_codes))
+    chip_codes = chip_codes[order]
+    bins = bins[order]
+
+    # Entries are in order, so each (chip, bin) is a run of them
+    starts = numpy.flatnonzero(numpy.concatenate(([True], (chip_codes[1:] != chip_codes[:-1]) |
+                                                           (bins[1:] != bins[:-1]))))
+
+    return Rates(width, chip_names[chip_codes[starts]], bins[starts],
+                 numpy.add.reduceat(frames[order], starts), numpy.add.reduceat(live[order], starts),
+                 numpy.add.reduceat(counts[order], starts, axis=0))
+
+
+def aggregate(columns, width):
+    """
+    Work out the rates from the per-frame results. Frames with no start or acquisition time (ie no DSC file) are
+    left out.
+
+    Within each chip, frames are taken in start time order - the same order that sorting their DscFiles gives.
+
+    :param columns: A dict of per-frame columns, as given by columnar.read_columns
+    :param width: The width of the bins, in seconds
+    :return: The Rates
+    """
+    times = columns["Capture Time"]
+    live = columns["Acquisition Time"]
+    timed = ~(numpy.isnan(times) | numpy.isnan(live))
+
+    times = times[timed]
+    counts = numpy.column_stack([columns[particle][timed] for particle in PARTICLE_COLUMNS]).astype(numpy.int64)
+    bins = numpy.floor(times / width).astype(numpy.int64)
+
+    return group(width, columns["Detector ID"][timed], times, bins, numpy.ones(len(times), numpy.int64),
+                 live[timed], counts)
+
+
+def merge(all_rates):
+    """
+    Merge the rates from separate runs (eg subjobs) into one.
+
+    :param all_rates: A list of Rates, all with the same bin width
+    :return: The merged Rates
+    """
+    widths = set(rates.width for rates in all_rates)
+    if len(widths) != 1:
+        raise ValueError("Can't merge rates with different bin widths: %s" % sorted(widths))
+
+    bins = numpy.concatenate([rates.bins for rates in all_rates])
+
+    return group(widths.pop(), numpy.concatenate([rates.chips for rates in all_rates]), bins, bins,
+                 numpy.concatenate([rates.frames for rates in all_rates]),
+                 numpy.concatenate([rates.live for rates in all_rates]),
+                 numpy.concatenate([rates.counts for rates in all_rates]))
+
+
+def write(rates, path=RATES_CSV):
+    """
+    Write rates to a CSV file, a row per chip and bin.
+
+    :param rates: The Rates
+    :param path: The path of the CSV file
+    """
+    per_second = rates.rates()
+
+    output = open(path, "wb")
+    try:
+        writer = csv.writer(output)
+        writer.writerow(RATES_HEADER)
+        for i in range(len(rates)):
+            writer.writerow([rates.chips[i], int(rates.bins[i]) * rates.width, rates.width, int(rates.frames[i]),
+                             float(rates.live[i])] + rates.counts[i].tolist() +
+                            ["" if numpy.isnan(r) else float(r) for r in per_second[i]])
+    finally:
+        output.close()
+
+
+def read(path):
+    """
+    Read rates back from a CSV file written by write.
+
+    :param path: The path of the CSV file
+    :return: The Rates
+    """
+    chips = []
+    starts = []
+    widths = set()
+    frames = []
+    live = []
+    counts = []
+
+    f = open(path, "rb")
+    try:
+        reader = csv.reader(f)
+        header = next(reader)
+        count_columns = [header.index(particle) for particle in PARTICLE_COLUMNS]
+
+        for row in reader:
+            chips.append(row[0])
+            starts.append(float(row[1]))
+            widths.add(float(row[2]))
+            frames.append(int(row[3]))
+            live.append(float(row[4]))
+            counts.append([int(row[i]) for i in count_columns])
+    finally:
+        f.close()
+
+    if len(widths) > 1:
+        raise ValueError("Mixed bin widths in " + path)
+    width = widths.pop() if widths else 1.0
+
+    return Rates(width, numpy.array(chips, str), numpy.round(numpy.array(starts) / width).astype(numpy.int64),
+                 numpy.array(frames, numpy.int64), numpy.array(live),
+                 numpy.array(counts, numpy.int64).reshape(-1, len(PARTICLE_COLUMNS)))
+
+
+def rates_from_csv(csv_path, width, path=RATES_CSV):
+    """
+    Work out the rates from a per-frame CSV file and write them out.
+
+    :param csv_path: The path of the per-frame CSV file
+    :param width: The width of the bins, in seconds
+    :param path: The path of the rates file to write
+    :return: The Rates
+    """
+    rates = aggregate(columnar.read_columns(csv_path), width)
+    write(rates, path)
+    return rates
+
+
+def merge_files(paths, path=RATES_CSV):
+    """
+    Merge the rates files from separate runs (eg subjobs) into one.
+
+    :param paths: The paths of the rates files
+    :param path: The path of the merged rates file
+    :return: The merged Rates
+    """
+    rates = merge([read(p) for p in paths])
+    write(rates, path)
+    return rates
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Work out time-binned particle rates from a per-frame CSV file, or '
+                                                 'merge the rates files from separate subjobs.')
+
+    parser.add_argument('inputs', metavar='csv_file', type=str, nargs='+',
+                        help='a per-frame CSV file, or with --merge, the rates files to merge.')
+
+    parser.add_argument('--bin', metavar='seconds', type=float, default=60.0,
+                        help='the width of the time bins, in seconds (default: 60).')
+
+    parser.add_argument('--merge', action='store_true',
+                        help='merge rates files rather than working them out from a per-frame CSV file.')
+
+    parser.add_argument('--output', '-o', metavar='rates_file', type=str, default=RATES_CSV,
+                        help='the rates file to write (default: %s).' % RATES_CSV)
+
+    args = parser.parse_args()
+
+    if args.merge:
+        result = merge_files(args.inputs, args.output)
+    else:
+        if len(args.inputs) != 1:
+            parser.error("give one per-frame CSV file, or use --merge")
+        result = rates_from_csv(args.inputs[0], args.bin, args.output)
+
+    print("Wrote %d bins to %s" % (len(result), args.output))
@@ -0,0 +1,156 @@
+"""
+
+grid-analysis resultcache.py
+
+A persistent cache of per-frame particle counts, so frames we've already analysed aren't analysed again when they
+turn up in another archive (or in a re-run of a failed job).
+
+Results are keyed by a hash of the frame's XYC contents together with the version of the classifier (and anything
+else that changes the counts, see package_version), and stored in an SQLite file. The cache is bounded in size: once
+it holds more than max_entries results, the least recently used ones are evicted.
+
+"""
+# Makes it easy to convert between Python 2 and Python 3
+from __future__ import print_function
+
+import hashlib
+
+import os
+
+import sqlite3
+
+import time
+
+DEFAULT_CACHE = "grid-analysis-cache.db"
+
+DEFAULT_MAX_ENTRIES = 1000000
+
+# The particle types stored for each frame, in the order of the columns in the CSV file
+PARTICLES = ['alpha', 'beta', 'gamma', 'proton', 'muon', 'other']
+
+
+def make_key(data, version):
+    """
+    Make the cache key for a frame.
+
+    :param data: The contents of the XYC file, as bytes
+    :param version: A string identifying the classifier and anything else that changes the counts
+    :return: The key, as a hex string
+    """
+    h = hashlib.sha1(version.encode("utf-8"))
+    h.update(b"\0")
+    h.update(data)
+    return h.hexdigest()
+
+
+def package_version(package):
+    """
+    Identify the installed version of a package (or module) for cache keys. Its source files are hashed along with its
+    __version__, if it has one, so an upgrade - or a local change that kept the version number - gives a new version.
+
+    :param package: The imported package or module
+    :return: A version string
+    """
+    path = package.__file__
+    if os.path.splitext(os.path.basename(path))[0] == "__init__":
+        root = os.path.dirname(path)
+        files = [os.path.join(folder, name) for folder, dirs, names in os.walk(root)
+                 for name in names if name.endswith(".py")]
+    else:
+        root = os.path.dirname(path)
+        files = [os.path.splitext(path)[0] + ".py"]
+
+    h = hashlib.sha1()
+    for name in sorted(files):
+        h.update(os.path.relpath(name, root).replace(os.sep, "/").encode("utf-8"))
+        h.update(b"\0")
+        f = open(name, "rb")
+        try:
+            h.update(f.read())
+        finally:
+            f.close()
+        h.update(b"\0")
+
+    version = getattr(package, '__version__', None)
+    if version is None:
+        return "%s %s" % (package.__name__, h.hexdigest()[:12])
+    return "%s %s %s" % (package.__name__, version, h.hexdigest()[:12])
+
+
+class ResultCache(object):
+    """
+    An on-disk cache of particle counts, keyed by make_key.
+
+    Reading (get) can be done from any number of processes at once. Writing (put_many, touch and evict) should only
+    be done by one, which is why hits aren't recorded by get - the keys are passed to touch instead.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE, max_entries=DEFAULT_MAX_ENTRIES):
+        """
+        Open (or create) a cache.
+
+        :param path: The path to the SQLite file
+        :param max_entries: The most results to keep before evicting the least recently used
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, " +
+                                ", ".join(p + " INTEGER" for p in PARTICLES) + ", used REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS results_used ON results (used)")
+        self.connection.commit()
+
+    def get(self, key):
+        """
+        Look up the counts for a frame.
+
+        :param key: The key from make_key
+        :return: A dict of counts for each particle type, or None if the frame isn't in the cache
+        """
+        row = self.connection.execute("SELECT " + ", ".join(PARTICLES) + " FROM results WHERE key = ?",
+                                      (key,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(PARTICLES, row))
+
+    def put_many(self, entries):
+        """
+        Store the counts for some frames.
+
+        :param entries: An iterable of (key, dict of counts) tuples
+        """
+        now = time.time()
+        self.connection.executemany("INSERT OR REPLACE INTO results VALUES (?, " + ", ".join("?" for p in PARTICLES) +
+                                    ", ?)", [(key,) + tuple(counts[p] for p in PARTICLES) + (now,)
+                                             for key, counts in entries])
+        self.connection.commit()
+
+    def touch(self, keys):
+        """
+        Mark some results as just used, so they're the last to be evicted.
+
+        :param keys: An iterable of keys
+        """
+        now = time.time()
+        self.connection.executemany("UPDATE results SET used = ? WHERE key = ?", [(now, key) for key in keys])
+        self.connection.commit()
+
+    def evict(self):
+        """
+        Evict the least recently used results until there are at most max_entries left.
+
+        :return: The number of results evicted
+        """
+        count = self.connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        excess = count - self.max_entries
+
+        if excess <= 0:
+            return 0
+
+        self.connection.execute("DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY used LIMIT ?)",
+                                (excess,))
+        self.connection.commit()
+        return excess
+
+    def close(self):
+        self.connection.close()
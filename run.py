@@ -3,16 +3,69 @@ from __future__ import print_function
 import sys
 sys.path.append("/cvmfs/ganga.cern.ch/Ganga/install/LATEST/python/")
 
-from ganga import Job, File, LocalFile, Executable, DiracFile, Dirac
+from ganga import Job, File, LocalFile, Executable, DiracFile, Dirac, GenericSplitter, jobs
 import zipfile
 
+import os
+
+import shutil
+
+import hashlib
+
+import framearchive
+
+import bundlestore
+
+import monitor
+
+import dscindex
+
+import hotpixels
+
+import planner
+
+import columnar
+
 import time
 
+import csv
+
+import json
+
+from multiprocessing.pool import ThreadPool
+
 # To get arguments from user
 import argparse
 
 VERSION = str(20170218)
 
+# The scripts that need to be shipped with every job for analyse.py to run
+ANALYSIS_FILES = ['dscreader.py', 'xycarray.py', 'clustering.py', 'clusterfeatures.py', 'resultcache.py',
+                  'framearchive.py', 'checkpoint.py', 'columnar.py', 'metrics.py', 'framepack.py',
+                  'dscindex.py', 'rates.py', 'hotpixels.py', 'prefetch.py', 'clustertable.py', 'analyse.py']
+
+OUTPUT_CSV = 'grid-analysis-frames.csv'
+
+METRICS_JSON = 'grid-analysis-metrics.json'
+
+RATES_CSV = 'grid-analysis-rates.csv'
+
+CLUSTERS_FILE = 'grid-analysis-clusters.npz'
+
+# The summary of the jobs submitted from a manifest
+SUBMITTED_JSON = 'grid-analysis-submitted.json'
+
+# How many datasets from a manifest to upload at a time
+DEFAULT_UPLOAD_THREADS = 4
+
+
+def analysis_inputfiles():
+    """
+    Get the scripts that every job needs to run the analysis.
+    :return: A list of LocalFiles
+    """
+    return [LocalFile(f) for f in ANALYSIS_FILES]
+
 
 def menu():
     """
@@ -84,12 +137,31 @@ def submit_job_interactive():
     j.submit()
 
 
-def submit_job(job_name, zip_name, backend):
+def submit_job(job_name, zip_name, backend, cache=None, frames_per_job=None, subjobs=None, columnar=None,
+               keep_csv=True, metrics=False, storage_dir=None, bundle_frames=bundlestore.DEFAULT_BUNDLE_FRAMES,
+               frame_filter=None, rate_bin=None, hot_pixels=None, bundles=None, clusters=False):
     """
     Allows a user non-interactively submit a job (eg from a script)
     :param job_name: The name of the job (to be shown in DIRAC)
     :param zip_name: The path to the zip file
     :param backend: The backend to run, local or grid
+    :param cache: The path to a result cache file to ship with the job, or None
+    :param frames_per_job: Split the job into subjobs with this many frames each
+    :param subjobs: Split the job into this many subjobs, balanced by the amount of data (if frames_per_job isn't set)
+    :param columnar: Also produce a columnar output file in this format ('npz' or 'parquet'), or None
+    :param keep_csv: Whether to keep the CSV file when a columnar file is produced
+    :param metrics: Whether to time each stage of the analysis and bring back the metrics file
+    :param storage_dir: Upload the dataset in bundles to this local folder instead of a storage element, and run the
+    job locally on them (for trying out bundled uploads offline)
+    :param bundle_frames: The number of frames in each bundle uploaded to storage
+    :param frame_filter: Only ship and analyse the frames whose DSC values match this expression (see dscindex)
+    :param rate_bin: Also work out per-chip particle rates in time bins of this many seconds, and bring them back
+    :param hot_pixels: The path to a hot pixel mask to apply to every frame, which is built from the dataset first if
+    it doesn't exist yet, or None
+    :param bundles: The dataset's bundles if they've already been uploaded (see upload_dataset), or None to upload them
+    here
+    :param clusters: Whether to also bring back a table of every cluster and its features (see clustertable)
+    :return: The submitted job
     """
 
     if not zipfile.is_zipfile(zip_name):
@@ -97,37 +169,331 @@ def submit_job(job_name, zip_name, backend):
         print("The file you have supplied is not a zip file!")
         raise Exception("ZIPFileError", "The ZIP file you supplied is not a ZIP file! Cannot continue.")
 
+    if clusters and cache is not None:
+        raise Exception("OptionError", "A cluster table needs every frame clustered, so it can't be used with a cache.")
+
+    if frame_filter is not None:
+        zip_name = filter_archive(zip_name, frame_filter)
+
     j = Job()
     j.name = "grid-analysis_" + job_name
     # Tell Ganga it's running an executable
     j.application = Executable()
     j.application.exe = File('run_analyse.sh')
 
-    if backend == "grid":
-        grid_backend(j, zip_name)
+    if frames_per_job is not None or (subjobs is not None and subjobs > 1):
+        shards = framearchive.shard_archive(zip_name, frames_per_job, subjobs)
+        split_job(j, shards, backend)
+    elif backend == "grid":
+        grid_backend(j, zip_name, bundle_frames, bundles)
+    elif storage_dir is not None:
+        directory_backend(j, zip_name, storage_dir, bundle_frames, bundles)
     else:
         local_backend(j, zip_name)
+
+    if cache is not None:
+        use_cache(j, cache)
+
+    if columnar is not None:
+        use_columnar(j, columnar, keep_csv)
+
+    if metrics:
+        use_metrics(j)
+
+    if rate_bin is not None:
+        use_rates(j, rate_bin)
+
+    if hot_pixels is not None:
+        use_hot_pixels(j, zip_name, hot_pixels)
+
+    if clusters:
+        use_clusters(j)
+
     j.submit()
+    return j
+
+
+def read_job_manifest(path, default_backend="local"):
+    """
+    Read a file listing many datasets to submit at once. Each line is a CSV row of job name, path to the zip file and
+    (optionally) backend, "local" or "grid". Blank lines, lines starting with # and a "job_name,zip,backend" header
+    are skipped.
+    :param path: The path to the manifest file
+    :param default_backend: The backend for rows that don't give one
+    :return: A list of (job name, zip path, backend) tuples, one per row
+    """
+    entries = []
+
+    f = open(path, "rb")
+    try:
+        for row in csv.reader(f):
+            row = [field.strip() for field in row]
+            if not row or not row[0] or row[0].startswith("#") or row[:2] == ["job_name", "zip"]:
+                continue
+            backend = row[2].lower() if len(row) > 2 and row[2] else default_backend
+            entries.append((row[0], row[1] if len(row) > 1 else "", backend))
+    finally:
+        f.close()
+
+    return entries
+
+
+def validate_job_manifest(entries):
+    """
+    Check every entry of a manifest before anything is submitted, so a typo in one line doesn't leave a batch half
+    submitted.
+    :param entries: The entries from read_job_manifest
+    :return: A list of problems, empty if every entry is fine
+    """
+    problems = []
+    seen = set()
+
+    for job_name, zip_name, backend in entries:
+        if job_name in seen:
+            problems.append("%s: the job name is used more than once" % job_name)
+        seen.add(job_name)
+
+        if backend not in ("local", "grid"):
+            problems.append("%s: unknown backend %s (should be local or grid)" % (job_name, backend))
 
+        if not os.path.isfile(zip_name):
+            problems.append("%s: %s doesn't exist" % (job_name, zip_name))
+        elif not zipfile.is_zipfile(zip_name):
+            problems.append("%s: %s is not a zip file" % (job_name, zip_name))
 
-def grid_backend(j, zip_name):
+    return problems
+
+
+def upload_dataset(zip_name, backend, storage_dir, bundle_frames, manifest):
+    """
+    Upload a dataset in bundles ahead of submitting its job, if its job reads bundles from storage.
+    :param zip_name: The path to the zip file
+    :param backend: The backend to run, local or grid
+    :param storage_dir: The local folder standing in for storage, see submit_job
+    :param bundle_frames: The number of frames in each bundle
+    :param manifest: The bundlestore.Manifest shared by every upload
+    :return: A list of (bundle file name, reference) tuples, or None if the job doesn't use bundles
+    """
+    if backend == "grid":
+        return upload_bundles(zip_name, DiracStorage(), bundle_frames, manifest)
+    elif storage_dir is not None:
+        return upload_bundles(zip_name, bundlestore.DirectoryStorage(storage_dir), bundle_frames, manifest)
+    return None
+
+
+def submit_manifest(manifest_path, summary_path=SUBMITTED_JSON, default_backend="local",
+                    upload_threads=DEFAULT_UPLOAD_THREADS, cache=None, frames_per_job=None, subjobs=None,
+                    columnar=None, keep_csv=True, metrics=False, storage_dir=None,
+                    bundle_frames=bundlestore.DEFAULT_BUNDLE_FRAMES, frame_filter=None, rate_bin=None,
+                    hot_pixels=None, clusters=False):
+    """
+    Submit a job for every dataset listed in a manifest file, all from this one Ganga session. Every entry is checked
+    before anything is submitted, the datasets are uploaded in parallel, and then the jobs are submitted one after
+    another. The other options are the same as submit_job's, and apply to every job, except that each dataset gets its
+    own hot pixel mask (see dataset_mask_path).
+    :param manifest_path: The path to the manifest file, see read_job_manifest
+    :param summary_path: Where to write the JSON summary of the submitted jobs and their ids
+    :param default_backend: The backend for entries that don't give one
+    :param upload_threads: How many datasets to upload at a time
+    :return: A list of summary dicts, one per entry
+    """
+    entries = read_job_manifest(manifest_path, default_backend)
+    if not entries:
+        raise Exception("ManifestError", "The manifest doesn't list any datasets! Cannot continue.")
+
+    problems = validate_job_manifest(entries)
+    if problems:
+        for problem in problems:
+            print(problem)
+        raise Exception("ManifestError", "%d problems with the manifest, nothing was submitted." % len(problems))
+
+    zip_names = [zip_name for job_name, zip_name, backend in entries]
+    if frame_filter is not None:
+        zip_names = [filter_archive(zip_name, frame_filter) for zip_name in zip_names]
+
+    split = frames_per_job is not None or (subjobs is not None and subjobs > 1)
+    bundle_manifest = bundlestore.Manifest()
+    errors = {}
+
+    def upload_entry(i):
+        if split:
+            # Split jobs ship their shards with them rather than uploading bundles
+            return None
+        try:
+            return upload_dataset(zip_names[i], entries[i][2], storage_dir, bundle_frames, bundle_manifest)
+        except Exception as e:
+            errors[i] = "upload failed: %s" % e
+            return None
+
+    pool = ThreadPool(max(1, min(upload_threads, len(entries))))
+    try:
+        all_bundles = pool.map(upload_entry, range(len(entries)))
+    finally:
+        pool.close()
+        pool.join()
+
+    summary = []
+    for i, (job_name, zip_name, backend) in enumerate(entries):
+        job_id = None
+        if i not in errors:
+            try:
+                mask = dataset_mask_path(hot_pixels, job_name) if hot_pixels is not None else None
+                j = submit_job(job_name, zip_names[i], backend, cache, frames_per_job, subjobs, columnar, keep_csv,
+                               metrics, storage_dir, bundle_frames, None, rate_bin, mask, all_bundles[i],
+                               clusters)
+                job_id = j.id
+            except Exception as e:
+                errors[i] = "submission failed: %s" % (e,)
+
+        summary.append({'job_name': job_name, 'zip': zip_name, 'backend': backend, 'job_id': job_id,
+                        'submitted': job_id is not None, 'error': errors.get(i)})
+        if job_id is not None:
+            print("Submitted %s as job %s" % (job_name, job_id))
+        else:
+            print("Couldn't submit %s: %s" % (job_name, errors[i]))
+
+    f = open(summary_path, "w")
+    try:
+        json.dump(summary, f, indent=1)
+    finally:
+        f.close()
+
+    print("Submitted %d of %d jobs, see %s" % (sum(1 for entry in summary if entry['submitted']), len(summary),
+                                                 summary_path))
+    return summary
+
+
+def dataset_mask_path(hot_pixels, job_name):
+    """
+    Work out where the hot pixel mask for one dataset of a manifest goes. Each dataset gets its own mask, built from
+    its own frames, as the datasets can come from different detectors.
+    :param hot_pixels: The hot pixel mask path given for the whole manifest
+    :param job_name: The name of the dataset's job
+    :return: The path of the dataset's mask, eg grid-analysis-hotpixels-day1.npz
+    """
+    root, ext = os.path.splitext(hot_pixels)
+    return "%s-%s%s" % (root, job_name, ext)
+
+
+def filter_archive(zip_name, frame_filter):
+    """
+    Write a new ZIP file with just the frames (and their DSC files) that match a filter expression, using the local
+    DSC metadata index so the archive's DSC files are only read the first time.
+    :param zip_name: The path to the zip file
+    :param frame_filter: The filter expression, see dscindex
+    :return: The path to the new zip file
+    """
+    index = dscindex.DscIndex()
+    try:
+        index.add_archive(zip_name)
+        members = index.select(zip_name, frame_filter)
+    finally:
+        index.close()
+
+    if not members:
+        raise Exception("FilterError", "No frames in the ZIP file match the filter! Cannot continue.")
+
+    # Name the new file after the filter, so different filters on the same archive don't overwrite each other
+    digest = hashlib.sha1(frame_filter.encode("utf-8")).hexdigest()[:8]
+    filtered = os.path.splitext(zip_name)[0] + "_filter-" + digest + ".zip"
+
+    archive = zipfile.ZipFile(zip_name, 'r')
+    try:
+        framearchive.write_members(archive, members, filtered)
+    finally:
+        archive.close()
+
+    print("%d frames match the filter" % len(members))
+    return filtered
+
+
+def grid_backend(j, zip_name, bundle_frames=bundlestore.DEFAULT_BUNDLE_FRAMES, bundles=None):
     """
     Submit a job to the GridPP DIRAC instance. This is a lot more involved than the local one as we need to first
     upload the data to a storage element. Then we need to actually get working on submitting the job!
+    The data is uploaded in bundles of frames, and bundles already on the storage element aren't uploaded again.
     :param j: The job
     :param zip_name: The path to the zip file (locally)
+    :param bundle_frames: The number of frames in each bundle
+    :param bundles: The bundles if they've already been uploaded, or None to upload them now
     :return:
     """
 
+    if bundles is None:
+        bundles = upload_bundles(zip_name, DiracStorage(), bundle_frames)
+
+    j.inputfiles = [DiracFile(lfn=lfn) for name, lfn in bundles] + analysis_inputfiles()
+    j.outputfiles = [LocalFile(OUTPUT_CSV)]  # For now we'll download the output
+    j.application.args = [name for name, lfn in bundles]
+    dirac_backend(j)
+
+
+def directory_backend(j, zip_name, storage_dir, bundle_frames=bundlestore.DEFAULT_BUNDLE_FRAMES, bundles=None):
+    """
+    Run a job locally on a dataset uploaded in bundles to a local folder, which stands in for a storage element.
+    :param j: The job
+    :param zip_name: The path to the zip file (locally)
+    :param storage_dir: The folder to upload the bundles to
+    :param bundle_frames: The number of frames in each bundle
+    :param bundles: The bundles if they've already been uploaded, or None to upload them now
+    """
+    if bundles is None:
+        bundles = upload_bundles(zip_name, bundlestore.DirectoryStorage(storage_dir), bundle_frames)
+
+    j.inputfiles = [LocalFile(path) for name, path in bundles] + analysis_inputfiles()
+    j.outputfiles = [LocalFile(OUTPUT_CSV)]
+    j.application.args = [name for name, path in bundles]
+
+
+class DiracStorage(object):
+    """
+    The user's default storage element, for uploading bundles to with bundlestore.
+    """
+    name = "dirac"
+
+    def put(self, local_path):
+        """
+        Upload a bundle.
+        :param local_path: The path to the bundle (locally)
+        :return: The LFN of the uploaded file
+        """
+        return upload(local_path).lfn
+
+
+def upload_bundles(zip_name, storage, bundle_frames, manifest=None):
+    """
+    Upload a dataset to storage in bundles, skipping any that are already there.
+    :param zip_name: The path to the zip file (locally)
+    :param storage: The storage to upload to, eg DiracStorage
+    :param bundle_frames: The number of frames in each bundle
+    :param manifest: The bundlestore.Manifest to record the bundles in (the default one if not given)
+    :return: A list of (bundle file name, reference) tuples, see bundlestore.upload_bundles
+    """
+    bundles, uploaded = bundlestore.upload_bundles(zip_name, storage, manifest, bundle_frames)
+    print("%s: uploaded %d of %d bundles, the rest were already on storage" % (zip_name, uploaded, len(bundles)))
+    return bundles
+
+
+def upload(zip_name):
+    """
+    Upload a ZIP file to the user's default storage element.
+    :param zip_name: The path to the zip file (locally)
+    :return: The DiracFile for the uploaded file
+    """
     # Set up a DiracFile object with the ZIP file the user specified
     # With thanks to https://lhcb.github.io/second-analysis-steps/01-managing-files-with-ganga.html
     df = DiracFile(zip_name)
 
     df.put() # Put to the users default SE
 
-    j.inputfiles = [df, LocalFile('dscreader.py'), LocalFile('analyse.py')]
-    j.outputfiles = [LocalFile('grid-analysis-frames.csv')]  # For now we'll download the output
-    j.application.args = [df.namePattern]
+    return df
+
+
+def dirac_backend(j):
+    """
+    Set a job up to run on the GridPP DIRAC instance.
+    :param j: The job
+    """
     j.backend = Dirac()
     # We can force somewhere to run here, QMUL isn't working atm.
     # https://twiki.cern.ch/twiki/bin/view/LHCb/FAQ/GangaLHCbFAQ#How_can_I_set_which_Grid_site_my
@@ -142,17 +508,262 @@ def local_backend(j, zip_name):
     :param zip_name: The path to the zip file (locally)
     :return:
     """
-    j.inputfiles = [LocalFile(zip_name), LocalFile('dscreader.py'), LocalFile('analyse.py')]
-    j.outputfiles = [LocalFile('grid-analysis-frames.csv')]
+    j.inputfiles = [LocalFile(zip_name)] + analysis_inputfiles()
+    j.outputfiles = [LocalFile(OUTPUT_CSV)]
     j.application.args = [zip_name]
 
 
-def check_job_status():
-    raise NotImplementedError
+def split_job(j, shards, backend):
+    """
+    Split a job into a subjob for each shard of the dataset, using a Ganga splitter. Each subjob analyses one shard
+    and produces its own partial CSV file, which can be merged afterwards.
+    :param j: The job
+    :param shards: The paths to the shard ZIP files (locally), see framearchive.shard_archive
+    :param backend: The backend to run, local or grid
+    """
+    inputfiles = []
+    args = []
+
+    for shard in shards:
+        if backend == "grid":
+            df = upload(shard)
+            inputfiles.append([df] + analysis_inputfiles())
+            args.append([df.namePattern])
+        else:
+            inputfiles.append([LocalFile(shard)] + analysis_inputfiles())
+            args.append([shard])
+
+    if backend == "grid":
+        dirac_backend(j)
+
+    j.inputfiles = analysis_inputfiles()
+    j.outputfiles = [LocalFile(OUTPUT_CSV)]
+    j.application.args = []
+
+    j.splitter = GenericSplitter()
+    j.splitter.multi_attrs = {'inputfiles': inputfiles, 'application.args': args}
+
+
+def use_cache(j, cache):
+    """
+    Ship a result cache with a job, so frames already in it aren't analysed again. The updated cache is brought back
+    with the rest of the output.
+    :param j: The job, with its backend already set up
+    :param cache: The path to the result cache file (locally)
+    """
+    name = os.path.basename(cache)
+    extra_inputs = [LocalFile(cache)] if os.path.exists(cache) else []
+
+    if j.splitter is not None:
+        # Each subjob gets its own input files and arguments from the splitter
+        attrs = j.splitter.multi_attrs
+        attrs['inputfiles'] = [files + extra_inputs for files in attrs['inputfiles']]
+        attrs['application.args'] = [args + ['--cache', name] for args in attrs['application.args']]
+        j.splitter.multi_attrs = attrs
+    else:
+        j.inputfiles = j.inputfiles + extra_inputs
+        j.application.args = j.application.args + ['--cache', name]
+
+    j.outputfiles = j.outputfiles + [LocalFile(name)]
+
+
+def use_columnar(j, fmt, keep_csv=True):
+    """
+    Have a job write its results as a columnar file as well as (or instead of) the CSV file, and bring it back with
+    the rest of the output.
+    :param j: The job, with its backend already set up
+    :param fmt: The columnar format, 'npz' or 'parquet'
+    :param keep_csv: Whether to keep the CSV file too
+    """
+    extra_args = ['--columnar', fmt]
+    if not keep_csv:
+        extra_args.append('--no-csv')
+
+    if j.splitter is not None:
+        attrs = j.splitter.multi_attrs
+        attrs['application.args'] = [args + extra_args for args in attrs['application.args']]
+        j.splitter.multi_attrs = attrs
+    else:
+        j.application.args = j.application.args + extra_args
+
+    outputfiles = [LocalFile(f) for f in [OUTPUT_CSV] if keep_csv]
+    outputfiles.append(LocalFile(OUTPUT_CSV[:-4] + '.' + fmt))
+    j.outputfiles = outputfiles + [f for f in j.outputfiles if f.namePattern != OUTPUT_CSV]
+
+
+def use_metrics(j):
+    """
+    Have a job time each stage of its analysis, and bring the metrics file back with the rest of the output.
+    :param j: The job, with its backend already set up
+    """
+    if j.splitter is not None:
+        attrs = j.splitter.multi_attrs
+        attrs['application.args'] = [args + ['--metrics'] for args in attrs['application.args']]
+        j.splitter.multi_attrs = attrs
+    else:
+        j.application.args = j.application.args + ['--metrics']
+
+    j.outputfiles = j.outputfiles + [LocalFile(METRICS_JSON)]
+
+
+def use_rates(j, rate_bin):
+    """
+    Have a job work out per-chip particle rates over time as well as the per-frame rows, and bring them back with the
+    rest of the output. The rates files from subjobs can be merged with rates.py --merge.
+    :param j: The job, with its backend already set up
+    :param rate_bin: The width of the time bins, in seconds
+    """
+    extra_args = ['--rates', str(rate_bin)]
+
+    if j.splitter is not None:
+        attrs = j.splitter.multi_attrs
+        attrs['application.args'] = [args + extra_args for args in attrs['application.args']]
+        j.splitter.multi_attrs = attrs
+    else:
+        j.application.args = j.application.args + extra_args
+
+    j.outputfiles = j.outputfiles + [LocalFile(RATES_CSV)]
+
+
+def use_hot_pixels(j, zip_name, hot_pixels):
+    """
+    Ship a hot pixel mask with a job, so hot pixels are dropped from every frame before clustering. The mask is built
+    here from the whole dataset if it doesn't exist yet, so every subjob uses the same one.
+    :param j: The job, with its backend already set up
+    :param zip_name: The path to the zip file
+    :param hot_pixels: The path to the hot pixel mask file (locally)
+    """
+    if not os.path.exists(hot_pixels):
+        print("Building the hot pixel mask...")
+        mask = hotpixels.build([zip_name])
+        mask.save(hot_pixels)
+        print("Found %d hot pixels across %d chips." % (mask.hot_pixels(), len(mask.masks)))
+
+    name = os.path.basename(hot_pixels)
+    extra_args = ['--hot-pixels', name]
+
+    if j.splitter is not None:
+        attrs = j.splitter.multi_attrs
+        attrs['inputfiles'] = [files + [LocalFile(hot_pixels)] for files in attrs['inputfiles']]
+        attrs['application.args'] = [args + extra_args for args in attrs['application.args']]
+        j.splitter.multi_attrs = attrs
+    else:
+        j.inputfiles = j.inputfiles + [LocalFile(hot_pixels)]
+        j.application.args = j.application.args + extra_args
+
+
+def use_clusters(j):
+    """
+    Have a job save every cluster with its features and label, and bring the table back with the rest of the output.
+    The tables from subjobs can be merged with clustertable.py --merge.
+    :param j: The job, with its backend already set up
+    """
+    if j.splitter is not None:
+        attrs = j.splitter.multi_attrs
+        attrs['application.args'] = [args + ['--clusters'] for args in attrs['application.args']]
+        j.splitter.multi_attrs = attrs
+    else:
+        j.application.args = j.application.args + ['--clusters']
+
+    j.outputfiles = j.outputfiles + [LocalFile(CLUSTERS_FILE)]
+
+
+class GangaJobs(object):
+    """
+    The grid-analysis jobs in the user's Ganga repository, as a job backend for monitor. A job that was split is
+    looked at subjob by subjob.
+    """
+
+    def units(self):
+        """
+        :return: The ids of every grid-analysis job, or of every subjob of the ones that were split
+        """
+        units = []
+        for j in jobs:
+            if not j.name.startswith(monitor.JOB_PREFIX):
+                continue
+            if len(j.subjobs) > 0:
+                units.extend(str(sj.fqid) for sj in j.subjobs)
+            else:
+                units.append(str(j.fqid))
+        return units
+
+    def job(self, unit):
+        """
+        :param unit: The id of a job or subjob, eg "12" or "13.4"
+        :return: The Ganga job
+        """
+        ids = [int(part) for part in unit.split(".")]
+        j = jobs(ids[0])
+        if len(ids) > 1:
+            j = j.subjobs(ids[1])
+        return j
+
+    def status(self, unit):
+        """
+        :param unit: The id of a job or subjob
+        :return: The job's status, as Ganga has it
+        """
+        return self.job(unit).status
+
+    def download(self, unit, path):
+        """
+        Copy a finished job's CSV file out of its output folder, fetching the output sandbox first if Ganga hasn't
+        already.
+        :param unit: The id of a job or subjob
+        :param path: Where to save the CSV file
+        """
+        j = self.job(unit)
+        output = os.path.join(j.outputdir, OUTPUT_CSV)
+        if not os.path.exists(output) and hasattr(j.backend, 'getOutputSandbox'):
+            j.backend.getOutputSandbox()
+        shutil.copyfile(output, path)
+
+
+def check_job_status(backend=None):
+    """
+    Poll all of the grid-analysis jobs at once and print their status.
+    :param backend: The job backend to ask (defaults to GangaJobs)
+    :return: A dict of {job id: status}
+    """
+    if backend is None:
+        backend = GangaJobs()
+
+    statuses = monitor.poll(backend)
+
+    for unit in sorted(statuses, key=monitor.unit_order):
+        print("%-10s %s" % (unit, statuses[unit]))
+
+    counts = monitor.summarise(statuses)
+    print(", ".join("%d %s" % (counts[status], status) for status in sorted(counts)))
+
+    return statuses
+
+
+def retrieve_data(output_csv=OUTPUT_CSV, backend=None):
+    """
+    Download the CSV files of every finished grid-analysis job in parallel, and merge them into a single CSV file
+    ordered by capture time.
+    :param output_csv: The path of the merged CSV file
+    :param backend: The job backend to ask (defaults to GangaJobs)
+    :return: The number of frames in the merged CSV file
+    """
+    if backend is None:
+        backend = GangaJobs()
 
+    statuses = monitor.poll(backend)
+    paths, failed = monitor.retrieve(backend, output_csv + ".parts", statuses)
 
-def retrieve_data():
-    raise NotImplementedError
+    if failed:
+        print("Couldn't download the output of jobs: " + ", ".join(failed))
+
+    unfinished = [unit for unit, status in statuses.items() if status != monitor.FINISHED]
+    if unfinished:
+        print("%d jobs haven't finished yet, their output isn't included" % len(unfinished))
+
+    n = monitor.merge(paths, output_csv)
+    print("Merged %d frames from %d jobs into %s" % (n, len(paths), output_csv))
+    return n
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Ganga based submission tool for Timepix data on GridPP/local running')
@@ -166,12 +777,89 @@ if __name__ == "__main__":
     parser.add_argument('--grid', '-g', action='store_true',
                     help='if set grid-analysis will use the DIRAC backend (GridPP).')
 
+    parser.add_argument('--cache', '-c', metavar='cache_file', type=str, default=None,
+                    help='a result cache file to ship with the job, so frames analysed before are skipped.')
+
+    parser.add_argument('--frames-per-job', metavar='N', type=int, default=None,
+                    help='split the dataset into subjobs of N frames each.')
+
+    parser.add_argument('--subjobs', '-s', metavar='N', type=int, default=None,
+                    help='split the dataset into N subjobs with about the same amount of data in each.')
+
+    parser.add_argument('--columnar', choices=['npz', 'parquet'], default=None,
+                    help='also produce a typed, compressed columnar output file in this format.')
+
+    parser.add_argument('--no-csv', action='store_true',
+                    help='with --columnar, only bring back the columnar file and not the CSV file.')
+
+    parser.add_argument('--bundle-frames', metavar='N', type=int, default=bundlestore.DEFAULT_BUNDLE_FRAMES,
+                    help='upload the dataset in bundles of N frames; bundles uploaded before are not uploaded again.')
+
+    parser.add_argument('--storage-dir', metavar='folder', type=str, default=None,
+                    help='without --grid, upload the bundles to this folder instead of a storage element and run '
+                         'on them locally (for testing).')
+
+    parser.add_argument('--filter', '-f', metavar='expression', type=str, default=None,
+                    help='only ship and analyse the frames whose DSC values match this expression, eg '
+                         '"chip_id = \'B06-W0212\' and bias_voltage >= 20" (see dscindex.py).')
+
+    parser.add_argument('--rates', metavar='seconds', type=float, default=None,
+                    help='also work out per-chip particle rates in time bins of this many seconds.')
+
+    parser.add_argument('--hot-pixels', metavar='mask_file', type=str, default=None,
+                    help='drop hot pixels from every frame, using this mask file (built from the dataset first if it '
+                         'doesn\'t exist yet). With --manifest, each dataset gets its own mask, named after its job.')
+
+    parser.add_argument('--clusters', action='store_true',
+                    help='also bring back a table of every cluster and its features, to study or classify again '
+                         'locally (see clustertable.py).')
+
+    parser.add_argument('--metrics', '-m', action='store_true',
+                    help='time each stage of the analysis and bring back a metrics file with the output.')
+
+    parser.add_argument('--manifest', metavar='manifest_file', type=str, default=None,
+                    help='submit a job for every dataset listed in this file, one "job_name,zip,backend" line each, '
+                         'from a single Ganga session. The other options apply to every job.')
+
+    parser.add_argument('--summary', metavar='summary_file', type=str, default=SUBMITTED_JSON,
+                    help='with --manifest, write a JSON summary of the submitted jobs and their ids here (default: '
+                         '%s).' % SUBMITTED_JSON)
+
+    parser.add_argument('--upload-threads', metavar='N', type=int, default=DEFAULT_UPLOAD_THREADS,
+                    help='with --manifest, upload N datasets at a time (default: %d).' % DEFAULT_UPLOAD_THREADS)
+
+    parser.add_argument('--plan', action='store_true',
+                    help='with --zip, check the zip file and estimate how long it will take to analyse and how to '
+                         'split it, without submitting anything.')
+
+    parser.add_argument('--status', action='store_true',
+                    help='check the status of all grid-analysis jobs and subjobs.')
+
+    parser.add_argument('--retrieve', metavar='output_csv', type=str, default=None,
+                    help='download the output of every finished job and merge it into this CSV file.')
+
     parser.add_argument('--interactive', '-i', action='store_true',
                     help='force the program to run in interactive mode.')
 
     args = parser.parse_args()
 
-    if args.interactive is True or args.jobname is None or args.zip is None:
+    if args.columnar is not None and not columnar.available(args.columnar):
+        parser.error("--columnar parquet needs pyarrow, which isn't installed")
+
+    if args.plan:
+        if args.zip is None:
+            parser.error("--plan needs a zip file, given with --zip")
+        planner.print_plan(planner.plan(args.zip))
+    elif args.status:
+        check_job_status()
+    elif args.retrieve is not None:
+        retrieve_data(args.retrieve)
+    elif args.manifest is not None:
+        submit_manifest(args.manifest, args.summary, "grid" if args.grid else "local", args.upload_threads,
+                        args.cache, args.frames_per_job, args.subjobs, args.columnar, not args.no_csv, args.metrics,
+                        args.storage_dir, args.bundle_frames, args.filter, args.rates, args.hot_pixels,
+                        args.clusters)
+    elif args.interactive is True or args.jobname is None or args.zip is None:
         user_input = ""
 
         while user_input not in ['1', '2', '3']:
@@ -185,8 +873,7 @@ if __name__ == "__main__":
             retrieve_data()
 
     else:
-        if args.grid is None:
-            backend = "local"
-        else:
-            backend = "grid"
-        submit_job(args.jobname, args.zip, backend)
+        backend = "grid" if args.grid else "local"
+        submit_job(args.jobname, args.zip, backend, args.cache, args.frames_per_job, args.subjobs, args.columnar,
+                   not args.no_csv, args.metrics, args.storage_dir, args.bundle_frames, args.filter,
+                   args.rates, args.hot_pixels, clusters=args.clusters)
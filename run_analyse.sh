@@ -13,7 +13,7 @@ export LD_LIBRARY_PATH=/cvmfs/lucid.egi.eu/libraries/python2.6/site-packages/:/c
 # Add CERN@school libraries to the PATH.
 export PATH=/cvmfs/lucid.egi.eu/libraries/python2.6/site-packages/:/cvmfs/cernatschool.egi.eu/lib64/:/cvmfs/cernatschool.egi.eu/lib/:/cvmfs/cernatschool.egi.eu/lib64/atlas:$PATH
 
-# Run the analysis
-python analyse.py $1
+# Run the analysis, passing along any options (eg --resume to carry on from a checkpoint)
+python analyse.py "$@"
 
 
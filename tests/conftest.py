@@ -0,0 +1,12 @@
+"""
+
+grid-analysis tests/conftest.py
+
+The modules live at the top of the repository rather than in a package, so make them importable from the tests.
+
+"""
+import os
+
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
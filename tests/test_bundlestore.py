@@ -0,0 +1,97 @@
+"""
+
+grid-analysis tests/test_bundlestore.py
+
+Checks that datasets are uploaded in bundles, and that bundles already on storage aren't uploaded again.
+
+"""
+import os
+
+import zipfile
+
+import bundlestore
+
+
+def make_dataset(path, frames):
+    """
+    Write a ZIP of small XYC frames, each with a DSC file.
+    """
+    archive = zipfile.ZipFile(path, 'w')
+    try:
+        for i in range(frames):
+            name = "frame_%04d.txt" % i
+            archive.writestr(name, "%d\t%d\t%d\n" % (i % 256, i // 256, i + 1))
+            archive.writestr(name + ".dsc", "A000000001\n")
+    finally:
+        archive.close()
+
+
+def test_second_upload_skips_every_bundle(tmpdir):
+    zip_name = str(tmpdir.join("frames.zip"))
+    make_dataset(zip_name, 25)
+
+    storage = bundlestore.DirectoryStorage(str(tmpdir.join("storage")))
+    manifest = bundlestore.Manifest(str(tmpdir.join("manifest.json")))
+
+    first, uploaded = bundlestore.upload_bundles(zip_name, storage, manifest, frames_per_bundle=10)
+    assert uploaded == 3
+    assert sorted(os.listdir(storage.path)) == sorted(name for name, reference in first)
+
+    stored = dict((name, os.path.getmtime(reference)) for name, reference in first)
+
+    # A new manifest object reads back what the first upload saved
+    second, uploaded = bundlestore.upload_bundles(zip_name, storage, bundlestore.Manifest(manifest.path),
+                                                  frames_per_bundle=10)
+    assert uploaded == 0
+    assert second == first
+    assert dict((name, os.path.getmtime(reference)) for name, reference in second) == stored
+
+
+def test_bundles_hold_every_frame(tmpdir):
+    zip_name = str(tmpdir.join("frames.zip"))
+    make_dataset(zip_name, 25)
+
+    storage = bundlestore.DirectoryStorage(str(tmpdir.join("storage")))
+    bundles, uploaded = bundlestore.upload_bundles(zip_name, storage, bundlestore.Manifest(str(tmpdir.join("m.json"))),
+                                                   frames_per_bundle=10)
+
+    names = []
+    for name, reference in bundles:
+        archive = zipfile.ZipFile(reference, 'r')
+        names.extend(archive.namelist())
+        archive.close()
+
+    original = zipfile.ZipFile(zip_name, 'r')
+    assert sorted(names) == sorted(original.namelist())
+    original.close()
+
+
+def test_only_new_frames_are_uploaded(tmpdir):
+    storage = bundlestore.DirectoryStorage(str(tmpdir.join("storage")))
+    manifest = bundlestore.Manifest(str(tmpdir.join("manifest.json")))
+
+    zip_name = str(tmpdir.join("frames.zip"))
+    make_dataset(zip_name, 20)
+    bundlestore.upload_bundles(zip_name, storage, manifest, frames_per_bundle=10)
+
+    # Adding frames to the end of a dataset only changes its last bundle
+    make_dataset(zip_name, 25)
+    bundles, uploaded = bundlestore.upload_bundles(zip_name, storage, manifest, frames_per_bundle=10)
+
+    assert len(bundles) == 3
+    assert uploaded == 1
+
+
+def test_bundle_missing_from_storage_is_uploaded_again(tmpdir):
+    zip_name = str(tmpdir.join("frames.zip"))
+    make_dataset(zip_name, 25)
+
+    storage = bundlestore.DirectoryStorage(str(tmpdir.join("storage")))
+    manifest = bundlestore.Manifest(str(tmpdir.join("manifest.json")))
+
+    bundles, uploaded = bundlestore.upload_bundles(zip_name, storage, manifest, frames_per_bundle=10)
+    os.remove(bundles[0][1])
+
+    bundles, uploaded = bundlestore.upload_bundles(zip_name, storage, manifest, frames_per_bundle=10)
+    assert uploaded == 1
+    assert os.path.exists(bundles[0][1])
@@ -0,0 +1,40 @@
+"""
+
+grid-analysis tests/test_clusterfeatures.py
+
+Checks the cluster features against values worked out by hand.
+
+"""
+import numpy
+
+import clusterfeatures
+
+
+def test_features():
+    # A single pixel, and a straight line of three pixels
+    ids = numpy.array([0, 1, 1, 1])
+    x = numpy.array([5, 10, 11, 12])
+    y = numpy.array([5, 20, 20, 20])
+    c = numpy.array([7, 1, 2, 3])
+
+    feats = clusterfeatures.features(ids, x, y, c)
+
+    assert feats['size'].tolist() == [1, 3]
+    assert feats['total'].tolist() == [7, 6]
+    assert feats['x'].tolist() == [5, 11]
+    assert feats['y'].tolist() == [5, 20]
+    assert feats['radius'].tolist() == [0, 1]
+    assert numpy.allclose(feats['density'], [1 / (numpy.pi * 0.25), 3 / (numpy.pi * 2.25)])
+    assert numpy.allclose(feats['linearity'], [0, 0])
+
+
+def test_count():
+    labels = numpy.array([0, 2, 2, 5])
+    frames = numpy.array([0, 0, 2, 2])
+
+    counts = clusterfeatures.count(labels, frames, 3)
+
+    assert counts.shape == (3, len(clusterfeatures.PARTICLES))
+    assert counts[0].tolist() == [1, 0, 1, 0, 0, 0]
+    assert counts[1].tolist() == [0] * 6
+    assert counts[2].tolist() == [0, 0, 1, 0, 0, 1]
@@ -0,0 +1,177 @@
+"""
+
+grid-analysis tests/test_clustering.py
+
+Checks clustering against SciPy's labelling and against lucid_utils' blobbing.find, and that matches_blobbing only
+passes for a blobbing.find that finds the same clusters and holds each pixel as an (x, y) tuple.
+
+"""
+import numpy
+
+import pytest
+
+from scipy import ndimage
+
+import clustering
+
+
+def random_frames(count, width=64, height=64, seed=0):
+    """
+    :return: A list of frames of random counts, with occupancies from nearly empty to nearly full
+    """
+    rng = numpy.random.RandomState(seed)
+    frames = []
+    for i in range(count):
+        occupancy = rng.uniform(0.01, 0.6)
+        hit = rng.random_sample((width, height)) < occupancy
+        frames.append(numpy.where(hit, rng.randint(1, 300, (width, height)), 0))
+    return frames
+
+
+def test_numpy_labelling_matches_scipy():
+    for frame in random_frames(40):
+        expected, expected_n = ndimage.label(frame > 0, structure=clustering.STRUCTURE)
+        found, found_n = clustering._label_numpy(frame > 0)
+
+        assert found_n == expected_n
+        assert (found == expected).all()
+
+
+def test_numpy_labelling_of_a_batch_matches_scipy():
+    frames = numpy.array(random_frames(10, seed=1))
+
+    expected, expected_n = ndimage.label(frames > 0, structure=clustering.BATCH_STRUCTURE)
+    found, found_n = clustering._label_numpy(frames > 0)
+
+    assert found_n == expected_n
+    assert (found == expected).all()
+
+
+def test_empty_frame_has_no_clusters():
+    frame = numpy.zeros((256, 256))
+
+    assert clustering._label_numpy(frame > 0)[1] == 0
+    assert clustering.find(frame) == []
+
+
+def test_diagonal_pixels_are_one_cluster():
+    frame = numpy.zeros((8, 8))
+    frame[1, 1] = frame[2, 2] = frame[3, 1] = 5
+    frame[6, 6] = 1
+
+    assert clustering.find(frame) == [[(1, 1), (2, 2), (3, 1)], [(6, 6)]]
+
+
+@pytest.mark.parametrize("tile_size", [1, 7, 16, 32])
+def test_tiled_labelling_matches_whole_frame(tile_size):
+    for frame in random_frames(10, 70, 50, seed=tile_size):
+        expected, expected_n = clustering.label(frame)
+        found, found_n = clustering.label_tiled(frame > 0, tile_size, threads=2)
+
+        assert found_n == expected_n
+        assert (found == expected).all()
+
+
+def test_batch_matches_frame_by_frame():
+    frames = random_frames(10, seed=2)
+
+    assert clustering.find_batch(frames) == [clustering.find(frame) for frame in frames]
+
+
+def test_pixel_labelling_matches_frame():
+    for frame in random_frames(20, 32, 32, seed=3):
+        x, y = numpy.nonzero(frame)
+
+        assert clustering.find_pixels(x, y) == clustering.find(frame)
+
+
+def test_matches_blobbing():
+    blobbing = pytest.importorskip('lucid_utils.blobbing')
+
+    for frame in random_frames(10, 256, 256, seed=4):
+        blobs = blobbing.find(frame)
+
+        # How a Blob holds its pixels is checked by test_installed_blobbing_matches, so only compare the clusters
+        assert all(len(pixel) == 2 for blob in blobs for pixel in blob.pixels)
+        assert (sorted(sorted(tuple(pixel) for pixel in blob.pixels) for blob in blobs) ==
+                sorted(clustering.find(frame)))
+
+
+def test_tile_threads_are_replaced_and_closed():
+    frame = random_frames(1, 70, 50, seed=5)[0]
+
+    clustering.label_tiled(frame > 0, 16, threads=2)
+    first = clustering._tile_pool
+    clustering.label_tiled(frame > 0, 16, threads=3)
+
+    # Changing the number of threads shuts the old pool down rather than leaving its threads running
+    assert clustering._tile_pool is not first
+    assert all(not worker.is_alive() for worker in first._pool)
+
+    clustering.close_tile_threads()
+    assert clustering._tile_pool is None
+
+
+class FakeBlob(object):
+    def __init__(self, pixels):
+        self.pixels = pixels
+
+
+class FakeBlobbing(object):
+    """ Stands in for lucid_utils' blobbing module, finding clusters by flood fill and holding pixels as given. """
+
+    def __init__(self, pixel=tuple, neighbours=((1, 0), (0, 1), (1, 1), (1, -1))):
+        self.pixel = pixel
+        self.neighbours = [(dx, dy) for dx, dy in neighbours] + [(-dx, -dy) for dx, dy in neighbours]
+
+    def find(self, frame):
+        seen = set()
+        blobs = []
+        for start in zip(*[a.tolist() for a in numpy.nonzero(frame)]):
+            if start in seen:
+                continue
+            seen.add(start)
+            stack = [start]
+            pixels = []
+            while stack:
+                x, y = stack.pop()
+                pixels.append(self.pixel((x, y)))
+                for dx, dy in self.neighbours:
+                    p = (x + dx, y + dy)
+                    if (0 <= p[0] < frame.shape[0] and 0 <= p[1] < frame.shape[1] and p not in seen and
+                            frame[p] > 0):
+                        seen.add(p)
+                        stack.append(p)
+            blobs.append(FakeBlob(pixels))
+        return blobs
+
+
+def test_reference_frame_has_every_kind_of_cluster():
+    frame = clustering.reference_frame()
+    sizes = sorted(len(cluster) for cluster in clustering.find(frame))
+
+    # Lone pixels, pairs, lines and blocks, and diagonal neighbours that a side-by-side flood fill would split up
+    assert sizes[0] == 1 and sizes[-1] >= 5
+    assert len(clustering.find(frame)) < len(FakeBlobbing(neighbours=((1, 0), (0, 1))).find(frame))
+
+
+def test_matches_blobbing_with_tuple_pixels():
+    assert clustering.matches_blobbing(FakeBlobbing())
+
+
+def test_blobbing_holding_pixels_as_lists_does_not_match():
+    assert not clustering.matches_blobbing(FakeBlobbing(pixel=list))
+
+
+def test_blobbing_holding_pixels_as_arrays_does_not_match():
+    assert not clustering.matches_blobbing(FakeBlobbing(pixel=numpy.array))
+
+
+def test_blobbing_without_diagonals_does_not_match():
+    assert not clustering.matches_blobbing(FakeBlobbing(neighbours=((1, 0), (0, 1))))
+
+
+def test_installed_blobbing_matches():
+    blobbing = pytest.importorskip('lucid_utils.blobbing')
+
+    assert clustering.matches_blobbing(blobbing)
@@ -0,0 +1,63 @@
+"""
+
+grid-analysis tests/test_dscindex.py
+
+Checks that the DSC index keeps frames apart by their full member name and by archive.
+
+"""
+import zipfile
+
+import pytest
+
+import dscindex
+
+DSC = """A000000001
+[F0]
+Type=i16 [X,Y,C] width=256 height=256
+"ChipboardID" ("Medipix or chipboard ID"):
+char[9]
+%s
+
+"HV" ("Bias voltage [V]"):
+double[1]
+%s
+"""
+
+
+def make_archive(path, frames):
+    """
+    :param frames: A dict of {XYC member name: (chip ID, bias voltage)}
+    """
+    archive = zipfile.ZipFile(path, 'w')
+    try:
+        for name, (chip_id, hv) in sorted(frames.items()):
+            archive.writestr(name, "1\t1\t10\n")
+            archive.writestr(name + ".dsc", DSC % (chip_id, hv))
+    finally:
+        archive.close()
+
+
+def test_same_name_in_different_folders(tmpdir):
+    zip_name = str(tmpdir.join("a.zip"))
+    make_archive(zip_name, {"run1/frame_0001.txt": ("A01-W0001", 20.0), "run2/frame_0001.txt": ("B06-W0212", 10.0)})
+
+    frames = dscindex.filter_frames([zip_name], "bias_voltage >= 15", str(tmpdir.join("index.db")))
+
+    assert frames == {zip_name: set(["run1/frame_0001.txt"])}
+
+
+def test_matches_are_kept_per_archive(tmpdir):
+    a = str(tmpdir.join("a.zip"))
+    b = str(tmpdir.join("b.zip"))
+    make_archive(a, {"frame_0001.txt": ("A01-W0001", 20.0), "frame_0002.txt": ("A01-W0001", 10.0)})
+    make_archive(b, {"frame_0001.txt": ("B06-W0212", 10.0), "frame_0002.txt": ("B06-W0212", 20.0)})
+
+    frames = dscindex.filter_frames([a, b], "bias_voltage >= 15", str(tmpdir.join("index.db")))
+
+    assert frames == {a: set(["frame_0001.txt"]), b: set(["frame_0002.txt"])}
+
+
+@pytest.mark.parametrize("expression", ["chip_id = 'x'; drop table frames", "colour = 'red'", ""])
+def test_bad_expression_is_rejected(expression):
+    with pytest.raises(ValueError):
+        dscindex.compile_filter(expression)
@@ -0,0 +1,166 @@
+"""
+
+grid-analysis tests/test_dscreader.py
+
+Checks the single-pass DSC parser against the values the original line-by-line parser read from the same files, and
+that bad files raise an IOError.
+
+"""
+import os
+
+import pytest
+
+import dscreader
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+# What the original dscreader.DscFile read from each of the files in tests/data
+DACS = [1, 100, 255, 127, 127, 0, 405, 7, 130, 128, 80, 85, 128, 128]
+
+EXPECTED = {
+    'single.dsc': {
+        'getFrameWidth': 256, 'getFrameHeight': 256, 'getAcqMode': 1, 'getAcqTime': 0.5, 'getChipId': 'B06-W0212',
+        'getDACs': DACS, 'getFirmwareVersion': '5.0.1', 'getBiasVoltage': 22.5, 'getHwTimerMode': 1,
+        'getInterface': 'USB 1.0', 'getMpxClock': 10.0, 'getMpxType': 3, 'getPixelmanVersion': '2.2.2',
+        'getPolarity': 1, 'getStartTime': 1487400000.123456, 'getStartTimeS': 'Sat Feb 18 06:40:00.123456 2017',
+        'getTpxClock': 10.0, 'getNameAndSerialNumber': 'MX-10 A01-W0001',
+    },
+    # A quad detector, with the Timepix clock given in MHz, "Bias Voltage" in a different case and a start time
+    # string header, which is ignored in favour of the start time itself
+    'quad.dsc': {
+        'getFrameWidth': 512, 'getFrameHeight': 512, 'getAcqMode': 1, 'getAcqTime': 2.0, 'getChipId': 'C08-W0255',
+        'getDACs': DACS, 'getFirmwareVersion': '5.0.1', 'getBiasVoltage': 60.0, 'getHwTimerMode': 1,
+        'getInterface': 'USB 1.0', 'getMpxClock': 10.0, 'getMpxType': 3, 'getPixelmanVersion': '2.2.2',
+        'getPolarity': 1, 'getStartTime': 1500000000.5, 'getStartTimeS': 'Fri Jul 14 02:40:00.500000 2017',
+        'getTpxClock': 48.5, 'getNameAndSerialNumber': 'MX-10 A01-W0001',
+    },
+}
+
+
+def read(name):
+    with open(os.path.join(DATA, name)) as f:
+        return f.read()
+
+
+def values(dsc):
+    return dict((getter, getattr(dsc, getter)()) for getter in EXPECTED['single.dsc'])
+
+
+@pytest.mark.parametrize("name", sorted(EXPECTED))
+@pytest.mark.parametrize("lazy", [False, True])
+def test_matches_original_parser(name, lazy):
+    assert values(dscreader.DscFile(os.path.join(DATA, name), lazy=lazy)) == EXPECTED[name]
+
+
+@pytest.mark.parametrize("name", sorted(EXPECTED))
+def test_content_matches_file(name):
+    assert values(dscreader.DscFile(name, read(name))) == EXPECTED[name]
+
+
+def test_dac_getters():
+    dsc = dscreader.DscFile("single.dsc", read("single.dsc"), lazy=True)
+
+    assert dsc.getIKrum() == DACS[0]
+    assert dsc.getTHL() == DACS[6]
+    assert dsc.getRefLVDS() == DACS[13]
+
+
+def test_lazy_values_are_decoded_on_access():
+    dsc = dscreader.DscFile("single.dsc", read("single.dsc"), lazy=True)
+
+    assert dsc._DscFile__dacs is None
+    assert dsc._DscFile__startTimeS is None
+
+    assert dsc.getDACs() == DACS
+    assert dsc._DscFile__dacs == DACS
+    assert dsc._DscFile__startTimeS is None
+
+    assert dsc.getStartTimeS() == EXPECTED['single.dsc']['getStartTimeS']
+    assert dsc._DscFile__startTimeS == EXPECTED['single.dsc']['getStartTimeS']
+
+
+def test_eager_values_are_decoded_up_front():
+    dsc = dscreader.DscFile("single.dsc", read("single.dsc"))
+
+    assert dsc._DscFile__dacs == DACS
+    assert dsc._DscFile__startTimeS == EXPECTED['single.dsc']['getStartTimeS']
+
+
+def test_parse_many(tmpdir):
+    bad = tmpdir.join("bad.dsc")
+    bad.write(read("single.dsc").replace("22.5", "150.0"))
+
+    paths = [os.path.join(DATA, "quad.dsc"), str(bad), os.path.join(DATA, "single.dsc")]
+    dscs = dscreader.parse_many(paths)
+
+    assert dscs[1] is None
+    assert dscs[0]._DscFile__dacs is None
+    assert values(dscs[0]) == EXPECTED['quad.dsc']
+    assert values(dscs[2]) == EXPECTED['single.dsc']
+
+
+@pytest.mark.parametrize("old, new", [
+    ("width=256", "width=100"),
+    ("width=256", "width=wide"),
+    ("B06-W0212", "not a chip"),
+    ("22.5", "150.0"),
+    ("22.5", "high"),
+    ("\ni32[1]\n3\n", "\ni32[1]\n7\n"),
+    ("1487400000.123456", "yesterday"),
+])
+def test_bad_values_raise(old, new):
+    content = read("single.dsc")
+    assert old in content
+
+    with pytest.raises(IOError):
+        dscreader.DscFile("single.dsc", content.replace(old, new, 1))
+
+
+def truncations():
+    """
+    :return: The sample file cut off at every line, and in the middle of the line giving the frame size
+    """
+    lines = read("single.dsc").splitlines(True)
+    cuts = ["".join(lines[:n]) for n in range(len(lines))]
+    return cuts + ["".join(lines[:2]) + "Type=i16 [X,Y,C] width=256"]
+
+
+@pytest.mark.parametrize("content", truncations())
+@pytest.mark.parametrize("lazy", [False, True])
+def test_truncated_files_raise_ioerror(content, lazy):
+    # Cutting the file off after a value line leaves a valid file, just with fewer values, so this only checks that
+    # nothing but an IOError is raised
+    try:
+        dscreader.DscFile("single.dsc", content, lazy=lazy)
+    except IOError:
+        pass
+
+
+@pytest.mark.parametrize("content", [
+    "",
+    "A000000001\n[F0]\n",
+    "A000000001\n[F0]\nType=i16 [X,Y,C] width=256 height=256\n\"HV\" (\"Bias voltage [V]\"):\n",
+    "A000000001\n[F0]\nType=i16 [X,Y,C] width=256 height=256\n\"HV\" (\"Bias voltage [V]\"):\ndouble[1]\n",
+])
+def test_truncated_header_raises(content):
+    with pytest.raises(IOError):
+        dscreader.DscFile("single.dsc", content)
+
+
+@pytest.mark.parametrize("value", ["inf", "nan"])
+@pytest.mark.parametrize("lazy", [False, True])
+def test_start_time_that_isnt_a_time_raises(value, lazy):
+    with pytest.raises(IOError):
+        dscreader.DscFile("single.dsc", read("single.dsc").replace("1487400000.123456", value), lazy=lazy)
+
+
+def test_bad_dacs_raise():
+    content = read("single.dsc").replace("1 100 255 127", "1 100 lots 127")
+
+    with pytest.raises(IOError):
+        dscreader.DscFile("single.dsc", content)
+
+    # Lazily, only once they're asked for
+    dsc = dscreader.DscFile("single.dsc", content, lazy=True)
+    with pytest.raises(IOError):
+        dsc.getDACs()
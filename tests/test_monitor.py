@@ -0,0 +1,100 @@
+"""
+
+grid-analysis tests/test_monitor.py
+
+Checks the job monitor against the in-memory FakeJobs backend: retries with backoff, and merging the CSV files of
+finished jobs in capture time order.
+
+"""
+import csv
+
+import pytest
+
+import monitor
+
+HEADER = "Frame Name,Capture Time,Detector ID,Bias Voltage,Acquisition Time,Alpha,Beta,Gamma,Proton,Muon,Other\n"
+
+
+def job_csv(*frames):
+    """
+    :param frames: (frame name, capture time) tuples, capture time "" for frames without DSC files
+    :return: The text of a job's CSV file
+    """
+    return HEADER + "".join("%s,%s,A01-W0001,20.0,1.0,0,0,1,0,0,0\n" % frame for frame in frames)
+
+
+def read_csv(path):
+    f = monitor.open_csv(path, "r")
+    try:
+        return list(csv.reader(f))
+    finally:
+        f.close()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """
+    Record the waits between retries, rather than waiting.
+    """
+    waits = []
+    monkeypatch.setattr(monitor.time, "sleep", waits.append)
+    return waits
+
+
+def test_failing_polls_are_retried_with_backoff(sleeps):
+    backend = monitor.FakeJobs({"1": (["completed"], job_csv(), 0), "2": (["running"], job_csv(), 0)},
+                               poll_failures={"1": 2})
+
+    statuses = monitor.poll(backend, attempts=3, delay=1.5)
+
+    assert statuses == {"1": "completed", "2": "running"}
+    assert sleeps == [1.5, 3.0]
+
+
+def test_job_that_never_polls_is_unknown(sleeps):
+    backend = monitor.FakeJobs({"1": (["completed"], job_csv(), 0)}, poll_failures={"1": 5})
+
+    assert monitor.poll(backend, attempts=3, delay=1.0) == {"1": monitor.UNKNOWN}
+    assert sleeps == [1.0, 2.0]
+
+
+def test_failing_downloads_are_retried_with_backoff(tmpdir, sleeps):
+    backend = monitor.FakeJobs({"1": (["completed"], job_csv(("a.txt", "10.0")), 2),
+                                "2": (["completed"], job_csv(("b.txt", "20.0")), 3),
+                                "3": (["running"], job_csv(), 0)})
+
+    paths, failed = monitor.retrieve(backend, str(tmpdir), attempts=3, delay=0.5, threads=1)
+
+    assert paths == [str(tmpdir.join("1.csv"))]
+    assert failed == ["2"]
+    # Job 1 succeeds on its third attempt and job 2 runs out of attempts, each waiting longer before every retry
+    assert sleeps == [0.5, 1.0, 0.5, 1.0]
+
+
+def test_statuses_move_on_with_each_poll():
+    backend = monitor.FakeJobs({"13.4": (["submitted", "running", "completed"], job_csv(), 0)})
+
+    assert [monitor.poll(backend)["13.4"] for i in range(4)] == ["submitted", "running", "completed", "completed"]
+
+
+def test_merge_orders_rows_by_capture_time(tmpdir):
+    backend = monitor.FakeJobs({
+        "1": (["completed"], job_csv(("a.txt", "30.0"), ("b.txt", "10.0"), ("c.txt", "")), 0),
+        "2": (["completed"], job_csv(("d.txt", "5.0"), ("e.txt", "20.0"), ("f.txt", "40.0")), 0),
+        "10": (["completed"], job_csv(("g.txt", "15.0"), ("h.txt", "")), 0),
+    })
+
+    paths, failed = monitor.retrieve(backend, str(tmpdir.join("parts")))
+    assert failed == []
+
+    output = str(tmpdir.join("merged.csv"))
+    assert monitor.merge(paths, output) == 8
+
+    rows = read_csv(output)
+    assert rows[0] == HEADER.strip().split(",")
+    # Frames without a capture time go last, ordered by name
+    assert [row[0] for row in rows[1:]] == ["d.txt", "b.txt", "g.txt", "e.txt", "a.txt", "f.txt", "c.txt", "h.txt"]
+
+
+def test_unit_order_is_numeric():
+    assert sorted(["10", "2", "13.10", "13.4", "1"], key=monitor.unit_order) == ["1", "2", "10", "13.4", "13.10"]
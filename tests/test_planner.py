@@ -0,0 +1,62 @@
+"""
+
+grid-analysis tests/test_planner.py
+
+Checks that the planner reports bad members of an archive rather than crashing on them.
+
+"""
+import zipfile
+
+import planner
+
+DSC = """A000000001
+[F0]
+Type=i16 [X,Y,C] width=256 height=256
+"HV" ("Bias voltage [V]"):
+double[1]
+20.0
+"""
+
+
+def make_archive(path, frames):
+    """
+    :param frames: A list of (XYC member name, XYC contents, DSC contents or None)
+    """
+    archive = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+    try:
+        for name, xyc, dsc in frames:
+            archive.writestr(name, xyc)
+            if dsc is not None:
+                archive.writestr(name + ".dsc", dsc)
+    finally:
+        archive.close()
+
+
+def test_truncated_dsc_files_are_reported(tmpdir):
+    zip_name = str(tmpdir.join("frames.zip"))
+    make_archive(zip_name, [
+        ("frame_0001.txt", "1\t1\t10\n", DSC),
+        ("frame_0002.txt", "1\t1\t10\n", "A000000001\n[F0]\n"),
+        ("frame_0003.txt", "1\t1\t10\n", DSC.rsplit("\n", 2)[0]),
+        ("frame_0004.txt", "1\t1\t10\n", "A000000001\n[F0]\nType=i16 [X,Y,C] width=256"),
+    ])
+
+    result = planner.plan(zip_name)
+
+    assert result['sampled'] == 4
+    assert result['bad_dsc'] == ["frame_0002.txt", "frame_0003.txt", "frame_0004.txt"]
+    assert any("invalid DSC files" in problem for problem in planner.problems(result))
+
+
+def test_malformed_frames_are_corrupt(tmpdir):
+    zip_name = str(tmpdir.join("frames.zip"))
+    make_archive(zip_name, [
+        ("frame_0001.txt", "1\t1\t10\n", DSC),
+        ("frame_0002.txt", "1\t1\t10\n2\tx\t5\n", DSC),
+        ("frame_0003.txt", "1\t-1\t10\n", DSC),
+    ])
+
+    result = planner.plan(zip_name)
+
+    assert result['sampled'] == 1
+    assert [file for file, error in result['corrupt']] == ["frame_0002.txt", "frame_0003.txt"]
@@ -0,0 +1,52 @@
+"""
+
+grid-analysis tests/test_resultcache.py
+
+Checks that cache keys change with the versions of the packages behind the counts.
+
+"""
+import sys
+
+import resultcache
+
+
+def make_package(tmpdir, name, source, version=None):
+    """
+    :return: A freshly imported package in tmpdir, with a single submodule holding source
+    """
+    package = tmpdir.mkdir(name)
+    package.join("__init__.py").write("" if version is None else "__version__ = %r\n" % version)
+    package.mkdir("classification").join("__init__.py").write("")
+    package.join("classification").join("algorithm.py").write(source)
+
+    sys.path.insert(0, str(tmpdir))
+    try:
+        sys.modules.pop(name, None)
+        return __import__(name)
+    finally:
+        sys.path.remove(str(tmpdir))
+
+
+def test_version_changes_with_source(tmpdir):
+    before = resultcache.package_version(make_package(tmpdir.mkdir("a"), "fakelucid", "CUT = 1\n"))
+    same = resultcache.package_version(make_package(tmpdir.mkdir("b"), "fakelucid", "CUT = 1\n"))
+    after = resultcache.package_version(make_package(tmpdir.mkdir("c"), "fakelucid", "CUT = 2\n"))
+
+    assert before == same
+    assert before != after
+    assert before.startswith("fakelucid ")
+
+
+def test_version_includes_version_number(tmpdir):
+    version = resultcache.package_version(make_package(tmpdir, "fakelucid", "CUT = 1\n", "1.2.3"))
+
+    assert version.startswith("fakelucid 1.2.3 ")
+
+
+def test_version_of_a_module():
+    assert resultcache.package_version(resultcache).startswith("resultcache ")
+
+
+def test_key_depends_on_version():
+    assert resultcache.make_key(b"1\t2\t3\n", "a") == resultcache.make_key(b"1\t2\t3\n", "a")
+    assert resultcache.make_key(b"1\t2\t3\n", "a") != resultcache.make_key(b"1\t2\t3\n", "b")
@@ -0,0 +1,55 @@
+"""
+
+grid-analysis tests/test_xycarray.py
+
+Checks the XYC reader parses good files and refuses bad ones rather than truncating them.
+
+"""
+import numpy
+
+import pytest
+
+import xycarray
+
+
+def test_parse():
+    x, y, c = xycarray.parse(b"1\t2\t30\n4\t5\t60\n")
+
+    assert x.tolist() == [1, 4]
+    assert y.tolist() == [2, 5]
+    assert c.tolist() == [30, 60]
+    assert x.dtype == xycarray.COORD_DTYPE
+    assert c.dtype == xycarray.COUNT_DTYPE
+
+
+def test_empty_file():
+    assert [len(a) for a in xycarray.parse(b"\n")] == [0, 0, 0]
+
+
+@pytest.mark.parametrize("data", [
+    b"1\t2\t30\n4\t5\n",            # A line missing its count
+    b"1\t2\t30\n4\tfive\t60\n",     # A bad token after a good line, where numpy.fromstring stopped without complaint
+    b"1\t2\t30\n-1\t5\t60\n",       # A negative coordinate, which would wrap round to 65535
+    b"1\t2\t30\n70000\t5\t60\n",    # A coordinate too big for COORD_DTYPE
+    b"1.5\t2\t30\n",                # Not a whole number
+    b"1\t2\tnan\n",
+])
+def test_bad_files_raise(data):
+    with pytest.raises(IOError):
+        xycarray.parse(data)
+
+
+def test_pixels_outside_the_frame_raise():
+    x, y, c = xycarray.parse(b"1\t300\t30\n")
+
+    with pytest.raises(IOError):
+        xycarray.to_frame(x, y, c)
+
+    assert xycarray.to_frame(x, y, c, 512, 512)[1, 300] == 30
+
+
+def test_batch_offsets():
+    x, y, c, offsets = xycarray.parse_batch([b"1\t2\t3\n", b"", b"4\t5\t6\n7\t8\t9\n"])
+
+    assert offsets.tolist() == [0, 1, 1, 3]
+    assert numpy.array_equal(x, [1, 4, 7])
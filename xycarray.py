@@ -0,0 +1,181 @@
+"""
+
+grid-analysis xycarray.py
+
+A vectorised reader for Timepix frames in the x,y,C format. Rather than going through a file one line at a time, the
+whole file is handed to NumPy in one go and split into compact x, y and C arrays. Like xycreader, a file that isn't
+made of whole-number x, y, C triples (or has pixels outside the frame) raises an IOError.
+
+"""
+# Makes it easy to convert between Python 2 and Python 3
+from __future__ import print_function
+
+import numpy
+
+# Frames are 256x256 unless the DSC file tells us otherwise
+DEFAULT_WIDTH = 256
+
+DEFAULT_HEIGHT = 256
+
+# Pixel coordinates are never bigger than 1024, so 16 bits is plenty
+COORD_DTYPE = numpy.uint16
+
+COUNT_DTYPE = numpy.int32
+
+
+def parse(data):
+    """
+    Parse the contents of an XYC file into arrays of pixel coordinates and counts.
+
+    :param data: The contents of the XYC file, as a string or bytes
+    :return: A tuple of (x, y, C) arrays, one element per hit pixel
+    """
+    if not data.strip():
+        return (numpy.empty(0, COORD_DTYPE), numpy.empty(0, COORD_DTYPE), numpy.empty(0, COUNT_DTYPE))
+
+    # Splitting on any run of whitespace (tabs and newlines included) and converting every token at once is still one
+    # pass through NumPy, but unlike numpy.fromstring it fails on a bad token rather than quietly stopping there
+    try:
+        values = numpy.array(data.split(), numpy.float64)
+    except ValueError:
+        raise IOError("BAD_XYC_FILE")
+
+    if values.size % 3 != 0:
+        raise IOError("BAD_XYC_FILE")
+
+    values = values.reshape(-1, 3)
+
+    # Every value has to be a whole number (NaN and infinity aren't), and the coordinates have to fit COORD_DTYPE
+    # rather than wrapping round when they're cast
+    if (values != numpy.floor(values)).any():
+        raise IOError("BAD_XYC_FILE")
+
+    coords = values[:, :2]
+    if (coords < 0).any() or (coords > numpy.iinfo(COORD_DTYPE).max).any():
+        raise IOError("BAD_XYC_FILE")
+
+    return (values[:, 0].astype(COORD_DTYPE), values[:, 1].astype(COORD_DTYPE), values[:, 2].astype(COUNT_DTYPE))
+
+
+def read(filename):
+    """
+    Read an XYC file into arrays of pixel coordinates and counts.
+
+    :param filename: The path to the XYC file
+    :return: A tuple of (x, y, C) arrays, one element per hit pixel
+    """
+    f = open(filename, "rb")
+    try:
+        return parse(f.read())
+    finally:
+        f.close()
+
+
+def to_frame(x, y, c, width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT):
+    """
+    Turn pixel arrays into a full frame, laid out the same way as lucid_utils' xycreader.read (frame[x][y] = C).
+
+    :param x: The x coordinates of the hit pixels
+    :param y: The y coordinates of the hit pixels
+    :param c: The counts of the hit pixels
+    :param width: The width of the frame
+    :param height: The height of the frame
+    :return: A width x height array of counts
+    """
+    if len(x) and (x.max() >= width or y.max() >= height):
+        raise IOError("BAD_XYC_FILE")
+
+    frame = numpy.zeros((width, height))
+    frame[x, y] = c
+    return frame
+
+
+def hit_pixels(x, y, c):
+    """
+    Get the pixels that are hit in the frame to_frame would build from some pixel arrays, without building it: where
+    a pixel is listed more than once the last one wins, and pixels with no counts are left out.
+
+    :param x: The x coordinates of the pixels
+    :param y: The y coordinates of the pixels
+    :param c: The counts of the pixels
+    :return: A tuple of (x, y, C) arrays of the hit pixels, in raster order (the order numpy.nonzero gives)
+    """
+    position = x.astype(numpy.int64) * 65536 + y
+
+    # numpy.unique finds the first of any repeats, so look through the pixels backwards to get the last
+    last = len(position) - 1 - numpy.unique(position[::-1], return_index=True)[1]
+
+    hit = last[c[last] != 0]
+    return x[hit], y[hit], c[hit]
+
+
+def parse_frame(data, width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT):
+    """
+    Parse the contents of an XYC file straight into a full frame.
+
+    :param data: The contents of the XYC file, as a string or bytes
+    :param width: The width of the frame
+    :param height: The height of the frame
+    :return: A width x height array of counts
+    """
+    x, y, c = parse(data)
+    return to_frame(x, y, c, width, height)
+
+
+def read_frame(filename, width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT):
+    """
+    Read an XYC file straight into a full frame. This can be used in place of xycreader.read.
+
+    :param filename: The path to the XYC file
+    :param width: The width of the frame
+    :param height: The height of the frame
+    :return: A width x height array of counts
+    """
+    x, y, c = read(filename)
+    return to_frame(x, y, c, width, height)
+
+
+def parse_batch(datas):
+    """
+    Parse the contents of many XYC files into one concatenated set of arrays. The pixels of frame i are
+    x[offsets[i]:offsets[i + 1]] (and the same for y and C), so later stages can work on the whole batch at once.
+
+    :param datas: An iterable of XYC file contents
+    :return: A tuple of (x, y, C, offsets) arrays, where offsets has one more element than there are frames
+    """
+    xs = []
+    ys = []
+    cs = []
+
+    for data in datas:
+        x, y, c = parse(data)
+        xs.append(x)
+        ys.append(y)
+        cs.append(c)
+
+    offsets = numpy.zeros(len(xs) + 1, numpy.int64)
+    offsets[1:] = numpy.cumsum([len(x) for x in xs])
+
+    if not xs:
+        return (numpy.empty(0, COORD_DTYPE), numpy.empty(0, COORD_DTYPE), numpy.empty(0, COUNT_DTYPE), offsets)
+
+    return numpy.concatenate(xs), numpy.concatenate(ys), numpy.concatenate(cs), offsets
+
+
+def read_batch(filenames):
+    """
+    Read many XYC files into one concatenated set of arrays, see parse_batch.
+
+    :param filenames: An iterable of paths to XYC files
+    :return: A tuple of (x, y, C, offsets) arrays, where offsets has one more element than there are frames
+    """
+    datas = []
+
+    for filename in filenames:
+        f = open(filename, "rb")
+        try:
+            datas.append(f.read())
+        finally:
+            f.close()
+
+    return parse_batch(datas)